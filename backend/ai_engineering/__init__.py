@@ -10,15 +10,115 @@ This package contains all AI/LLM related functionality including:
 
 from .anthropic_client import AnthropicClient
 from .bedrock_client import BedrockClient
+from .client_registry import ConnectionSettings, configure_clients, get_anthropic_client, get_bedrock_client
 from .extract import extract_invoice_from_file, extract_invoice_from_csv
-from .image_processor import get_image_from_pdf
-from .prompts import INVOICE_EXTRACTION_PROMPT
+from .image_processor import (
+    get_image_from_pdf,
+    iter_image_from_pdf,
+    spool_image_from_pdf,
+    PageSpool,
+    PreprocessPolicy,
+    RenderOptions,
+    RenderStats,
+    ResolutionBudget,
+    TilingPolicy,
+    TriagePolicy,
+)
+from .image_encoding import EncodingPolicy, ImagePayload
+from .page_cache import PageCache, get_page_cache
+from .render_sandbox import SandboxPolicy, iter_sandboxed_pages, shutdown_render_sandboxes
+from .document_fingerprint import FingerprintPolicy, compute_document_fingerprint, verify_duplicate
+from .text_layer import TextLayer, TextLayerPolicy, extract_text_layer
+from .segmentation import Segment, SegmentationPolicy, segment_pdf, split_pdf
+from .concurrency import gather_limited, run_sync
+from .prompt_cache import cached_text_block, combine_usage, usage_from_response
+from .json_stream import ExtractionEvents, IncrementalJSONParser, invoice_stream_parser
+from .structured_output import EXTRACTION_TOOL, OutputPolicy, output_budget
+from .provider_router import ProviderRouter, RouterPolicy, configure_router, get_provider_router
+from .rate_limit import RateLimiter, RateLimitPolicy, RateLimitTimeout, configure_rate_limiter, get_rate_limiter
+from .cascade import CascadePolicy, classify_from_text, should_extract
+from .model_selection import DocumentComplexity, ModelSelection, SelectionPolicy, select_model
+from .circuit_breaker import BreakerPolicy, CircuitBreaker, CircuitOpenError, configure_circuit_breaker, get_circuit_breaker
+from .windowing import WindowPolicy, extract_in_windows, extract_in_windows_async, merge_window_results, plan_windows
+from .vendor_templates import apply_template, learn_template, observe_extraction
+from .prompts import INVOICE_EXTRACTION_PROMPT, INVOICE_TEXT_EXTRACTION_PROMPT
 
 __all__ = [
     'AnthropicClient',
     'BedrockClient', 
+    'ConnectionSettings',
+    'configure_clients',
+    'get_anthropic_client',
+    'get_bedrock_client',
     'extract_invoice_from_file',
     'extract_invoice_from_csv',
     'get_image_from_pdf',
-    'INVOICE_EXTRACTION_PROMPT'
+    'iter_image_from_pdf',
+    'spool_image_from_pdf',
+    'PageSpool',
+    'RenderStats',
+    'ResolutionBudget',
+    'RenderOptions',
+    'PreprocessPolicy',
+    'TilingPolicy',
+    'TriagePolicy',
+    'EncodingPolicy',
+    'ImagePayload',
+    'PageCache',
+    'get_page_cache',
+    'SandboxPolicy',
+    'iter_sandboxed_pages',
+    'shutdown_render_sandboxes',
+    'FingerprintPolicy',
+    'compute_document_fingerprint',
+    'verify_duplicate',
+    'TextLayer',
+    'TextLayerPolicy',
+    'extract_text_layer',
+    'Segment',
+    'SegmentationPolicy',
+    'segment_pdf',
+    'split_pdf',
+    'WindowPolicy',
+    'extract_in_windows',
+    'extract_in_windows_async',
+    'gather_limited',
+    'run_sync',
+    'cached_text_block',
+    'combine_usage',
+    'usage_from_response',
+    'ExtractionEvents',
+    'IncrementalJSONParser',
+    'invoice_stream_parser',
+    'EXTRACTION_TOOL',
+    'OutputPolicy',
+    'output_budget',
+    'ProviderRouter',
+    'RouterPolicy',
+    'configure_router',
+    'get_provider_router',
+    'RateLimiter',
+    'RateLimitPolicy',
+    'RateLimitTimeout',
+    'configure_rate_limiter',
+    'get_rate_limiter',
+    'CascadePolicy',
+    'classify_from_text',
+    'should_extract',
+    'DocumentComplexity',
+    'ModelSelection',
+    'SelectionPolicy',
+    'select_model',
+    'BreakerPolicy',
+    'CircuitBreaker',
+    'CircuitOpenError',
+    'configure_circuit_breaker',
+    'get_circuit_breaker',
+    'merge_window_results',
+    'plan_windows',
+    'apply_template',
+    'learn_template',
+    'observe_extraction',
+    'INVOICE_EXTRACTION_PROMPT',
+    'INVOICE_TEXT_EXTRACTION_PROMPT'
 ] 
\ No newline at end of file
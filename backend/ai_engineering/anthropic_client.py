@@ -1,25 +1,84 @@
+import asyncio
 import base64
 import json
 import anthropic
 import os
 import sys
 import re
-from typing import Dict, Any, Optional, Union, List
+import threading
+import weakref
+from typing import Dict, Any, Optional, Union, List, Iterable, Callable
 from decimal import Decimal
 from datetime import datetime
-from .prompts import INVOICE_EXTRACTION_PROMPT
+from .prompts import INVOICE_EXTRACTION_PROMPT, INVOICE_TEXT_EXTRACTION_PROMPT
+from .image_encoding import ImageInput, ImagePayload, image_content_blocks
+from .cascade import classification_content, classification_result
+from .circuit_breaker import CircuitOpenError, get_circuit_breaker
+from .prompt_cache import cached_text_block, combine_usage, log_usage, usage_from_response
+from .json_stream import ExtractionEvents, IncrementalJSONParser, invoice_stream_parser, output_started
+from .model_selection import FAST, STANDARD, ModelSelection
+from .rate_limit import get_rate_limiter, message_tokens
+from .structured_output import (
+    CLASSIFICATION_MAX_TOKENS, CLASSIFICATION_TOOL, CLASSIFICATION_TOOL_CHOICE, CLASSIFICATION_TOOL_NAME,
+    EXTRACTION_TOOL, EXTRACTION_TOOL_CHOICE, OutputPolicy, continuation_messages, event_output_text,
+    output_budget, tool_input, trim_answer,
+)
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
 class AnthropicClient:
-    def __init__(self):
+    def __init__(
+        self,
+        async_http_client_factory: Optional[Callable[[], Any]] = None,
+        prompt_caching: bool = True,
+        output_policy: Optional[OutputPolicy] = None,
+        **client_options,
+    ):
+        """
+        Args:
+            async_http_client_factory: Builds the HTTP client for the async SDK
+                client; called once per event loop, since async connections
+                can't be shared between loops
+            prompt_caching: Mark the extraction prompt as a cacheable prefix, so
+                requests after the first read it from the prompt cache
+            output_policy: Sizing of each extraction's output budget, and how
+                often an answer cut off at it is continued
+            **client_options: Passed on to anthropic.Anthropic (e.g. http_client,
+                timeout, max_retries); see client_registry for the shared,
+                pooled instance
+        """
         api_key = os.getenv('ANTHROPIC_API_KEY')
         if not api_key:
             raise ValueError("ANTHROPIC_API_KEY not found in environment variables. Please set it in your .env file.")
-        self.client = anthropic.Anthropic(api_key=api_key)
+        self.client = anthropic.Anthropic(api_key=api_key, **client_options)
         self.model = "claude-3-5-sonnet-20240620"
+        # Small, fast model for classifying documents before extraction
+        self.classification_model = "claude-3-haiku-20240307"
+        # Models of the extraction tiers chosen by model_selection
+        self.tier_models = {FAST: "claude-3-haiku-20240307", STANDARD: self.model}
+        self.prompt_caching = prompt_caching
+        self.output_policy = output_policy or OutputPolicy()
+        self._api_key = api_key
+        self._async_client_options = {k: v for k, v in client_options.items() if k != 'http_client'}
+        self._async_http_client_factory = async_http_client_factory
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, anthropic.AsyncAnthropic]" = weakref.WeakKeyDictionary()
+        self._async_clients_lock = threading.Lock()
+
+    @property
+    def async_client(self) -> anthropic.AsyncAnthropic:
+        """The async SDK client for the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._async_clients_lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                options = dict(self._async_client_options)
+                if self._async_http_client_factory is not None:
+                    options['http_client'] = self._async_http_client_factory()
+                client = anthropic.AsyncAnthropic(api_key=self._api_key, **options)
+                self._async_clients[loop] = client
+            return client
 
     def _parse_numeric(self, value: str) -> Optional[float]:
         """Parse numeric values from strings, handling various formats."""
@@ -45,76 +104,283 @@ class AnthropicClient:
             parsed_items.append(parsed_item)
         return parsed_items
 
-    def extract_invoice_data(self, image_base64: Union[str, List[str]]) -> Dict[str, Any]:
+    def _build_content(
+        self,
+        image_base64: Union[ImageInput, Iterable[ImageInput]],
+        document_text: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Build the message content: the prompt, the text layer if given, then every image."""
+        # Always convert to an iterable for consistent handling
+        images = [image_base64] if isinstance(image_base64, (str, ImagePayload)) else image_base64
+
+        # Prepare the message content, consuming the page producer lazily.
+        # The SDK needs the whole request in memory, so this is the one point
+        # where every page is materialized at once. The prompt is the same for
+        # every document, so it comes first and ends the cached prefix.
+        if document_text is not None:
+            content = [
+                cached_text_block(INVOICE_TEXT_EXTRACTION_PROMPT, self.prompt_caching),
+                {"type": "text", "text": document_text},
+            ]
+        else:
+            content = [cached_text_block(INVOICE_EXTRACTION_PROMPT, self.prompt_caching)]
+        image_count = 0
+        for img in images:
+            content.extend(image_content_blocks(img))
+            image_count += 1
+        if document_text is not None:
+            print(f"Processing {len(document_text)} characters of text and {image_count} image(s) with Anthropic...", file=sys.stderr)
+        else:
+            print(f"Processing {image_count} image(s) with Anthropic...", file=sys.stderr)
+        return content
+
+    def _message_request(
+        self,
+        content: List[Dict[str, Any]],
+        document_text: Optional[str] = None,
+        selection: Optional[ModelSelection] = None,
+    ) -> Dict[str, Any]:
+        """
+        The extraction request: a forced call of the extraction tool, with an output
+        budget sized to the document (or the selection's model and budget).
+        """
+        if selection is not None:
+            model, max_tokens = self.tier_models[selection.tier], selection.max_tokens
+        else:
+            page_count = sum(1 for block in content if block["type"] == "image")
+            model, max_tokens = self.model, output_budget(page_count, document_text, self.output_policy)
+        return {
+            "model": model,
+            "max_tokens": max_tokens,
+            "tools": [EXTRACTION_TOOL],
+            "tool_choice": EXTRACTION_TOOL_CHOICE,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": content,
+                }
+            ],
+        }
+
+    def _continuation_request(self, request: Dict[str, Any], answer: str) -> Dict[str, Any]:
+        """A request that continues a cut-off answer as text (an unfinished tool call can't be resumed)."""
+        return {
+            "model": request["model"],
+            "max_tokens": request["max_tokens"],
+            "messages": continuation_messages(request["messages"][0]["content"], answer),
+        }
+
+    def _collect_answer(self, event: Any, parts: List[str], parser: Optional[IncrementalJSONParser]) -> None:
+        """Collect the answer text carried by a stream event, feeding it to the parser if there is one."""
+        text = event_output_text(event)
+        if text:
+            parts.append(text)
+            if parser is not None:
+                parser.feed(text)
+
+    def _stream(self, request: Dict[str, Any], parser: Optional[IncrementalJSONParser]) -> tuple:
+        """Stream one request's answer; returns its text and the final message."""
+        parts: List[str] = []
+        with self.client.messages.stream(**request) as stream:
+            for event in stream:
+                self._collect_answer(event, parts, parser)
+            return "".join(parts), stream.get_final_message()
+
+    async def _stream_async(self, request: Dict[str, Any], parser: Optional[IncrementalJSONParser]) -> tuple:
+        """Async version of _stream."""
+        parts: List[str] = []
+        async with self.async_client.messages.stream(**request) as stream:
+            async for event in stream:
+                self._collect_answer(event, parts, parser)
+            return "".join(parts), await stream.get_final_message()
+
+    def _continues(self, stop_reason: Optional[str], max_tokens: int, attempt: int) -> bool:
+        """Whether to continue an answer, i.e. the model stopped at max_tokens and continuations are left."""
+        if stop_reason != "max_tokens" or attempt >= self.output_policy.max_continuations:
+            return False
+        print(
+            f"Answer cut off at {max_tokens} tokens; continuing "
+            f"({attempt + 1}/{self.output_policy.max_continuations})",
+            file=sys.stderr,
+        )
+        return True
+
+    def _normalize_invoice(self, invoice: Dict[str, Any]) -> Dict[str, Any]:
+        """Parse an extracted invoice's numeric fields in place."""
+        invoice["amount"] = self._parse_numeric(str(invoice.get("amount", "")))
+        invoice["tax_amount"] = self._parse_numeric(str(invoice.get("tax_amount", "")))
+        # Don't parse payment terms as numeric - keep as string
+        invoice["payment_term_days"] = str(invoice.get("payment_term_days", ""))
+        if "line_items" in invoice and isinstance(invoice["line_items"], list):
+            invoice["line_items"] = self._parse_line_items(invoice["line_items"])
+        else:
+            invoice["line_items"] = []
+        return invoice
+
+    def _parse_extraction(self, extracted_text: str, usage: Any = None, model: Optional[str] = None) -> Dict[str, Any]:
+        """Decode the model's JSON answer, normalize its numeric fields and attach the call's token usage."""
+        extracted_data = json.loads(extracted_text)
+        extracted_data["usage"] = {**usage_from_response(usage), "model": model or self.model}
+        log_usage("Anthropic", extracted_data["usage"])
+
+        # Parse numeric values in the response
+        if "invoices" in extracted_data:
+            for invoice in extracted_data["invoices"]:
+                self._normalize_invoice(invoice)
+            print(f"Found {len(extracted_data['invoices'])} invoices", file=sys.stderr)
+        else:
+            extracted_data["invoices"] = []
+            print("No invoices found", file=sys.stderr)
+
+        return extracted_data
+
+    def _report_error(self, error: Exception, extracted_text: Optional[str]) -> None:
+        if isinstance(error, CircuitOpenError):
+            print(f"Anthropic unavailable: {error}", file=sys.stderr)
+        elif isinstance(error, anthropic.APIStatusError):
+            print(f"Anthropic API returned an error: {error.status_code} - {error.message}", file=sys.stderr)
+        elif isinstance(error, anthropic.APIConnectionError):
+            print(f"Failed to connect to Anthropic API: {error}", file=sys.stderr)
+        elif isinstance(error, json.JSONDecodeError):
+            print(f"Error decoding JSON from Anthropic response: {error}", file=sys.stderr)
+            print(f"Raw response text: {extracted_text if extracted_text is not None else 'N/A'}", file=sys.stderr)
+        else:
+            print(f"An unexpected error occurred in Anthropic client: {str(error)}", file=sys.stderr)
+
+    def extract_invoice_data(
+        self,
+        image_base64: Union[ImageInput, Iterable[ImageInput]],
+        document_text: Optional[str] = None,
+        events: Optional[ExtractionEvents] = None,
+        selection: Optional[ModelSelection] = None,
+    ) -> Dict[str, Any]:
         """
         Extract invoice data using Anthropic's Claude model from an image or list of images.
 
         Args:
-            image_base64 (Union[str, List[str]]): Base64 encoded image(s) of the invoice(s)
+            image_base64 (Union[ImageInput, Iterable[ImageInput]]): Base64 encoded image(s) of the
+                invoice(s), as bare JPEG strings or ImagePayloads carrying their media type.
+                Any iterable works (list, generator, PageSpool); pages are pulled one at a time.
+            document_text (Optional[str]): Layout text of the document's PDF text layer. When
+                given, the document is read from the text and the images (which may be empty)
+                only support it.
+            events (Optional[ExtractionEvents]): When given, each invoice, and its key fields,
+                is reported as soon as the model has written them.
+            selection (Optional[ModelSelection]): The model tier and output budget chosen
+                for the document's complexity; without one, the standard model is used.
 
         Returns:
             Dict[str, Any]: Extracted invoice data
         """
+        extracted_text = None
         try:
-            # Always convert to list for consistent handling
-            images = [image_base64] if isinstance(image_base64, str) else image_base64
-            print(f"Processing {len(images)} image(s) with Anthropic...", file=sys.stderr)
-
-            # Prepare the message content with all images
-            content = [{"type": "text", "text": INVOICE_EXTRACTION_PROMPT}]
-            for img in images:
-                content.append({
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/jpeg",
-                        "data": img,
-                    },
-                })
-
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=1000,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": content,
-                    }
-                ],
-            )
+            request = self._message_request(self._build_content(image_base64, document_text), document_text, selection)
+            parser = invoice_stream_parser(events, self._normalize_invoice) if events is not None else None
+
+            # The answer is streamed, so a cut-off tool call's JSON so far is
+            # known and can be continued
+            rate_limiter, circuit_breaker = get_rate_limiter(), get_circuit_breaker()
+            answer, usages, attempt = "", [], 0
+            while True:
+                # Every request (continuations too) is refused at once while the
+                # provider's circuit is open, and waits for its shared rate limit
+                # (a throttled stream is only queued again if none of it reached the parser)
+                reserved = message_tokens(request["messages"], request["max_tokens"])
+                started = output_started(parser)
+                text, response = circuit_breaker.call(
+                    "anthropic", lambda: rate_limiter.call("anthropic", reserved, lambda: self._stream(request, parser), started),
+                )
+                answer = trim_answer(answer + text)
+                usages.append(usage_from_response(response.usage))
+                rate_limiter.settle("anthropic", reserved, usages[-1])
+                if not self._continues(response.stop_reason, request["max_tokens"], attempt):
+                    break
+                request = self._continuation_request(request, answer)
+                attempt += 1
 
             # Parse the response
-            extracted_text = response.content[0].text
-            extracted_data = json.loads(extracted_text)
-
-            # Parse numeric values in the response
-            if "invoices" in extracted_data:
-                for invoice in extracted_data["invoices"]:
-                    invoice["amount"] = self._parse_numeric(str(invoice.get("amount", "")))
-                    invoice["tax_amount"] = self._parse_numeric(str(invoice.get("tax_amount", "")))
-                    # Don't parse payment terms as numeric - keep as string
-                    invoice["payment_term_days"] = str(invoice.get("payment_term_days", ""))
-                    if "line_items" in invoice and isinstance(invoice["line_items"], list):
-                        invoice["line_items"] = self._parse_line_items(invoice["line_items"])
-                    else:
-                        invoice["line_items"] = []
-                print(f"Found {len(extracted_data['invoices'])} invoices", file=sys.stderr)
-            else:
-                extracted_data["invoices"] = []
-                print("No invoices found", file=sys.stderr)
-
-            return extracted_data
-
-        except anthropic.APIStatusError as e:
-            print(f"Anthropic API returned an error: {e.status_code} - {e.message}", file=sys.stderr)
-            return None
-        except anthropic.APIConnectionError as e:
-            print(f"Failed to connect to Anthropic API: {e}", file=sys.stderr)
+            extracted_text = answer
+            return self._parse_extraction(extracted_text, combine_usage(usages), request["model"])
+
+        except Exception as e:
+            self._report_error(e, extracted_text)
             return None
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON from Anthropic response: {e}", file=sys.stderr)
-            print(f"Raw response text: {extracted_text if 'extracted_text' in locals() else 'N/A'}", file=sys.stderr)
+
+    async def extract_invoice_data_async(
+        self,
+        image_base64: Union[ImageInput, Iterable[ImageInput]],
+        document_text: Optional[str] = None,
+        events: Optional[ExtractionEvents] = None,
+        selection: Optional[ModelSelection] = None,
+    ) -> Dict[str, Any]:
+        """
+        Async version of extract_invoice_data, which doesn't hold a thread while the model works.
+
+        Many of these can be in flight from one event loop; see
+        concurrency.gather_limited to bound how many.
+        """
+        extracted_text = None
+        try:
+            request = self._message_request(self._build_content(image_base64, document_text), document_text, selection)
+            parser = invoice_stream_parser(events, self._normalize_invoice) if events is not None else None
+
+            rate_limiter, circuit_breaker = get_rate_limiter(), get_circuit_breaker()
+            answer, usages, attempt = "", [], 0
+            while True:
+                reserved = message_tokens(request["messages"], request["max_tokens"])
+                started = output_started(parser)
+                text, response = await circuit_breaker.call_async(
+                    "anthropic", lambda: rate_limiter.call_async("anthropic", reserved, lambda: self._stream_async(request, parser), started),
+                )
+                answer = trim_answer(answer + text)
+                usages.append(usage_from_response(response.usage))
+                rate_limiter.settle("anthropic", reserved, usages[-1])
+                if not self._continues(response.stop_reason, request["max_tokens"], attempt):
+                    break
+                request = self._continuation_request(request, answer)
+                attempt += 1
+
+            # Parse the response
+            extracted_text = answer
+            return self._parse_extraction(extracted_text, combine_usage(usages), request["model"])
+
+        except Exception as e:
+            self._report_error(e, extracted_text)
             return None
+
+    def classify_document(
+        self,
+        image: Optional[ImageInput] = None,
+        document_text: Optional[str] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Classify a document from its first page with the small classification model.
+
+        Args:
+            image: A low-resolution image of the first page
+            document_text: The first page's text, when the PDF has a text layer
+
+        Returns:
+            The document_type, the model's confidence in it and the call's usage,
+            or None if the call failed
+        """
+        try:
+            request = {
+                "model": self.classification_model,
+                "max_tokens": CLASSIFICATION_MAX_TOKENS,
+                "tools": [CLASSIFICATION_TOOL],
+                "tool_choice": CLASSIFICATION_TOOL_CHOICE,
+                "messages": [{"role": "user", "content": classification_content(image, document_text)}],
+            }
+            rate_limiter, circuit_breaker = get_rate_limiter(), get_circuit_breaker()
+            reserved = message_tokens(request["messages"], request["max_tokens"])
+            response = circuit_breaker.call(
+                "anthropic", lambda: rate_limiter.call("anthropic", reserved, lambda: self.client.messages.create(**request)),
+            )
+            usage = {**usage_from_response(response.usage), "model": self.classification_model}
+            rate_limiter.settle("anthropic", reserved, usage)
+            return classification_result(tool_input(response.content, CLASSIFICATION_TOOL_NAME), usage)
+
         except Exception as e:
-            print(f"An unexpected error occurred in Anthropic client: {str(e)}", file=sys.stderr)
-            return None 
\ No newline at end of file
+            self._report_error(e, None)
+            return None
@@ -1,25 +1,94 @@
+import asyncio
 import base64
 import json
+import anthropic
 import boto3
+from botocore.config import Config
 import os
 import sys
-from typing import Dict, Any, Union, List, Optional
+import tempfile
+import threading
+import weakref
+from typing import Dict, Any, Union, List, Optional, Iterable, Iterator, BinaryIO, Callable
 from decimal import Decimal
-from .prompts import INVOICE_EXTRACTION_PROMPT
+from .prompts import INVOICE_EXTRACTION_PROMPT, INVOICE_TEXT_EXTRACTION_PROMPT
+from .image_encoding import ImageInput, ImagePayload, image_content_blocks
+from .cascade import classification_content, classification_result
+from .circuit_breaker import get_circuit_breaker
+from .prompt_cache import cached_text_block, combine_usage, log_usage, usage_from_response
+from .json_stream import ExtractionEvents, IncrementalJSONParser, invoice_stream_parser, output_started
+from .model_selection import FAST, STANDARD, ModelSelection
+from .rate_limit import estimate_tokens, get_rate_limiter, message_tokens
+from .structured_output import (
+    CLASSIFICATION_MAX_TOKENS, CLASSIFICATION_TOOL, CLASSIFICATION_TOOL_CHOICE, CLASSIFICATION_TOOL_NAME,
+    EXTRACTION_TOOL, EXTRACTION_TOOL_CHOICE, OutputPolicy, assistant_prefill, continuation_messages, event_output_text,
+    output_budget, tool_input, trim_answer,
+)
 from dotenv import load_dotenv
 
 # Set AWS region in environment variable
 os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
 
+# Request bodies larger than this are spooled to disk instead of held in memory
+REQUEST_BODY_SPOOL_BYTES = 8 * 1024 * 1024
+
+ANTHROPIC_VERSION = "bedrock-2023-05-31"
+
 
 class BedrockClient:
-    def __init__(self):
+    def __init__(
+        self,
+        config: Optional[Config] = None,
+        async_http_client_factory: Optional[Callable[[], Any]] = None,
+        prompt_caching: bool = False,
+        output_policy: Optional[OutputPolicy] = None,
+        **async_client_options,
+    ):
+        """
+        Args:
+            config: botocore connection pool, timeout and retry settings; see
+                client_registry for the shared, pooled instance
+            async_http_client_factory: Builds the HTTP client for the async SDK
+                client; called once per event loop, since async connections
+                can't be shared between loops
+            prompt_caching: Mark the extraction prompt as a cacheable prefix;
+                off by default, since Bedrock rejects cache_control for models
+                without prompt caching
+            output_policy: Sizing of each extraction's output budget, and how
+                often an answer cut off at it is continued
+            **async_client_options: Passed on to anthropic.AsyncAnthropicBedrock
+                (e.g. timeout, max_retries)
+        """
         # Create session with explicit region
         session = boto3.Session(region_name="us-east-1")
-        self.client = session.client("bedrock-runtime")
+        self.client = session.client("bedrock-runtime", config=config)
         self.model_id = (
             "anthropic.claude-3-5-sonnet-20240620-v1:0"  # Using Claude 3.5 Sonnet
         )
+        # Small, fast model for classifying documents before extraction
+        self.classification_model_id = "anthropic.claude-3-haiku-20240307-v1:0"
+        # Models of the extraction tiers chosen by model_selection
+        self.tier_model_ids = {FAST: "anthropic.claude-3-haiku-20240307-v1:0", STANDARD: self.model_id}
+        self.prompt_caching = prompt_caching
+        self.output_policy = output_policy or OutputPolicy()
+        self._async_client_options = async_client_options
+        self._async_http_client_factory = async_http_client_factory
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, anthropic.AsyncAnthropicBedrock]" = weakref.WeakKeyDictionary()
+        self._async_clients_lock = threading.Lock()
+
+    @property
+    def async_client(self) -> anthropic.AsyncAnthropicBedrock:
+        """The async Bedrock client (Anthropic SDK, boto3 credentials) for the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._async_clients_lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                options = dict(self._async_client_options)
+                if self._async_http_client_factory is not None:
+                    options['http_client'] = self._async_http_client_factory()
+                client = anthropic.AsyncAnthropicBedrock(aws_region="us-east-1", **options)
+                self._async_clients[loop] = client
+            return client
 
     def _parse_numeric(self, value: str) -> Optional[float]:
         """Parse numeric values from strings, handling various formats."""
@@ -43,74 +112,347 @@ class BedrockClient:
             parsed_items.append(parsed_item)
         return parsed_items
 
-    def extract_invoice_data(self, image_base64: Union[str, List[str]]) -> Dict[str, Any]:
+    def _write_request_body(
+        self,
+        body_file: BinaryIO,
+        images: Iterable[ImageInput],
+        document_text: Optional[str] = None,
+        max_tokens: Optional[int] = None,
+    ) -> tuple:
+        """
+        Serialize the extraction request body into a file, one page at a time.
+
+        The output budget (unless given) depends on the page count, so it is written last.
+
+        Returns:
+            tuple: Number of images written, the output budget, and the (start,
+                end) offsets of the user message, which a continuation reuses
+        """
+        image_count = 0
+
+        def counted(images: Iterable[ImageInput]) -> Iterator[ImageInput]:
+            nonlocal image_count
+            for img in images:
+                image_count += 1
+                yield img
+
+        body_file.write(
+            f'{{"anthropic_version": "{ANTHROPIC_VERSION}", '
+            f'"tools": {json.dumps([EXTRACTION_TOOL])}, "tool_choice": {json.dumps(EXTRACTION_TOOL_CHOICE)}, '
+            f'"messages": ['.encode("utf-8")
+        )
+        message_start = body_file.tell()
+        body_file.write(b'{"role": "user", "content": [')
+        for index, block in enumerate(self._iter_content_blocks(counted(images), document_text)):
+            if index:
+                body_file.write(b", ")
+            body_file.write(json.dumps(block).encode("utf-8"))
+        body_file.write(b"]}")
+        message_end = body_file.tell()
+        if max_tokens is None:
+            max_tokens = output_budget(image_count, document_text, self.output_policy)
+        body_file.write(f'], "max_tokens": {max_tokens}}}'.encode("utf-8"))
+        body_file.seek(0)
+        return image_count, max_tokens, (message_start, message_end)
+
+    def _write_continuation_body(
+        self,
+        body_file: BinaryIO,
+        request_file: BinaryIO,
+        message_span: tuple,
+        answer: str,
+        max_tokens: int,
+    ) -> None:
+        """
+        Serialize a request continuing a cut-off answer as text (an unfinished
+        tool call can't be resumed), copying the user message from the original
+        request body rather than rebuilding it.
+        """
+        body_file.write(f'{{"anthropic_version": "{ANTHROPIC_VERSION}", "max_tokens": {max_tokens}, "messages": ['.encode("utf-8"))
+        start, end = message_span
+        request_file.seek(start)
+        remaining = end - start
+        while remaining:
+            chunk = request_file.read(min(remaining, 1024 * 1024))
+            body_file.write(chunk)
+            remaining -= len(chunk)
+        body_file.write(b", " + json.dumps(assistant_prefill(answer)).encode("utf-8") + b"]}")
+        body_file.seek(0)
+
+    def _iter_content_blocks(self, images: Iterable[ImageInput], document_text: Optional[str] = None) -> Iterator[dict]:
+        """Yield the message content: the (cacheable) prompt, the text layer if given, then every image."""
+        if document_text is not None:
+            yield cached_text_block(INVOICE_TEXT_EXTRACTION_PROMPT, self.prompt_caching)
+            yield {"type": "text", "text": document_text}
+        else:
+            yield cached_text_block(INVOICE_EXTRACTION_PROMPT, self.prompt_caching)
+        for img in images:
+            yield from image_content_blocks(img)
+
+    def _normalize_invoice(self, invoice: Dict[str, Any]) -> Dict[str, Any]:
+        """Parse an extracted invoice's numeric fields in place."""
+        # Parse main invoice amounts
+        invoice["amount"] = self._parse_numeric(str(invoice.get("amount", "")))
+        invoice["tax_amount"] = self._parse_numeric(str(invoice.get("tax_amount", "")))
+        # Don't parse payment terms as numeric - keep as string
+        invoice["payment_term_days"] = str(invoice.get("payment_term_days", ""))
+
+        # Parse line items
+        if "line_items" in invoice:
+            invoice["line_items"] = self._parse_line_items(invoice["line_items"])
+        return invoice
+
+    def _read_response_stream(self, response: Dict[str, Any], parser: Optional[IncrementalJSONParser]) -> tuple:
+        """
+        Read an invoke_model_with_response_stream answer as it arrives, feeding it
+        to the parser if there is one.
+
+        Returns:
+            tuple: The answer text (tool input JSON, or text in a continuation),
+                the stop reason and the call's usage
+        """
+        parts = []
+        usage: Dict[str, Any] = {}
+        stop_reason = None
+        for event in response["body"]:
+            chunk = event.get("chunk")
+            if not chunk:
+                continue
+            message_event = json.loads(chunk["bytes"])
+            text = event_output_text(message_event)
+            if text:
+                parts.append(text)
+                if parser is not None:
+                    parser.feed(text)
+            elif message_event["type"] == "message_start":
+                usage.update(message_event["message"].get("usage") or {})
+            elif message_event["type"] == "message_delta":
+                usage.update(message_event.get("usage") or {})
+                stop_reason = message_event.get("delta", {}).get("stop_reason")
+        return "".join(parts), stop_reason, usage
+
+    def _invoke_stream(self, request_file: BinaryIO, parser: Optional[IncrementalJSONParser], model_id: str) -> tuple:
+        """Send a request body (from its start, so a queued retry resends it whole) and read its streamed answer."""
+        request_file.seek(0)
+        response = self.client.invoke_model_with_response_stream(
+            modelId=model_id,
+            body=request_file,
+        )
+        return self._read_response_stream(response, parser)
+
+    async def _stream_async(self, request: Dict[str, Any], parser: Optional[IncrementalJSONParser]) -> tuple:
+        """Stream one request's answer with the async client; returns its text and the final message."""
+        parts = []
+        async with self.async_client.messages.stream(**request) as stream:
+            async for event in stream:
+                text = event_output_text(event)
+                if text:
+                    parts.append(text)
+                    if parser is not None:
+                        parser.feed(text)
+            return "".join(parts), await stream.get_final_message()
+
+    def _continues(self, stop_reason: Optional[str], max_tokens: int, attempt: int) -> bool:
+        """Whether to continue an answer, i.e. the model stopped at max_tokens and continuations are left."""
+        if stop_reason != "max_tokens" or attempt >= self.output_policy.max_continuations:
+            return False
+        print(
+            f"Answer cut off at {max_tokens} tokens; continuing "
+            f"({attempt + 1}/{self.output_policy.max_continuations})",
+            file=sys.stderr,
+        )
+        return True
+
+    def _parse_extraction(self, extracted_text: str, usage: Any = None, model_id: Optional[str] = None) -> Dict[str, Any]:
+        """Decode the model's JSON answer, normalize its numeric fields and attach the call's token usage."""
+        extracted_data = json.loads(extracted_text)
+        extracted_data["usage"] = {**usage_from_response(usage), "model": model_id or self.model_id}
+        log_usage("AWS Bedrock", extracted_data["usage"])
+
+        # Parse numeric values in the response
+        if extracted_data.get("invoices"):
+            for invoice in extracted_data["invoices"]:
+                print(f"Raw payment terms from LLM: {invoice.get('payment_term_days', '')}", file=sys.stderr)
+                self._normalize_invoice(invoice)
+            print(f"Found {len(extracted_data['invoices'])} invoices", file=sys.stderr)
+        else:
+            print("No invoices found", file=sys.stderr)
+
+        return extracted_data
+
+    def extract_invoice_data(
+        self,
+        image_base64: Union[ImageInput, Iterable[ImageInput]],
+        document_text: Optional[str] = None,
+        events: Optional[ExtractionEvents] = None,
+        selection: Optional[ModelSelection] = None,
+    ) -> Dict[str, Any]:
         """
         Extract invoice data using AWS Bedrock's Claude model from an image or list of images.
 
         Args:
-            image_base64 (Union[str, List[str]]): Base64 encoded image(s) of the invoice(s)
+            image_base64 (Union[ImageInput, Iterable[ImageInput]]): Base64 encoded image(s) of the
+                invoice(s), as bare JPEG strings or ImagePayloads carrying their media type.
+                Any iterable works (list, generator, PageSpool); pages are pulled one at a time.
+            document_text (Optional[str]): Layout text of the document's PDF text layer. When
+                given, the document is read from the text and the images (which may be empty)
+                only support it.
+            events (Optional[ExtractionEvents]): When given, each invoice, and its key fields,
+                is reported as soon as the model has written them.
+            selection (Optional[ModelSelection]): The model tier and output budget chosen
+                for the document's complexity; without one, the standard model is used.
 
         Returns:
             Dict[str, Any]: Extracted invoice data
         """
         try:
-            # Always convert to list for consistent handling
-            images = [image_base64] if isinstance(image_base64, str) else image_base64
-            print(f"Processing {len(images)} image(s) with AWS Bedrock...", file=sys.stderr)
+            # Always convert to an iterable for consistent handling
+            images = [image_base64] if isinstance(image_base64, (str, ImagePayload)) else image_base64
+            model_id = self.tier_model_ids[selection.tier] if selection is not None else self.model_id
 
-            # Prepare the message content with all images
-            content = [{"type": "text", "text": INVOICE_EXTRACTION_PROMPT}]
-            for img in images:
-                content.append({
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/jpeg",
-                        "data": img,
-                    },
-                })
-
-            response = self.client.invoke_model(
-                modelId=self.model_id,
-                body=json.dumps(
-                    {
-                        "anthropic_version": "bedrock-2023-05-31",
-                        "max_tokens": 1000,
-                        "messages": [
-                            {
-                                "role": "user",
-                                "content": content,
-                            }
-                        ],
-                    }
-                ),
-            )
+            # Stream the request body through a spooled file so large documents
+            # never need the full JSON payload in memory
+            with tempfile.SpooledTemporaryFile(max_size=REQUEST_BODY_SPOOL_BYTES) as body_file:
+                image_count, max_tokens, message_span = self._write_request_body(
+                    body_file, images, document_text=document_text,
+                    max_tokens=selection.max_tokens if selection is not None else None,
+                )
+                if document_text is not None:
+                    print(f"Processing {len(document_text)} characters of text and {image_count} image(s) with AWS Bedrock...", file=sys.stderr)
+                else:
+                    print(f"Processing {image_count} image(s) with AWS Bedrock...", file=sys.stderr)
+
+                # The answer is streamed, so a cut-off tool call's JSON so far
+                # is known and can be continued
+                parser = invoice_stream_parser(events, self._normalize_invoice) if events is not None else None
+                prompt = INVOICE_TEXT_EXTRACTION_PROMPT if document_text is not None else INVOICE_EXTRACTION_PROMPT
+                text_chars = len(prompt) + len(document_text or "")
+                rate_limiter, circuit_breaker = get_rate_limiter(), get_circuit_breaker()
+                answer, usages, attempt = "", [], 0
+                request_file = body_file
+                while True:
+                    # Every request (continuations too) is refused at once while the
+                    # provider's circuit is open, and waits for its shared rate limit
+                    # (a throttled stream is only queued again if none of it reached the parser)
+                    reserved = estimate_tokens(text_chars + len(answer), image_count, max_tokens)
+                    started = output_started(parser)
+                    text, stop_reason, usage = circuit_breaker.call(
+                        "bedrock", lambda: rate_limiter.call("bedrock", reserved, lambda: self._invoke_stream(request_file, parser, model_id), started),
+                    )
+                    answer = trim_answer(answer + text)
+                    usages.append(usage_from_response(usage))
+                    rate_limiter.settle("bedrock", reserved, usages[-1])
+                    if request_file is not body_file:
+                        request_file.close()
+                    if not self._continues(stop_reason, max_tokens, attempt):
+                        break
+                    request_file = tempfile.SpooledTemporaryFile(max_size=REQUEST_BODY_SPOOL_BYTES)
+                    self._write_continuation_body(request_file, body_file, message_span, answer, max_tokens)
+                    attempt += 1
 
             # Parse the response
-            response_body = json.loads(response["body"].read())
-            extracted_text = response_body["content"][0]["text"]
-
-            # Parse the JSON response
-            extracted_data = json.loads(extracted_text)
-
-            # Parse numeric values in the response
-            if extracted_data.get("invoices"):
-                for invoice in extracted_data["invoices"]:
-                    print(f"Raw payment terms from LLM: {invoice.get('payment_term_days', '')}", file=sys.stderr)
-                    # Parse main invoice amounts
-                    invoice["amount"] = self._parse_numeric(str(invoice.get("amount", "")))
-                    invoice["tax_amount"] = self._parse_numeric(str(invoice.get("tax_amount", "")))
-                    # Don't parse payment terms as numeric - keep as string
-                    invoice["payment_term_days"] = str(invoice.get("payment_term_days", ""))
-
-                    # Parse line items
-                    if "line_items" in invoice:
-                        invoice["line_items"] = self._parse_line_items(invoice["line_items"])
-                print(f"Found {len(extracted_data['invoices'])} invoices", file=sys.stderr)
+            return self._parse_extraction(answer, combine_usage(usages), model_id)
+
+        except Exception as e:
+            print(f"Error calling Bedrock: {str(e)}", file=sys.stderr)
+            return None
+
+    async def extract_invoice_data_async(
+        self,
+        image_base64: Union[ImageInput, Iterable[ImageInput]],
+        document_text: Optional[str] = None,
+        events: Optional[ExtractionEvents] = None,
+        selection: Optional[ModelSelection] = None,
+    ) -> Dict[str, Any]:
+        """
+        Async version of extract_invoice_data, which doesn't hold a thread while the model works.
+
+        The request is built in memory rather than spooled to disk. Many of these
+        can be in flight from one event loop; see concurrency.gather_limited to
+        bound how many.
+        """
+        try:
+            images = [image_base64] if isinstance(image_base64, (str, ImagePayload)) else image_base64
+            content = list(self._iter_content_blocks(images, document_text))
+            image_count = sum(1 for block in content if block["type"] == "image")
+            if document_text is not None:
+                print(f"Processing {len(document_text)} characters of text and {image_count} image(s) with AWS Bedrock...", file=sys.stderr)
             else:
-                print("No invoices found", file=sys.stderr)
+                print(f"Processing {image_count} image(s) with AWS Bedrock...", file=sys.stderr)
+
+            if selection is not None:
+                model_id, max_tokens = self.tier_model_ids[selection.tier], selection.max_tokens
+            else:
+                model_id, max_tokens = self.model_id, output_budget(image_count, document_text, self.output_policy)
+            request = {
+                "model": model_id,
+                "max_tokens": max_tokens,
+                "tools": [EXTRACTION_TOOL],
+                "tool_choice": EXTRACTION_TOOL_CHOICE,
+                "messages": [{"role": "user", "content": content}],
+            }
+            parser = invoice_stream_parser(events, self._normalize_invoice) if events is not None else None
+            rate_limiter, circuit_breaker = get_rate_limiter(), get_circuit_breaker()
+            answer, usages, attempt = "", [], 0
+            while True:
+                reserved = message_tokens(request["messages"], request["max_tokens"])
+                started = output_started(parser)
+                text, response = await circuit_breaker.call_async(
+                    "bedrock", lambda: rate_limiter.call_async("bedrock", reserved, lambda: self._stream_async(request, parser), started),
+                )
+                answer = trim_answer(answer + text)
+                usages.append(usage_from_response(response.usage))
+                rate_limiter.settle("bedrock", reserved, usages[-1])
+                if not self._continues(response.stop_reason, request["max_tokens"], attempt):
+                    break
+                request = {
+                    "model": model_id,
+                    "max_tokens": request["max_tokens"],
+                    "messages": continuation_messages(content, answer),
+                }
+                attempt += 1
+            return self._parse_extraction(answer, combine_usage(usages), model_id)
+
+        except Exception as e:
+            print(f"Error calling Bedrock: {str(e)}", file=sys.stderr)
+            return None
+
+    def classify_document(
+        self,
+        image: Optional[ImageInput] = None,
+        document_text: Optional[str] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Classify a document from its first page with the small classification model.
+
+        Args:
+            image: A low-resolution image of the first page
+            document_text: The first page's text, when the PDF has a text layer
+
+        Returns:
+            The document_type, the model's confidence in it and the call's usage,
+            or None if the call failed
+        """
+        try:
+            messages = [{"role": "user", "content": classification_content(image, document_text)}]
+            body = json.dumps({
+                "anthropic_version": ANTHROPIC_VERSION,
+                "max_tokens": CLASSIFICATION_MAX_TOKENS,
+                "tools": [CLASSIFICATION_TOOL],
+                "tool_choice": CLASSIFICATION_TOOL_CHOICE,
+                "messages": messages,
+            })
+            rate_limiter, circuit_breaker = get_rate_limiter(), get_circuit_breaker()
+            reserved = message_tokens(messages, CLASSIFICATION_MAX_TOKENS)
+
+            def invoke() -> Dict[str, Any]:
+                response = self.client.invoke_model(modelId=self.classification_model_id, body=body)
+                return json.loads(response["body"].read())
 
-            return extracted_data
+            answer = circuit_breaker.call("bedrock", lambda: rate_limiter.call("bedrock", reserved, invoke))
+            usage = {**usage_from_response(answer.get("usage")), "model": self.classification_model_id}
+            rate_limiter.settle("bedrock", reserved, usage)
+            return classification_result(tool_input(answer.get("content"), CLASSIFICATION_TOOL_NAME), usage)
 
         except Exception as e:
             print(f"Error calling Bedrock: {str(e)}", file=sys.stderr)
@@ -0,0 +1,132 @@
+"""
+Classification Cascade
+
+This module puts a cheap first stage in front of the full extraction: a
+statement, remittance advice or anything else that isn't an invoice, credit
+note or reminder is recognised from its first page and never sent to the
+large extraction model, which would only return an empty invoice list for it.
+
+The cascade:
+1. Reads the document type off the first page's title when its text says it
+   plainly (a local heuristic, free and instant); only an invoice, credit note
+   or reminder title is taken as is, since a wrongly skipped invoice is lost
+   while a wrongly extracted statement only costs a call
+2. Otherwise, or to confirm a title of another type, asks a small, fast model, with a low-resolution image of the
+   first page (or its text, when the PDF has a text layer) and a forced
+   classification tool call
+3. Runs the full extraction only for invoices, credit notes and reminders,
+   or when the classifier isn't confident enough to skip it
+"""
+
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+import fitz
+
+from .image_encoding import ImageInput, image_content_blocks
+from .prompts import DOCUMENT_CLASSIFICATION_PROMPT
+from .structured_output import DOCUMENT_TYPES
+
+# Document types whose invoices are extracted
+EXTRACTABLE_TYPES = ('invoice', 'credit_note', 'reminder')
+
+# Lines at the top of the first page (in reading order) searched for the document's title
+TITLE_LINES = 12
+
+# Longest line, in words, that can be a title rather than a sentence or a field
+TITLE_MAX_WORDS = 6
+
+# Title patterns, in order of precedence, and the type they name
+_TITLE_PATTERNS = (
+    ('remittance_advice', re.compile(r'\b(remittance|payment) advice\b', re.IGNORECASE)),
+    ('statement', re.compile(r'\b(statement of account|account statement|customer statement)\b', re.IGNORECASE)),
+    ('purchase_order', re.compile(r'^\W*purchase order\b', re.IGNORECASE | re.MULTILINE)),
+    ('credit_note', re.compile(r'\bcredit (note|memo)\b', re.IGNORECASE)),
+    ('reminder', re.compile(r'\b(reminder|overdue|past due|aged (creditors|debtors))\b', re.IGNORECASE)),
+    ('invoice', re.compile(r'\binvoice\b', re.IGNORECASE)),
+)
+
+
+@dataclass(frozen=True)
+class CascadePolicy:
+    """
+    How documents are classified before extraction.
+
+    Attributes:
+        use_heuristic: Take the type from the first page's title when it names
+            an invoice, credit note or reminder
+        image_long_edge: Long edge, in pixels, of the first page image sent to
+            the classification model
+        max_text_chars: Most characters of the first page's text sent to it
+        min_confidence: Confidence the classifier needs to skip the extraction
+            of a document that isn't an invoice, credit note or reminder
+    """
+    use_heuristic: bool = True
+    image_long_edge: int = 768
+    max_text_chars: int = 3000
+    min_confidence: float = 0.8
+
+
+def _is_title(line: str) -> bool:
+    """Whether a line reads like a title: short, and not a "label: value" field such as "Purchase Order: 4500012"."""
+    label, colon, value = line.partition(':')
+    return not (colon and value.strip()) and len(label.split()) <= TITLE_MAX_WORDS
+
+
+def classify_from_text(first_page_text: Optional[str]) -> Optional[str]:
+    """
+    The document type named by the first page's title, or None if it doesn't name exactly one.
+
+    Only title-like lines among the first TITLE_LINES count. A title naming
+    both a non-invoice type and an invoice (e.g. "Statement of invoices") is
+    left to the model.
+    """
+    if not first_page_text:
+        return None
+    lines = [line.strip() for line in first_page_text.splitlines() if line.strip()]
+    title = "\n".join(line for line in lines[:TITLE_LINES] if _is_title(line))
+    named = [document_type for document_type, pattern in _TITLE_PATTERNS if pattern.search(title)]
+    if len(named) == 1 or (len(named) == 2 and named[1] == 'invoice' and named[0] in EXTRACTABLE_TYPES):
+        return named[0]
+    return None
+
+
+def should_extract(classification: Optional[dict], policy: Optional[CascadePolicy] = None) -> bool:
+    """Whether a classified document goes on to the full extraction (it does if it couldn't be classified)."""
+    policy = policy or CascadePolicy()
+    if not classification:
+        return True
+    return classification['document_type'] in EXTRACTABLE_TYPES or classification['confidence'] < policy.min_confidence
+
+
+def classification_content(image: Optional[ImageInput] = None, document_text: Optional[str] = None) -> list:
+    """The message content of a classification request: the prompt, then the first page's text and/or image."""
+    content = [{"type": "text", "text": DOCUMENT_CLASSIFICATION_PROMPT}]
+    if document_text:
+        content.append({"type": "text", "text": document_text})
+    if image is not None:
+        content.extend(image_content_blocks(image))
+    return content
+
+
+def classification_result(answer: Optional[dict], usage: dict) -> Optional[dict]:
+    """A classifier's answer (its tool input) as a classification, or None if it isn't one."""
+    if not answer or answer.get('document_type') not in DOCUMENT_TYPES:
+        return None
+    try:
+        confidence = min(1.0, max(0.0, float(answer.get('confidence'))))
+    except (TypeError, ValueError):
+        confidence = 0.0
+    return {'document_type': answer['document_type'], 'confidence': confidence, 'usage': usage}
+
+
+def first_page_text(pdf_bytes: bytes) -> Optional[str]:
+    """The text of a PDF's first page, or None if it has none (e.g. a scan)."""
+    try:
+        with fitz.Document(stream=pdf_bytes, filetype="pdf") as doc:
+            # Reading order, so the first lines are the top of the page
+            text = doc[0].get_text(sort=True) if len(doc) else ""
+    except Exception:
+        return None
+    return text if text.strip() else None
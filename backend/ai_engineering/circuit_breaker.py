@@ -0,0 +1,291 @@
+"""
+LLM Circuit Breaker
+
+This module stops calls to an LLM provider that is failing (timing out,
+refusing connections, answering with 5xx errors), so uploads fail over to the
+other provider, or fail at once, instead of each waiting out the full timeout.
+
+Each provider's breaker:
+1. Is closed while the provider works; every call goes through, and failures
+   in a row (within failure_window_seconds of each other) are counted
+2. Opens after failure_threshold such failures: calls are refused at once
+   with CircuitOpenError, which the clients report like any other failure,
+   and the router ranks the provider last so work goes to the other one
+3. Turns half-open once open_seconds have passed: one probe call is let
+   through (the others are still refused); its success closes the breaker,
+   its failure opens it again for another open_seconds
+
+Only errors saying the provider is unwell count as failures; a rejected
+request, a 429 (see rate_limit) or an answer that doesn't parse does not.
+The breakers' state lives in a store all processes share (Redis when
+configured, else a lock-protected file per host), so every worker trips and
+recovers together.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional
+
+import anthropic
+from botocore.exceptions import ConnectionError as BotocoreConnectionError, HTTPClientError
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; the file store only locks within the process there
+    fcntl = None
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Seconds a breaker's state is kept in Redis after its last change
+STATE_TTL_SECONDS = 24 * 3600
+
+# Bedrock error codes of a provider-side failure
+_BEDROCK_FAILURE_CODES = (
+    'InternalServerException', 'ServiceUnavailableException', 'ModelTimeoutException',
+    'ModelNotReadyException', 'internalServerException', 'serviceUnavailableException',
+)
+
+
+class CircuitOpenError(Exception):
+    """A call was refused because its provider's breaker is open."""
+
+
+@dataclass(frozen=True)
+class BreakerPolicy:
+    """
+    When a provider's breaker opens and how it recovers.
+
+    Attributes:
+        enabled: Guard calls with the breakers
+        failure_threshold: Failures in a row that open the breaker
+        failure_window_seconds: A failure this long after the previous one
+            starts the count again
+        open_seconds: How long an open breaker refuses calls before letting a
+            probe through
+        probe_timeout_seconds: How long a probe may take before another call
+            may probe instead (e.g. when the probing process died)
+        redis_url: Redis shared by every host's processes; when empty (or
+            unreachable) the state lives in state_dir
+        state_dir: Directory of the file store, shared by one host's processes
+    """
+    enabled: bool = True
+    failure_threshold: int = 5
+    failure_window_seconds: float = 60.0
+    open_seconds: float = 30.0
+    probe_timeout_seconds: float = 300.0
+    redis_url: str = ""
+    state_dir: str = ""
+
+
+def is_provider_failure(error: Exception) -> bool:
+    """Whether an error says the provider is unwell (rather than the request or its answer being at fault)."""
+    if isinstance(error, (anthropic.APIConnectionError, BotocoreConnectionError, HTTPClientError, TimeoutError)):
+        return True
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code >= 500
+    # botocore ClientError (and EventStreamError, for failures mid-stream)
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        code = response.get("Error", {}).get("Code", "")
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        return code in _BEDROCK_FAILURE_CODES or status >= 500
+    return False
+
+
+class FileStateStore:
+    """Breaker states in JSON files, updated under an exclusive file lock, for the processes of one host."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def update(self, provider: str, change: Callable[[dict, float], Any]) -> Any:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{provider}.json")
+        with self._lock, open(f"{path}.lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(path) as state_file:
+                    state = json.load(state_file)
+            except (OSError, ValueError):
+                state = {}
+            result = change(state, time.time())
+            with open(path, "w") as state_file:
+                json.dump(state, state_file)
+            return result
+
+
+class RedisStateStore:
+    """Breaker states in Redis, updated in optimistic (WATCH) transactions, for every host."""
+
+    def __init__(self, url: str):
+        import redis
+
+        self.client = redis.Redis.from_url(url, socket_timeout=5, socket_connect_timeout=5)
+
+    def update(self, provider: str, change: Callable[[dict, float], Any]) -> Any:
+        key = f"llm-circuit:{provider}"
+        result = None
+
+        def transaction(pipe) -> None:
+            nonlocal result
+            raw = pipe.get(key)
+            state = json.loads(raw) if raw else {}
+            result = change(state, time.time())
+            pipe.multi()
+            pipe.set(key, json.dumps(state), ex=STATE_TTL_SECONDS)
+
+        # Retried from the read if another process changed the state meanwhile
+        self.client.transaction(transaction, key)
+        return result
+
+
+class CircuitBreaker:
+    """Guards calls to each provider with a breaker whose state all processes share."""
+
+    def __init__(self, policy: Optional[BreakerPolicy] = None):
+        self.policy = policy or BreakerPolicy()
+        self._build_stores()
+
+    def _build_stores(self) -> None:
+        self.file_store = FileStateStore(self.policy.state_dir or os.path.join(tempfile.gettempdir(), "llm-circuit"))
+        self.redis_store = None
+        if self.policy.redis_url:
+            try:
+                self.redis_store = RedisStateStore(self.policy.redis_url)
+            except Exception as e:
+                print(f"Circuit breaker store unavailable, sharing state per host: {str(e)}", file=sys.stderr)
+
+    def configure(self, policy: BreakerPolicy) -> None:
+        if policy != self.policy:
+            self.policy = policy
+            self._build_stores()
+
+    def _update(self, provider: str, change: Callable[[dict, float], Any], default: Any) -> Any:
+        """Apply a state change on Redis, or the file store; a broken store never stops calls."""
+        if self.redis_store is not None:
+            try:
+                return self.redis_store.update(provider, change)
+            except Exception as e:
+                print(f"Circuit breaker store error, sharing state per host: {str(e)}", file=sys.stderr)
+        try:
+            return self.file_store.update(provider, change)
+        except Exception as e:
+            print(f"Circuit breaker state unavailable: {str(e)}", file=sys.stderr)
+            return default
+
+    def state(self, provider: str) -> str:
+        """The provider's breaker state; an open breaker past its open_seconds reads as half-open."""
+        def read(state: dict, now: float) -> str:
+            if state.get('state') == OPEN and now >= state.get('opened_at', 0.0) + self.policy.open_seconds:
+                return HALF_OPEN
+            return state.get('state', CLOSED)
+        return self._update(provider, read, CLOSED) if self.policy.enabled else CLOSED
+
+    def is_open(self, provider: str) -> bool:
+        """Whether calls to the provider are being refused right now."""
+        return self.state(provider) == OPEN
+
+    def _allow(self, provider: str) -> bool:
+        """Whether a call may go through, claiming the probe if the breaker is due one."""
+        def allow(state: dict, now: float) -> bool:
+            current = state.get('state', CLOSED)
+            if current == CLOSED:
+                return True
+            if current == OPEN and now < state.get('opened_at', 0.0) + self.policy.open_seconds:
+                return False
+            if current == HALF_OPEN and now < state.get('probe_until', 0.0):
+                return False
+            print(f"{provider} circuit half-open; probing", file=sys.stderr)
+            state.update(state=HALF_OPEN, probe_until=now + self.policy.probe_timeout_seconds)
+            return True
+        return self._update(provider, allow, True)
+
+    def _record(self, provider: str, ok: bool) -> None:
+        def record(state: dict, now: float) -> None:
+            current = state.get('state', CLOSED)
+            if ok:
+                if current != CLOSED:
+                    print(f"{provider} circuit closed", file=sys.stderr)
+                state.clear()
+                state['state'] = CLOSED
+                return
+            recent = now - state.get('failed_at', 0.0) <= self.policy.failure_window_seconds
+            failures = state.get('failures', 0) + 1 if recent else 1
+            state.update(failures=failures, failed_at=now)
+            if current == HALF_OPEN or failures >= self.policy.failure_threshold:
+                print(f"{provider} circuit open after {failures} failure(s); refusing calls for {self.policy.open_seconds:g}s", file=sys.stderr)
+                state.update(state=OPEN, opened_at=now)
+        self._update(provider, record, None)
+
+    def _before(self, provider: str) -> None:
+        if not self._allow(provider):
+            raise CircuitOpenError(f"{provider} circuit open; call refused")
+
+    def _release(self, provider: str) -> None:
+        """Let another call probe, after a probe that ended without telling whether the provider is well."""
+        def release(state: dict, now: float) -> None:
+            if state.get('state') == HALF_OPEN:
+                state['probe_until'] = 0.0
+        self._update(provider, release, None)
+
+    def _after_error(self, provider: str, error: Exception) -> None:
+        if is_provider_failure(error):
+            self._record(provider, False)
+        else:
+            # A rejected request, a 429 or a wait for rate limit capacity
+            self._release(provider)
+
+    def call(self, provider: str, function: Callable[[], Any]) -> Any:
+        """
+        Run function unless the provider's breaker is open, recording how it went.
+
+        Raises:
+            CircuitOpenError: If the breaker is open (or another call is probing)
+            Exception: The call's own error
+        """
+        if not self.policy.enabled:
+            return function()
+        self._before(provider)
+        try:
+            result = function()
+        except Exception as e:
+            self._after_error(provider, e)
+            raise
+        self._record(provider, True)
+        return result
+
+    async def call_async(self, provider: str, function: Callable[[], Awaitable[Any]]) -> Any:
+        """Async version of call, for a function returning an awaitable."""
+        if not self.policy.enabled:
+            return await function()
+        self._before(provider)
+        try:
+            result = await function()
+        except Exception as e:
+            self._after_error(provider, e)
+            raise
+        self._record(provider, True)
+        return result
+
+
+_circuit_breaker = CircuitBreaker()
+
+
+def configure_circuit_breaker(policy: BreakerPolicy) -> None:
+    """Set the thresholds and store of this process's breakers."""
+    _circuit_breaker.configure(policy)
+
+
+def get_circuit_breaker() -> CircuitBreaker:
+    """Return this process's circuit breaker (its state is shared through the store)."""
+    return _circuit_breaker
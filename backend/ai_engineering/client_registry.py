@@ -0,0 +1,167 @@
+"""
+LLM Client Registry
+
+This module keeps one Anthropic and one Bedrock client per process, so every
+extraction and assignment call reuses the same HTTP connection pool instead of
+paying for a new TLS handshake on each upload.
+
+The registry:
+1. Builds each client lazily, on first use, with the configured connection
+   limits, timeouts and retries
+2. Hands the same client to every caller (the SDK clients are thread-safe);
+   each client's async SDK client is built per event loop on first use
+3. Forgets its clients in a forked child (e.g. a gunicorn worker forked from a
+   preloaded master), which builds its own rather than sharing the parent's
+   sockets
+4. Rebuilds the clients when the connection or caching settings change
+"""
+
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import anthropic
+from botocore.config import Config
+
+from .anthropic_client import AnthropicClient
+from .bedrock_client import BedrockClient
+from .structured_output import OutputPolicy
+
+
+@dataclass(frozen=True)
+class ConnectionSettings:
+    """
+    HTTP connection pool, timeout, prompt caching and output settings of the LLM clients.
+
+    Attributes:
+        max_connections: Most connections open to a provider at once
+        max_keepalive_connections: Idle connections kept open for reuse
+        keepalive_expiry: Seconds an idle connection is kept open
+        connect_timeout: Seconds to establish a connection
+        read_timeout: Seconds to wait for a response (extractions of long
+            documents take a while)
+        max_retries: Retries of failed requests (connection errors, 429s and
+            5xx responses) inside the SDK
+        anthropic_prompt_caching: Cache the extraction prompt prefix on the
+            Anthropic API
+        bedrock_prompt_caching: Cache the extraction prompt prefix on Bedrock
+            (only for models that support it there)
+        output_policy: Output budget sizing and continuation of extractions
+    """
+    max_connections: int = 20
+    max_keepalive_connections: int = 10
+    keepalive_expiry: float = 30.0
+    connect_timeout: float = 10.0
+    read_timeout: float = 300.0
+    max_retries: int = 2
+    anthropic_prompt_caching: bool = True
+    bedrock_prompt_caching: bool = False
+    output_policy: OutputPolicy = OutputPolicy()
+
+
+_settings = ConnectionSettings()
+_clients: dict[str, Any] = {}
+_clients_pid = os.getpid()
+_clients_lock = threading.Lock()
+
+
+def _forget_clients() -> None:
+    """Drop this process's clients without closing them (their sockets may belong to a parent)."""
+    global _clients, _clients_pid
+    _clients = {}
+    _clients_pid = os.getpid()
+
+
+def _after_fork_in_child() -> None:
+    global _clients_lock
+    # The parent may have been holding the lock in another thread when it forked
+    _clients_lock = threading.Lock()
+    _forget_clients()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def configure_clients(settings: ConnectionSettings) -> None:
+    """Set the connection settings; clients built with different ones are replaced on next use."""
+    global _settings
+    with _clients_lock:
+        if settings != _settings:
+            _settings = settings
+            _clients.clear()
+
+
+def get_output_policy() -> OutputPolicy:
+    """Return the output budget sizing the shared clients are configured with."""
+    return _settings.output_policy
+
+
+def _get_client(name: str, factory: Callable[[ConnectionSettings], Any]) -> Any:
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _forget_clients()
+        client = _clients.get(name)
+        if client is None:
+            client = factory(_settings)
+            _clients[name] = client
+        return client
+
+
+def _http_limits(settings: ConnectionSettings) -> Any:
+    """Connection pool limits of the SDK's HTTP client, built with the class the SDK itself uses for them."""
+    return type(anthropic.DEFAULT_CONNECTION_LIMITS)(
+        max_connections=settings.max_connections,
+        max_keepalive_connections=settings.max_keepalive_connections,
+        keepalive_expiry=settings.keepalive_expiry,
+    )
+
+
+def _build_anthropic_client(settings: ConnectionSettings) -> AnthropicClient:
+    return AnthropicClient(
+        http_client=anthropic.DefaultHttpxClient(limits=_http_limits(settings)),
+        async_http_client_factory=lambda: anthropic.DefaultAsyncHttpxClient(limits=_http_limits(settings)),
+        prompt_caching=settings.anthropic_prompt_caching,
+        output_policy=settings.output_policy,
+        timeout=anthropic.Timeout(settings.read_timeout, connect=settings.connect_timeout),
+        max_retries=settings.max_retries,
+    )
+
+
+def _build_bedrock_client(settings: ConnectionSettings) -> BedrockClient:
+    return BedrockClient(
+        config=Config(
+            max_pool_connections=settings.max_connections,
+            connect_timeout=settings.connect_timeout,
+            read_timeout=settings.read_timeout,
+            retries={"total_max_attempts": settings.max_retries + 1, "mode": "standard"},
+            tcp_keepalive=True,
+        ),
+        async_http_client_factory=lambda: anthropic.DefaultAsyncHttpxClient(limits=_http_limits(settings)),
+        prompt_caching=settings.bedrock_prompt_caching,
+        output_policy=settings.output_policy,
+        timeout=anthropic.Timeout(settings.read_timeout, connect=settings.connect_timeout),
+        max_retries=settings.max_retries,
+    )
+
+
+def get_anthropic_client() -> AnthropicClient:
+    """
+    Return this process's shared Anthropic client.
+
+    Raises:
+        ValueError: If ANTHROPIC_API_KEY is not set
+    """
+    return _get_client("anthropic", _build_anthropic_client)
+
+
+def get_bedrock_client() -> BedrockClient:
+    """Return this process's shared Bedrock client."""
+    return _get_client("bedrock", _build_bedrock_client)
+
+
+def reset_clients() -> None:
+    """Drop the shared clients, e.g. after rotating credentials; the next call builds new ones."""
+    with _clients_lock:
+        _clients.clear()
@@ -0,0 +1,94 @@
+"""
+Async Concurrency Helpers
+
+This module lets one process keep many LLM requests in flight through the
+clients' async extraction methods, instead of tying up a thread per request
+for the 10-40 seconds each one takes.
+
+The helpers:
+1. gather_limited runs awaitables concurrently, at most limit at a time, and
+   returns their results in input order
+2. run_sync runs a coroutine to completion from synchronous code (the Django
+   request and worker paths), whether or not that thread already has a
+   running event loop. Every call runs on one long-lived event loop per
+   process, so the async SDK clients (built once per loop) and their
+   connection pools are reused across jobs rather than rebuilt and leaked by
+   each call
+"""
+
+import asyncio
+import os
+import threading
+from typing import Awaitable, Coroutine, Iterable, Optional, TypeVar
+
+T = TypeVar("T")
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def _after_fork_in_child() -> None:
+    global _loop, _loop_lock
+    # The parent's loop thread doesn't exist in the child; it starts its own
+    _loop = None
+    _loop_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+async def gather_limited(awaitables: Iterable[Awaitable[T]], limit: int, return_exceptions: bool = False) -> list[T]:
+    """
+    Await every awaitable with at most limit of them running at once.
+
+    Args:
+        awaitables: Coroutines (or other awaitables) to run
+        limit: Most awaitables in flight at a time (values below 1 count as 1)
+        return_exceptions: Return exceptions in place of results instead of
+            raising the first one
+
+    Returns:
+        Results in the same order as the awaitables
+    """
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(awaitable: Awaitable[T]) -> T:
+        async with semaphore:
+            return await awaitable
+
+    return await asyncio.gather(*(run(awaitable) for awaitable in awaitables), return_exceptions=return_exceptions)
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    """This process's long-lived event loop, run by a daemon thread started on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="async-loop", daemon=True).start()
+            _loop = loop
+        return _loop
+
+
+def run_sync(coroutine: Coroutine[object, object, T]) -> T:
+    """
+    Run a coroutine to completion from synchronous code and return its result.
+
+    The coroutine runs on the process's background event loop, which also
+    works inside a running event loop (sync code called from an async view),
+    since that loop is never the one blocked on.
+
+    Raises:
+        RuntimeError: If called from a coroutine already on the background loop,
+            which would wait on itself; await the coroutine there instead
+    """
+    loop = _background_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coroutine.close()
+        raise RuntimeError("run_sync called from the background event loop; await the coroutine instead")
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
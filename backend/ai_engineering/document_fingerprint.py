@@ -0,0 +1,275 @@
+"""
+Document Fingerprinting
+
+This module fingerprints uploaded documents so that an invoice a supplier
+re-sends as a fresh scan or a re-export can be recognised before it is
+extracted again. Byte hashes alone miss these, since every scan and export
+produces a different file.
+
+The fingerprint:
+1. Hashes the file bytes (identical re-uploads) and the normalized text layer
+   (re-exports of a born-digital PDF)
+2. Computes a 64-bit perceptual hash of every page, cropped to its content so
+   scanner margins and offsets don't change it
+3. Splits each hash into four 16-bit bands for a multi-index Hamming search:
+   two hashes within d bits of each other differ by at most d // 4 bits in at
+   least one band, so candidates can be found with indexed equality lookups
+4. Verifies image candidates pixel by pixel after aligning them, because
+   invoices printed on the same template hash almost identically
+"""
+
+import hashlib
+import sys
+from dataclasses import dataclass
+from itertools import combinations
+from typing import Iterator, Optional
+
+import cv2
+import fitz
+import numpy as np
+
+from .image_processor import content_bounds, perceptual_hash
+from .render_sandbox import SandboxPolicy, iter_sandboxed_pages
+
+HASH_BANDS = 4
+BAND_BITS = 16
+
+
+@dataclass
+class FingerprintPolicy:
+    """
+    How documents are fingerprinted and when two of them count as the same.
+
+    Attributes:
+        max_hamming: Largest perceptual hash distance, per page, for a candidate
+        hash_width: Width in pixels pages are rendered at for hashing
+        verify_width: Width in pixels pages are rendered at for verification
+        verify_block_size: Side in pixels of the blocks compared during verification
+        verify_tolerance: Ink may move this many pixels between two scans
+            without counting as a difference
+        max_block_difference: Most ink pixels any block of two aligned pages may
+            disagree on; a changed invoice number, date or amount exceeds it
+        min_text_chars: Documents with less text are treated as scans
+        max_pages: Longer documents are not fingerprinted
+        sandbox: Render PDF pages in sandboxed child processes with these limits
+    """
+    max_hamming: int = 8
+    hash_width: int = 512
+    verify_width: int = 1536
+    verify_block_size: int = 16
+    verify_tolerance: int = 1
+    max_block_difference: int = 30
+    min_text_chars: int = 50
+    max_pages: int = 50
+    sandbox: Optional[SandboxPolicy] = None
+
+
+@dataclass
+class DocumentFingerprint:
+    """Content hashes of one uploaded document."""
+    file_sha256: str
+    text_digest: Optional[str]
+    page_hashes: list[int]
+
+    @property
+    def page_count(self) -> int:
+        return len(self.page_hashes)
+
+
+def hash_bands(phash: int) -> list[int]:
+    """Split a 64-bit hash into its 16-bit bands, most significant first."""
+    mask = (1 << BAND_BITS) - 1
+    return [(phash >> (BAND_BITS * (HASH_BANDS - 1 - band))) & mask for band in range(HASH_BANDS)]
+
+
+def band_neighbourhood(band: int, radius: int) -> list[int]:
+    """All band values within radius bits of a band, including the band itself."""
+    values = [band]
+    for distance in range(1, radius + 1):
+        for bits in combinations(range(BAND_BITS), distance):
+            values.append(band ^ sum(1 << bit for bit in bits))
+    return values
+
+
+def band_radius(max_hamming: int) -> int:
+    """Per-band search radius that guarantees finding every hash within max_hamming bits."""
+    return max_hamming // HASH_BANDS
+
+
+def _normalize_page(gray: np.ndarray, width: int) -> np.ndarray:
+    """Crop a grayscale page to its content and scale it to a fixed width."""
+    bounds = content_bounds(gray)
+    if bounds is not None:
+        top, bottom, left, right = bounds
+        gray = gray[top:bottom, left:right]
+    height = max(1, round(gray.shape[0] * width / gray.shape[1]))
+    interpolation = cv2.INTER_AREA if gray.shape[1] > width else cv2.INTER_CUBIC
+    return cv2.resize(gray, (width, height), interpolation=interpolation)
+
+
+def _render_gray_page(page: fitz.Page, width: int) -> np.ndarray:
+    # Render with some headroom so the content crop still spans the target width
+    zoom = 1.25 * width / max(page.rect.width, 1.0)
+    pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    return np.frombuffer(pixmap.samples, np.uint8).reshape(pixmap.height, pixmap.stride)[:, :pixmap.width]
+
+
+def iter_document_pages(
+    file_bytes: bytes,
+    file_type: str,
+    width: int,
+    max_pages: Optional[int] = None,
+    sandbox: Optional[SandboxPolicy] = None,
+) -> Iterator[np.ndarray]:
+    """
+    Yield the pages of a PDF or image upload as content-cropped grayscale arrays of the given width.
+
+    Raises:
+        ValueError: If the document can't be read, has more than max_pages
+            pages, or a sandboxed page fails to render
+    """
+    if file_type != 'pdf':
+        image = cv2.imdecode(np.frombuffer(file_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise ValueError("could not decode image")
+        yield _normalize_page(image, width)
+        return
+
+    with fitz.Document(stream=file_bytes, filetype="pdf") as doc:
+        if max_pages is not None and doc.page_count > max_pages:
+            raise ValueError(f"{doc.page_count} pages exceeds the limit of {max_pages}")
+        if sandbox is None:
+            for page in doc:
+                yield _normalize_page(_render_gray_page(page, width), width)
+            return
+        page_count = doc.page_count
+
+    for page_number, gray, failure in iter_sandboxed_pages(file_bytes, range(page_count), _render_gray_page, (width,), sandbox):
+        if failure is not None:
+            raise ValueError(f"page {page_number + 1} could not be rendered: {failure.detail or failure.reason}")
+        yield _normalize_page(gray, width)
+
+
+def document_text_digest(file_bytes: bytes, file_type: str, min_chars: int) -> Optional[str]:
+    """Hash of a PDF's whitespace-normalized text, or None if it has too little text to rely on."""
+    if file_type != 'pdf':
+        return None
+    with fitz.Document(stream=file_bytes, filetype="pdf") as doc:
+        text = "\f".join(" ".join(page.get_text().split()) for page in doc)
+    if len(text.replace("\f", "").replace(" ", "")) < min_chars:
+        return None
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def compute_document_fingerprint(
+    file_bytes: bytes,
+    file_type: str,
+    policy: Optional[FingerprintPolicy] = None,
+) -> Optional[DocumentFingerprint]:
+    """
+    Fingerprint an uploaded PDF or image.
+
+    Returns:
+        The fingerprint, or None if the document can't be fingerprinted
+    """
+    policy = policy or FingerprintPolicy()
+    try:
+        page_hashes = [
+            perceptual_hash(page)
+            for page in iter_document_pages(file_bytes, file_type, policy.hash_width, policy.max_pages, policy.sandbox)
+        ]
+        text_digest = document_text_digest(file_bytes, file_type, policy.min_text_chars)
+    except Exception as e:
+        print(f"Could not fingerprint document: {str(e)}", file=sys.stderr)
+        return None
+
+    if not page_hashes:
+        return None
+    return DocumentFingerprint(
+        file_sha256=hashlib.sha256(file_bytes).hexdigest(),
+        text_digest=text_digest,
+        page_hashes=page_hashes,
+    )
+
+
+def _ink_mask(page: np.ndarray) -> np.ndarray:
+    page = cv2.GaussianBlur(page, (0, 0), 0.7)
+    _, mask = cv2.threshold(page, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    return mask
+
+
+def page_difference(page_a: np.ndarray, page_b: np.ndarray, block_size: int, tolerance: int) -> int:
+    """
+    Largest number of ink pixels two pages disagree on within any block.
+
+    Page B is aligned onto page A with an affine transform first, which absorbs
+    the rotation, offset and scale of a re-scan. Ink pixels with no ink within
+    tolerance pixels on the other page count as disagreement, after isolated
+    specks (scanner noise) are removed. A localized count, rather than a
+    page-wide one, keeps a changed number from being diluted by the rest of
+    the page. Returns the block area if the pages can't be aligned.
+    """
+    height = max(page_a.shape[0], page_b.shape[0])
+    width = page_a.shape[1]
+    page_a = cv2.copyMakeBorder(page_a, 0, height - page_a.shape[0], 0, 0, cv2.BORDER_CONSTANT, value=255)
+    page_b = cv2.copyMakeBorder(page_b, 0, height - page_b.shape[0], 0, 0, cv2.BORDER_CONSTANT, value=255)
+
+    # Align coarse to fine: a quarter-scale pass finds offsets that a
+    # full-scale pass alone would not converge from
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 50, 1e-4)
+    warp = np.eye(2, 3, dtype=np.float32)
+    try:
+        for scale in (0.25, 1.0):
+            target, moving = page_a, page_b
+            if scale < 1.0:
+                target = cv2.resize(page_a, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                moving = cv2.resize(page_b, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            else:
+                warp[:, 2] *= 4
+            _, warp = cv2.findTransformECC(
+                255 - target.astype(np.float32), 255 - moving.astype(np.float32),
+                warp, cv2.MOTION_AFFINE, criteria, None, 5,
+            )
+    except cv2.error:
+        return block_size * block_size
+    page_b = cv2.warpAffine(
+        page_b, warp, (width, height),
+        flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderValue=255,
+    )
+
+    ink_a, ink_b = _ink_mask(page_a), _ink_mask(page_b)
+    kernel = np.ones((2 * tolerance + 1, 2 * tolerance + 1), np.uint8)
+    unmatched = (ink_a & ~cv2.dilate(ink_b, kernel)) | (ink_b & ~cv2.dilate(ink_a, kernel))
+    unmatched = cv2.morphologyEx(unmatched, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8)) > 0
+
+    rows, columns = height // block_size, width // block_size
+    blocks = unmatched[:rows * block_size, :columns * block_size].reshape(rows, block_size, columns, block_size)
+    return int(blocks.sum(axis=(1, 3)).max())
+
+
+def verify_duplicate(
+    file_bytes: bytes,
+    file_type: str,
+    candidate_bytes: bytes,
+    candidate_type: str,
+    policy: Optional[FingerprintPolicy] = None,
+) -> tuple[bool, int]:
+    """
+    Check page by page whether two documents show the same content.
+
+    Returns:
+        (is_duplicate, largest block difference over all pages)
+    """
+    policy = policy or FingerprintPolicy()
+    worst = 0
+    try:
+        pages = iter_document_pages(file_bytes, file_type, policy.verify_width, policy.max_pages, policy.sandbox)
+        candidate_pages = iter_document_pages(candidate_bytes, candidate_type, policy.verify_width, policy.max_pages, policy.sandbox)
+        for page, candidate_page in zip(pages, candidate_pages):
+            worst = max(worst, page_difference(page, candidate_page, policy.verify_block_size, policy.verify_tolerance))
+            if worst > policy.max_block_difference:
+                return False, worst
+    except Exception as e:
+        print(f"Could not verify duplicate document: {str(e)}", file=sys.stderr)
+        return False, worst
+    return True, worst
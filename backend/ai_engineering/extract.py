@@ -7,8 +7,7 @@ import tempfile
 import csv
 from typing import Dict, Any, List
 from .image_processor import get_image_from_pdf
-from .anthropic_client import AnthropicClient
-from .bedrock_client import BedrockClient
+from .client_registry import get_anthropic_client, get_bedrock_client
 
 def extract_invoice_from_file(file_path: str) -> Dict[str, Any]:
     """Process a file (PDF or image) and extract invoice data."""
@@ -35,10 +34,10 @@ def extract_invoice_from_file(file_path: str) -> Dict[str, Any]:
         
         # Choose which client to use based on environment variables
         if os.getenv('ANTHROPIC_API_KEY'):
-            client = AnthropicClient()
+            client = get_anthropic_client()
             print("Using Anthropic client for extraction", file=sys.stderr)
         elif os.environ.get('AWS_DEFAULT_REGION'):  # Check if AWS credentials are available
-            client = BedrockClient()
+            client = get_bedrock_client()
             print("Using AWS Bedrock client for extraction", file=sys.stderr)
         else:
             # If no API keys are available, return a mock response for testing
@@ -0,0 +1,214 @@
+"""
+Page Image Encoding
+
+This module picks the cheapest way to encode a page image for the LLM while
+keeping it legible. Smaller payloads mean less to upload on every extraction
+and, for images under the model's downscaling limit, fewer input tokens.
+
+The encoding search:
+1. Decides whether the page needs colour or can go as grayscale
+2. Binary-searches JPEG quality for the lowest setting whose edges still match
+   the original (a cheap proxy for "the text is still readable")
+3. Also tries lossless PNG for line-art pages, where it often beats JPEG
+4. Returns the smallest candidate that passes
+"""
+
+from dataclasses import dataclass
+from typing import Optional, Union
+
+import cv2
+import numpy as np
+
+JPEG_MEDIA_TYPE = "image/jpeg"
+PNG_MEDIA_TYPE = "image/png"
+
+
+@dataclass
+class ImagePayload:
+    """
+    A base64 encoded image together with its media type.
+
+    A caption, when set, is sent as a text block just before the image to tell
+    the model what it is looking at (e.g. a zoomed crop of an earlier page).
+    The page number (0-based) ties a page's close-ups to its overview.
+    """
+    data: str
+    media_type: str = JPEG_MEDIA_TYPE
+    caption: Optional[str] = None
+    page_number: Optional[int] = None
+
+
+# What the LLM clients accept per image: a bare base64 JPEG string or a payload
+ImageInput = Union[str, ImagePayload]
+
+
+@dataclass
+class EncodingPolicy:
+    """
+    Constraints for the encoding search.
+
+    Attributes:
+        allow_grayscale: Drop colour when the page has almost none
+        allow_png: Try lossless PNG for line-art pages
+        min_jpeg_quality: Lowest JPEG quality the search may pick
+        max_jpeg_quality: Highest JPEG quality the search may pick
+        min_edge_f1: Minimum edge-map agreement (F1 score, 0-1) between the
+            original and the decoded candidate for the candidate to be accepted
+        colour_pixel_fraction: Pages with fewer than this fraction of strongly
+            coloured pixels are treated as grayscale
+        line_art_fraction: Pages with at least this fraction of near-black or
+            near-white pixels are treated as line art
+    """
+    allow_grayscale: bool = True
+    allow_png: bool = True
+    min_jpeg_quality: int = 30
+    max_jpeg_quality: int = 90
+    min_edge_f1: float = 0.98
+    colour_pixel_fraction: float = 0.005
+    line_art_fraction: float = 0.97
+
+
+# Channel spread above which a pixel counts as "coloured"
+_CHROMA_THRESHOLD = 32
+
+# Canny thresholds for the edge maps used as the legibility proxy
+_CANNY_LOW = 50
+_CANNY_HIGH = 150
+
+_EDGE_TOLERANCE_KERNEL = np.ones((3, 3), np.uint8)
+
+# JPEG qualities the search chooses between; a coarse ladder keeps it to ~3 encodes
+_JPEG_QUALITY_LADDER = (30, 40, 50, 60, 70, 80, 90)
+
+
+def image_content_block(image: ImageInput) -> dict:
+    """
+    Build an Anthropic messages API image block.
+
+    Bare strings are treated as base64 JPEG data for backwards compatibility.
+    """
+    if isinstance(image, str):
+        image = ImagePayload(data=image)
+    return {
+        "type": "image",
+        "source": {
+            "type": "base64",
+            "media_type": image.media_type,
+            "data": image.data,
+        },
+    }
+
+
+def image_content_blocks(image: ImageInput) -> list[dict]:
+    """Build the message content blocks for an image: its caption, if any, then the image."""
+    blocks = []
+    if isinstance(image, ImagePayload) and image.caption:
+        blocks.append({"type": "text", "text": image.caption})
+    blocks.append(image_content_block(image))
+    return blocks
+
+
+def is_grayscale_page(image: np.ndarray, policy: EncodingPolicy) -> bool:
+    """Return True when a BGR page has too little colour to be worth keeping."""
+    if image.ndim == 2 or image.shape[2] == 1:
+        return True
+    # A strided sample is plenty to spot coloured logos or stamps
+    sample = image[::4, ::4]
+    chroma = sample.max(axis=2).astype(np.int16) - sample.min(axis=2)
+    return np.count_nonzero(chroma > _CHROMA_THRESHOLD) < policy.colour_pixel_fraction * chroma.size
+
+
+def is_line_art(gray: np.ndarray, policy: EncodingPolicy) -> bool:
+    """Return True when a grayscale page is almost entirely black ink on white."""
+    sample = gray[::2, ::2]
+    extremes = np.count_nonzero((sample < 64) | (sample > 224))
+    return extremes >= policy.line_art_fraction * sample.size
+
+
+def _edges(gray: np.ndarray) -> np.ndarray:
+    return cv2.Canny(gray, _CANNY_LOW, _CANNY_HIGH)
+
+
+def edge_f1(reference_edges: np.ndarray, candidate_gray: np.ndarray) -> float:
+    """
+    Score how well a candidate's edges match the reference, allowing 1px drift.
+
+    Recall catches strokes lost to compression, precision catches ringing
+    artifacts that could be misread as strokes.
+    """
+    candidate_edges = _edges(candidate_gray)
+    reference_count = np.count_nonzero(reference_edges)
+    candidate_count = np.count_nonzero(candidate_edges)
+    if reference_count == 0:
+        return 1.0 if candidate_count == 0 else 0.0
+    if candidate_count == 0:
+        return 0.0
+
+    recall = np.count_nonzero(reference_edges & cv2.dilate(candidate_edges, _EDGE_TOLERANCE_KERNEL)) / reference_count
+    precision = np.count_nonzero(candidate_edges & cv2.dilate(reference_edges, _EDGE_TOLERANCE_KERNEL)) / candidate_count
+    if not recall or not precision:
+        return 0.0
+    return 2 * recall * precision / (recall + precision)
+
+
+def _encode_jpeg(image: np.ndarray, quality: int) -> bytes:
+    _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes()
+
+
+def _encode_png(image: np.ndarray) -> bytes:
+    _, buffer = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, 6])
+    return buffer.tobytes()
+
+
+def _to_gray(image: np.ndarray) -> np.ndarray:
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def encode_page_image(image: np.ndarray, policy: Optional[EncodingPolicy] = None) -> tuple[bytes, str]:
+    """
+    Encode a BGR (or grayscale) page image as compactly as legibility allows.
+
+    Args:
+        image: Page image; may be a read-only view
+        policy: Search constraints. None keeps the historical behaviour of a
+            colour JPEG at OpenCV's default quality.
+
+    Returns:
+        Tuple of (encoded bytes, media type)
+    """
+    if policy is None:
+        _, buffer = cv2.imencode('.jpg', image)
+        return buffer.tobytes(), JPEG_MEDIA_TYPE
+
+    gray = _to_gray(image)
+    working = gray if policy.allow_grayscale and is_grayscale_page(image, policy) else image
+    reference_edges = _edges(gray)
+
+    # Lowest JPEG quality that still preserves the page's edges. Edge agreement
+    # rises with quality, so a binary search over the ladder is enough.
+    ladder = [q for q in _JPEG_QUALITY_LADDER if policy.min_jpeg_quality <= q <= policy.max_jpeg_quality]
+    best_jpeg = None
+    low, high = 0, len(ladder) - 1
+    while low <= high:
+        middle = (low + high) // 2
+        candidate = _encode_jpeg(working, ladder[middle])
+        decoded = cv2.imdecode(np.frombuffer(candidate, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if edge_f1(reference_edges, decoded) >= policy.min_edge_f1:
+            best_jpeg = candidate
+            high = middle - 1
+        else:
+            low = middle + 1
+
+    if best_jpeg is None:
+        best_jpeg = _encode_jpeg(working, policy.max_jpeg_quality)
+
+    if policy.allow_png and working.ndim == 2 and is_line_art(gray, policy):
+        # Lossless, so it always passes the legibility check
+        png = _encode_png(working)
+        if len(png) < len(best_jpeg):
+            return png, PNG_MEDIA_TYPE
+
+    return best_jpeg, JPEG_MEDIA_TYPE
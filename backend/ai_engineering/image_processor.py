@@ -2,11 +2,62 @@ import fitz
 import numpy as np
 import cv2
 import base64
+import hashlib
+import math
+import multiprocessing
+import os
 import sys
-from typing import Optional
-from dataclasses import dataclass
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
+from typing import Iterator, Optional
+from dataclasses import asdict, dataclass, field
 from time import time
 
+from .image_encoding import JPEG_MEDIA_TYPE, EncodingPolicy, ImageInput, ImagePayload, encode_page_image
+from .page_cache import PageCache, document_key
+from .render_sandbox import SandboxPolicy, iter_sandboxed_pages
+
+# Zoom used when rasterizing PDF pages for the LLM
+DEFAULT_PDF_ZOOM = 3.0
+
+# Documents shorter than this are rendered in-process; the IPC overhead of
+# shipping the PDF to a worker outweighs the gain for one or two pages.
+MIN_PAGES_FOR_PARALLEL_RENDER = 3
+
+# Bytes of base64 page data a PageSpool keeps in memory before spilling to disk
+DEFAULT_SPOOL_MEMORY_BYTES = 8 * 1024 * 1024
+
+# Claude downscales images whose long edge exceeds 1568px or that come to more
+# than ~1.15 megapixels (~1600 tokens); anything rendered beyond that is wasted.
+MODEL_MAX_LONG_EDGE = 1568
+MODEL_MAX_MEGAPIXELS = 1.15
+PIXELS_PER_IMAGE_TOKEN = 750
+
+# Size of the grayscale thumbnail kept per page for near-duplicate comparison
+SIGNATURE_THUMBNAIL_WIDTH = 256
+
+@dataclass
+class PageSignature:
+    """
+    Cheap statistics about a rendered page, used to triage it before it is sent.
+
+    Attributes:
+        ink_coverage: Fraction of pixels dark enough to be ink
+        intensity_std: Standard deviation of grayscale intensity
+        phash: 64-bit DCT perceptual hash of the page
+        text_digest: Hash of the page's normalized text layer, or None when it has none
+        thumbnail: Small grayscale rendition for pixel-level comparison
+    """
+    ink_coverage: float
+    intensity_std: float
+    phash: int
+    text_digest: Optional[str]
+    thumbnail: np.ndarray
+
 @dataclass
 class PDFPageImage:
     data: bytes
@@ -14,6 +65,310 @@ class PDFPageImage:
     height: int
     applied_rotation: float
     elapsed_time: float
+    page_number: int = -1
+    zoom: float = DEFAULT_PDF_ZOOM
+    media_type: str = JPEG_MEDIA_TYPE
+    signature: Optional[PageSignature] = None
+    # High-resolution crops of table regions; when present this image is a low-resolution overview
+    tiles: list["PDFPageImage"] = field(default_factory=list)
+    # Text rows inside the page's table regions, when counted (see count_table_lines)
+    table_lines: int = 0
+
+@dataclass
+class ResolutionBudget:
+    """
+    Target size for rendered pages.
+
+    Each page's zoom is chosen so the rendered image fits within both the
+    long-edge and megapixel limits (either may be None to ignore it), then
+    clamped to [min_zoom, max_zoom].
+    """
+    target_long_edge: Optional[int] = MODEL_MAX_LONG_EDGE
+    max_megapixels: Optional[float] = MODEL_MAX_MEGAPIXELS
+    min_zoom: float = 1.0
+    max_zoom: float = DEFAULT_PDF_ZOOM
+
+DEFAULT_RESOLUTION_BUDGET = ResolutionBudget()
+
+@dataclass
+class PreprocessPolicy:
+    """
+    Cleanup applied to each rendered page before it is encoded.
+
+    Attributes:
+        crop_margins: Trim blank margins down to the content bounding box
+        margin_padding: Whitespace kept around the content when cropping, in pixels
+        min_crop_saving: Skip the crop unless it removes at least this fraction of the area
+        deskew: Detect and correct skew on scanned (unstructured) pages
+        min_skew_degrees: Smaller detected angles are left alone
+        max_skew_degrees: Larger detected angles are treated as misdetections
+        max_long_edge: Downscale the final page so its longer side fits; None disables
+    """
+    crop_margins: bool = True
+    margin_padding: int = 16
+    min_crop_saving: float = 0.05
+    deskew: bool = True
+    min_skew_degrees: float = 0.2
+    max_skew_degrees: float = 10.0
+    max_long_edge: Optional[int] = MODEL_MAX_LONG_EDGE
+
+@dataclass
+class TilingPolicy:
+    """
+    Send table-heavy pages as a low-resolution overview plus sharp table crops.
+
+    Attributes:
+        overview_long_edge: Long edge of the overview render, in pixels
+        tile_long_edge: Long edge each table crop is rendered at, in pixels
+        max_tile_zoom: Upper bound on the zoom used for table crops
+        max_tiles: Most table crops sent per page
+        min_region_fraction: Smallest table region worth a crop, as a fraction of the page area
+        max_region_fraction: Regions larger than this cover most of the page; the page
+            is then rendered normally instead of tiled
+        tile_padding: Margin added around each region, in overview pixels
+    """
+    overview_long_edge: int = 1000
+    tile_long_edge: int = MODEL_MAX_LONG_EDGE
+    max_tile_zoom: float = 4.0
+    max_tiles: int = 2
+    min_region_fraction: float = 0.04
+    max_region_fraction: float = 0.7
+    tile_padding: int = 8
+
+@dataclass
+class RenderOptions:
+    """
+    How PDF pages are turned into images. Sent to render workers, so it must
+    stay picklable.
+
+    Attributes:
+        zoom: Fixed zoom for every page; overrides the budget when set
+        budget: Resolution budget used to plan each page's zoom from its size
+        encoding: Encoding search policy; None encodes a colour JPEG at
+            OpenCV's default quality
+        triage: Blank/duplicate page skipping policy; None sends every page
+        preprocess: Crop/deskew/downscale policy; None sends the render as is
+        tiling: Overview-plus-table-crops policy; None sends one image per page
+        table_lines: Count each page's table lines, e.g. to gauge how complex
+            the document is before choosing a model
+        sandbox: Per-page time, memory and page count limits, enforced by
+            rendering in sandboxed child processes; None renders in this
+            process or the shared pool without limits
+    """
+    zoom: Optional[float] = None
+    budget: ResolutionBudget = field(default_factory=ResolutionBudget)
+    encoding: Optional[EncodingPolicy] = None
+    triage: Optional["TriagePolicy"] = None
+    preprocess: Optional[PreprocessPolicy] = None
+    tiling: Optional[TilingPolicy] = None
+    table_lines: bool = False
+    sandbox: Optional[SandboxPolicy] = None
+
+@dataclass
+class RenderStats:
+    """
+    Running totals for one document's rendered pages, compared against what the
+    fixed DEFAULT_PDF_ZOOM render would have produced. Baseline bytes are
+    scaled by pixel count, which overstates them somewhat since JPEG compresses
+    larger renders better; token counts use the model's image token formula
+    after its own downscaling.
+
+    Table crops are extra images the baseline had no equivalent of, so they
+    are totalled separately (tile_*) and left out of the savings; the cost of
+    tiling is the tile totals less the savings on the overviews.
+    """
+    pages: int = 0
+    pixels: int = 0
+    baseline_pixels: int = 0
+    bytes: int = 0
+    estimated_baseline_bytes: int = 0
+    estimated_tokens: int = 0
+    estimated_baseline_tokens: int = 0
+    skipped_pages: int = 0
+    tiles: int = 0
+    tile_pixels: int = 0
+    tile_bytes: int = 0
+    tile_estimated_tokens: int = 0
+    table_lines: int = 0
+    page_cache: str = ''
+    triage: list[dict] = field(default_factory=list)
+    failed_pages: list[dict] = field(default_factory=list)
+    pages_over_limit: int = 0
+
+    def record_triage(self, decision: "PageTriageDecision") -> None:
+        if decision.action != TRIAGE_KEEP:
+            self.skipped_pages += 1
+        self.triage.append(asdict(decision))
+
+    def record(self, page_image: PDFPageImage) -> None:
+        pixels = page_image.width * page_image.height
+        linear_scale = DEFAULT_PDF_ZOOM / page_image.zoom
+        baseline_width = round(page_image.width * linear_scale)
+        baseline_height = round(page_image.height * linear_scale)
+
+        self.pages += 1
+        self.pixels += pixels
+        self.baseline_pixels += baseline_width * baseline_height
+        self.bytes += len(page_image.data)
+        self.estimated_baseline_bytes += round(len(page_image.data) * linear_scale ** 2)
+        self.estimated_tokens += estimate_image_tokens(page_image.width, page_image.height)
+        self.estimated_baseline_tokens += estimate_image_tokens(baseline_width, baseline_height)
+        self.table_lines += page_image.table_lines
+
+        for tile in page_image.tiles:
+            self.tiles += 1
+            self.tile_pixels += tile.width * tile.height
+            self.tile_bytes += len(tile.data)
+            self.tile_estimated_tokens += estimate_image_tokens(tile.width, tile.height)
+
+    def as_dict(self) -> dict:
+        return {
+            **asdict(self),
+            'bytes_saved': self.estimated_baseline_bytes - self.bytes,
+            'tokens_saved': self.estimated_baseline_tokens - self.estimated_tokens,
+        }
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Approximate input tokens for an image, after the model's own downscaling."""
+    scale = min(1.0, MODEL_MAX_LONG_EDGE / max(width, height, 1))
+    scale = min(scale, math.sqrt(MODEL_MAX_MEGAPIXELS * 1_000_000 / max(width * height, 1)))
+    return math.ceil(width * height * scale * scale / PIXELS_PER_IMAGE_TOKEN)
+
+def plan_page_zoom(page_rect: fitz.Rect, budget: ResolutionBudget = DEFAULT_RESOLUTION_BUDGET) -> float:
+    """
+    Pick the zoom for a page from its geometry and a pixel budget.
+
+    Uses the page's visible rect (mediabox clipped to the cropbox, with rotation
+    applied), since that is what PyMuPDF rasterizes.
+    """
+    width, height = abs(page_rect.width), abs(page_rect.height)
+    if not width or not height:
+        return budget.max_zoom
+
+    zoom = budget.max_zoom
+    if budget.target_long_edge:
+        zoom = min(zoom, budget.target_long_edge / max(width, height))
+    if budget.max_megapixels:
+        zoom = min(zoom, math.sqrt(budget.max_megapixels * 1_000_000 / (width * height)))
+    return max(budget.min_zoom, zoom)
+
+TRIAGE_KEEP = 'keep'
+TRIAGE_SKIP_BLANK = 'skip_blank'
+TRIAGE_SKIP_DUPLICATE = 'skip_duplicate'
+
+@dataclass
+class TriagePolicy:
+    """
+    Thresholds for dropping pages that add cost but no information.
+
+    A page is blank when both its ink coverage and intensity spread are below
+    the limits. A page is a duplicate of an earlier kept page when their
+    perceptual hashes are within max_hamming bits and, in addition, either
+    both text layers are identical or (for pages without text, i.e. scans)
+    their thumbnails differ in at most max_pixel_diff of pixels. The extra
+    check stops invoices printed on the same template from being collapsed.
+    """
+    skip_blank: bool = True
+    skip_duplicates: bool = True
+    blank_ink_coverage: float = 0.0005
+    blank_intensity_std: float = 12.0
+    max_hamming: int = 4
+    max_pixel_diff: float = 0.002
+
+@dataclass
+class PageTriageDecision:
+    """Audit record of what triage did with one page and why."""
+    page_number: int
+    action: str
+    reason: str
+    ink_coverage: float
+    phash: str
+    duplicate_of: Optional[int] = None
+    hamming_distance: Optional[int] = None
+
+def perceptual_hash(gray: np.ndarray) -> int:
+    """64-bit DCT perceptual hash: low-frequency coefficients above their median."""
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_freq = cv2.dct(small)[:8, :8].flatten()
+    bits = low_freq > np.median(low_freq[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    return (hash_a ^ hash_b).bit_count()
+
+def compute_page_signature(image: np.ndarray, page_text: str) -> PageSignature:
+    """Compute triage statistics for a rendered page (BGR or grayscale) and its text layer."""
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    sample = gray[::2, ::2]
+    text = " ".join(page_text.split())
+    thumb_height = max(1, round(gray.shape[0] * SIGNATURE_THUMBNAIL_WIDTH / gray.shape[1]))
+
+    return PageSignature(
+        ink_coverage=float(np.count_nonzero(sample < 128)) / sample.size,
+        intensity_std=float(sample.std()),
+        phash=perceptual_hash(gray),
+        text_digest=hashlib.sha1(text.encode("utf-8")).hexdigest() if text else None,
+        thumbnail=cv2.resize(gray, (SIGNATURE_THUMBNAIL_WIDTH, thumb_height), interpolation=cv2.INTER_AREA),
+    )
+
+def _thumbnail_diff(thumb_a: np.ndarray, thumb_b: np.ndarray) -> float:
+    """Fraction of thumbnail pixels that differ noticeably; 1.0 if the shapes differ."""
+    if thumb_a.shape != thumb_b.shape:
+        return 1.0
+    return float(np.count_nonzero(cv2.absdiff(thumb_a, thumb_b) > 48)) / thumb_a.size
+
+class PageTriage:
+    """
+    Decides, page by page in document order, which pages are worth sending.
+
+    Kept pages are remembered so later pages can be compared against them.
+    """
+
+    def __init__(self, policy: TriagePolicy):
+        self.policy = policy
+        self._kept: list[tuple[int, PageSignature]] = []
+
+    def decide(self, page_number: int, signature: PageSignature) -> PageTriageDecision:
+        policy = self.policy
+        decision = PageTriageDecision(
+            page_number=page_number,
+            action=TRIAGE_KEEP,
+            reason='',
+            ink_coverage=round(signature.ink_coverage, 6),
+            phash=f"{signature.phash:016x}",
+        )
+
+        if (policy.skip_blank
+                and signature.ink_coverage < policy.blank_ink_coverage
+                and signature.intensity_std < policy.blank_intensity_std):
+            decision.action = TRIAGE_SKIP_BLANK
+            decision.reason = (
+                f"ink coverage {signature.ink_coverage:.4%} and intensity std "
+                f"{signature.intensity_std:.1f} below blank thresholds"
+            )
+            return decision
+
+        if policy.skip_duplicates:
+            for kept_number, kept in self._kept:
+                distance = hamming_distance(signature.phash, kept.phash)
+                if distance > policy.max_hamming:
+                    continue
+                if signature.text_digest and kept.text_digest:
+                    is_duplicate = signature.text_digest == kept.text_digest
+                    evidence = 'identical text layer'
+                else:
+                    pixel_diff = _thumbnail_diff(signature.thumbnail, kept.thumbnail)
+                    is_duplicate = pixel_diff <= policy.max_pixel_diff
+                    evidence = f"{pixel_diff:.3%} of thumbnail pixels differ"
+                if is_duplicate:
+                    decision.action = TRIAGE_SKIP_DUPLICATE
+                    decision.duplicate_of = kept_number
+                    decision.hamming_distance = distance
+                    decision.reason = f"duplicate of page {kept_number + 1}: phash distance {distance}, {evidence}"
+                    return decision
+
+        self._kept.append((page_number, signature))
+        return decision
 
 def bytes_to_cv2(image_bytes: bytes) -> np.ndarray:
     """Convert bytes to OpenCV image format."""
@@ -29,21 +384,159 @@ def extract_image_page_bytes(page: fitz.Page, zoom: float = 2.0) -> bytes:
     """Extract image from PDF page."""
     return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom)).pil_tobytes(format="JPEG", optimize=True)
 
+def pixmap_to_array(pixmap: fitz.Pixmap) -> np.ndarray:
+    """
+    Wrap a pixmap's sample buffer as an HxWxN uint8 array without copying.
+
+    The array is a view onto memory owned by the pixmap, so the pixmap must be
+    kept alive for as long as the array is in use.
+    """
+    buffer = np.frombuffer(pixmap.samples_mv, dtype=np.uint8)
+    return np.lib.stride_tricks.as_strided(
+        buffer,
+        shape=(pixmap.height, pixmap.width, pixmap.n),
+        strides=(pixmap.stride, pixmap.n, 1),
+        writeable=True,
+    )
+
+def extract_page_array(
+    page: fitz.Page,
+    zoom: float = 2.0,
+    clip: Optional[fitz.Rect] = None,
+) -> tuple[np.ndarray, fitz.Pixmap]:
+    """
+    Render a PDF page (or the clip area of it) straight into a BGR array suitable for OpenCV.
+
+    Returns the array together with the pixmap that owns its memory. The RGB to
+    BGR swap is done in place, so no full-frame copy is made between rendering
+    and encoding.
+    """
+    pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, alpha=False, clip=clip)
+    image = pixmap_to_array(pixmap)
+    cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=image)
+    return image, pixmap
+
+# Pixels darker than this count as content when looking for the page's margins
+_CONTENT_THRESHOLD = 200
+
+# Width skew detection works at; plenty to find text baselines and ruling lines
+_DESKEW_ANALYSIS_WIDTH = 800
+
+# Long edge table lines are counted at, and the most table regions counted per page
+_TABLE_ANALYSIS_LONG_EDGE = 1000
+_MAX_TABLE_REGIONS = 4
+
+def content_bounds(gray: np.ndarray, padding: int = 0) -> Optional[tuple[int, int, int, int]]:
+    """
+    Return the (top, bottom, left, right) bounds of a page's non-blank content.
+
+    Returns None for pages with no content at all.
+    """
+    ink = gray < _CONTENT_THRESHOLD
+    rows = np.flatnonzero(ink.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(ink[rows[0]:rows[-1] + 1].any(axis=0))
+    height, width = gray.shape
+    return (
+        max(0, rows[0] - padding),
+        min(height, rows[-1] + 1 + padding),
+        max(0, cols[0] - padding),
+        min(width, cols[-1] + 1 + padding),
+    )
+
+def detect_skew_angle(gray: np.ndarray, max_skew_degrees: float) -> float:
+    """
+    Estimate page skew in degrees from the median angle of near-horizontal lines.
+
+    Text baselines and table rulings are picked up by a probabilistic Hough
+    transform on a downscaled edge map. Returns 0.0 when too few lines are found.
+    """
+    scale = min(1.0, _DESKEW_ANALYSIS_WIDTH / gray.shape[1])
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else gray
+    edges = cv2.Canny(small, 50, 150)
+    # Merge characters on a line into one blob so baselines read as long segments
+    edges = cv2.dilate(edges, cv2.getStructuringElement(cv2.MORPH_RECT, (15, 1)))
+    lines = cv2.HoughLinesP(
+        edges, 1, np.pi / 720, threshold=100,
+        minLineLength=small.shape[1] // 5, maxLineGap=20,
+    )
+    if lines is None:
+        return 0.0
+
+    x1, y1, x2, y2 = lines[:, 0].T.astype(np.float64)
+    angles = np.degrees(np.arctan2(y2 - y1, x2 - x1))
+    angles = angles[np.abs(angles) <= max_skew_degrees]
+    if angles.size < 3:
+        return 0.0
+    return float(np.median(angles))
+
+def rotate_page(image: np.ndarray, angle: float) -> np.ndarray:
+    """Rotate a page about its centre, keeping its size and filling exposed corners white."""
+    height, width = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    border = 255 if image.ndim == 2 else (255, 255, 255)
+    return cv2.warpAffine(
+        image, matrix, (width, height),
+        flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=border,
+    )
+
 def preprocess_pdf_page_image(
     source_image: np.ndarray,
     pre_defined_rotation: Optional[float] = None,
     is_structured: bool = True,
+    encoding: Optional[EncodingPolicy] = None,
+    policy: Optional[PreprocessPolicy] = None,
 ) -> PDFPageImage:
-    """Preprocess the image for optimal processing."""
-    start_time = time()
-    source_image = np.copy(source_image)
-    img_height, img_width, *_ = source_image.shape
+    """
+    Preprocess the image for optimal processing.
+
+    Steps, each skipped when disabled in the policy:
+    1. Straighten the page: by pre_defined_rotation when given, otherwise by the
+       detected skew for scanned pages (is_structured=False). Digitally
+       generated pages are never skewed, so detection is not run for them.
+    2. Crop blank margins, keeping a little padding
+    3. Downscale so the longer side fits policy.max_long_edge
 
-    # For now, we'll keep it simple and just return the image as is
-    # We can add more preprocessing steps later if needed
+    The source image may be a view onto a pixmap buffer; it is read, never
+    copied unless a step has to produce new pixels, and the result is encoded
+    exactly once. Without a policy the image is encoded as is.
+    """
+    start_time = time()
     page = source_image
-    page_rotation = 0
-    data = cv2_to_bytes(page)
+    page_rotation = 0.0
+
+    if policy is not None:
+        gray = page if page.ndim == 2 else cv2.cvtColor(page, cv2.COLOR_BGR2GRAY)
+
+        if pre_defined_rotation is not None:
+            page_rotation = pre_defined_rotation
+        elif policy.deskew and not is_structured:
+            page_rotation = detect_skew_angle(gray, policy.max_skew_degrees)
+            if abs(page_rotation) < policy.min_skew_degrees:
+                page_rotation = 0.0
+        if page_rotation:
+            page = rotate_page(page, page_rotation)
+            gray = rotate_page(gray, page_rotation)
+
+        if policy.crop_margins:
+            bounds = content_bounds(gray, policy.margin_padding)
+            if bounds is not None:
+                top, bottom, left, right = bounds
+                img_height, img_width = gray.shape
+                if (bottom - top) * (right - left) <= (1 - policy.min_crop_saving) * img_height * img_width:
+                    # Slicing is free; the encoder reads the strided view directly
+                    page = page[top:bottom, left:right]
+
+        page_height, page_width = page.shape[:2]
+        if policy.max_long_edge and max(page_height, page_width) > policy.max_long_edge:
+            scale = policy.max_long_edge / max(page_height, page_width)
+            page = cv2.resize(
+                page, (max(1, round(page_width * scale)), max(1, round(page_height * scale))),
+                interpolation=cv2.INTER_AREA,
+            )
+
+    data, media_type = encode_page_image(page, encoding)
     page_height, page_width, *_ = page.shape
 
     return PDFPageImage(
@@ -52,52 +545,747 @@ def preprocess_pdf_page_image(
         height=page_height,
         applied_rotation=page_rotation,
         elapsed_time=time() - start_time,
+        media_type=media_type,
     )
 
-def get_image_from_pdf(pdf_bytes: bytes) -> Optional[list[str]]:
-    """Convert PDF to list of base64 encoded images, one per page."""
+def is_scanned_page(page: fitz.Page, min_coverage: float = 0.8) -> bool:
+    """Return True when a page is dominated by a raster image, i.e. it came from a scanner."""
+    page_area = abs(page.rect)
+    if not page_area:
+        return False
+    for image_info in page.get_image_info():
+        if abs(fitz.Rect(image_info["bbox"]) & page.rect) >= min_coverage * page_area:
+            return True
+    return False
+
+def render_pdf_page(
+    page: fitz.Page,
+    zoom: float = DEFAULT_PDF_ZOOM,
+    encoding: Optional[EncodingPolicy] = None,
+    with_signature: bool = False,
+    preprocess: Optional[PreprocessPolicy] = None,
+    with_table_lines: bool = False,
+) -> Optional[PDFPageImage]:
+    """
+    Rasterize and preprocess a single PDF page, returning None if it can't be used.
+
+    With with_signature, the page's triage statistics are computed from the
+    same render and attached to the result; with with_table_lines, so is its
+    count of table lines.
+    """
+    page_num = page.number
+    try:
+        # Render with higher zoom for better quality; the array is a view onto the pixmap
+        cv_image, pixmap = extract_page_array(page, zoom=zoom)
+        if cv_image.size == 0:
+            print(f"Empty render for page {page_num + 1}", file=sys.stderr)
+            return None
+
+        # Preprocess
+        is_structured = preprocess is None or not preprocess.deskew or not is_scanned_page(page)
+        processed_image = preprocess_pdf_page_image(
+            cv_image, is_structured=is_structured, encoding=encoding, policy=preprocess,
+        )
+        processed_image.page_number = page_num
+        processed_image.zoom = zoom
+        if with_signature:
+            processed_image.signature = compute_page_signature(cv_image, page.get_text("text"))
+        if with_table_lines:
+            processed_image.table_lines = count_table_lines(cv_image)
+        del cv_image, pixmap
+
+        # Verify the processed image data
+        if not processed_image.data:
+            print(f"Empty image data for page {page_num + 1}", file=sys.stderr)
+            return None
+
+        return processed_image
+
+    except Exception as page_error:
+        print(f"Error processing page {page_num + 1}: {str(page_error)}", file=sys.stderr)
+        return None
+
+def detect_table_regions(gray: np.ndarray, policy: TilingPolicy) -> list[tuple[int, int, int, int]]:
+    """
+    Find table regions on a page as (x0, y0, x1, y1) pixel boxes, top to bottom.
+
+    Long horizontal and vertical strokes are isolated with morphological opening,
+    merged into grids and boxed. Ruled tables are boxes with rulings in both
+    directions. Open tables, where only a header bar or rule spans the page,
+    show up as thin wide bands; those are extended down through the block of
+    text rows beneath them.
+    """
+    height, width = gray.shape
+    ink = cv2.adaptiveThreshold(~gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 15, -2)
+    horizontal = cv2.morphologyEx(ink, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (max(width // 25, 10), 1)))
+    vertical = cv2.morphologyEx(ink, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (1, max(height // 50, 10))))
+    grid = cv2.dilate(horizontal | vertical, np.ones((5, 5), np.uint8))
+
+    # Rows holding any ink, and the blank gap that ends a block of table rows
+    inked_rows = (gray < _CONTENT_THRESHOLD).any(axis=1)
+    max_row_gap = max(height // 25, 1)
+
+    regions = []
+    contours, _ = cv2.findContours(grid, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if not horizontal[y:y + h, x:x + w].any():
+            continue
+        if h < height // 20 and w >= width // 2:
+            # Header band of an open table: take the rows up to the first wide blank gap
+            bottom = y + h
+            gap = 0
+            while bottom + gap < height and gap < max_row_gap:
+                if inked_rows[bottom + gap]:
+                    bottom += gap + 1
+                    gap = 0
+                else:
+                    gap += 1
+            h = bottom - y
+        elif not vertical[y:y + h, x:x + w].any():
+            continue
+        if w * h < policy.min_region_fraction * width * height:
+            continue
+        regions.append((
+            max(0, x - policy.tile_padding),
+            max(0, y - policy.tile_padding),
+            min(width, x + w + policy.tile_padding),
+            min(height, y + h + policy.tile_padding),
+        ))
+
+    # Keep the largest regions, then restore reading order
+    regions.sort(key=lambda box: (box[2] - box[0]) * (box[3] - box[1]), reverse=True)
+    return sorted(regions[:policy.max_tiles], key=lambda box: box[1])
+
+def count_table_lines(image: np.ndarray) -> int:
+    """
+    Count the text rows inside a page image's table regions, a proxy for its number of line items.
+
+    The page is analysed at _TABLE_ANALYSIS_LONG_EDGE. Within each region found by
+    detect_table_regions, every run of inked pixel rows at least as tall as a
+    line of text counts as one line; thinner runs are rulings.
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    scale = _TABLE_ANALYSIS_LONG_EDGE / max(gray.shape)
+    if scale < 1:
+        gray = cv2.resize(gray, (max(1, round(gray.shape[1] * scale)), max(1, round(gray.shape[0] * scale))), interpolation=cv2.INTER_AREA)
+    policy = TilingPolicy(max_tiles=_MAX_TABLE_REGIONS, tile_padding=0)
+    min_row_height = max(gray.shape[0] // 250, 2)
+
+    lines = 0
+    for x0, y0, x1, y1 in detect_table_regions(gray, policy):
+        inked_rows = (gray[y0:y1, x0:x1] < _CONTENT_THRESHOLD).any(axis=1)
+        run = 0
+        for inked in np.append(inked_rows, False):
+            if inked:
+                run += 1
+                continue
+            if run >= min_row_height:
+                lines += 1
+            run = 0
+    return lines
+
+def _needs_deskew(page: fitz.Page, gray: np.ndarray, preprocess: Optional[PreprocessPolicy]) -> bool:
+    """Whether preprocessing would straighten a page: a scan skewed by at least min_skew_degrees."""
+    if preprocess is None or not preprocess.deskew or not is_scanned_page(page):
+        return False
+    return abs(detect_skew_angle(gray, preprocess.max_skew_degrees)) >= preprocess.min_skew_degrees
+
+def render_tiled_pdf_page(
+    page: fitz.Page,
+    options: RenderOptions,
+    fallback_zoom: float,
+) -> Optional[PDFPageImage]:
+    """
+    Render a page as a low-resolution overview with high-resolution table crops attached.
+
+    The overview and the crops get the same margin cropping and downscaling as
+    untiled pages. Pages without a suitable table region, rotated pages (whose
+    pixel and page coordinates differ) and skewed scans (whose crops would be
+    skewed too) are rendered normally at fallback_zoom instead, which for a
+    skewed scan straightens it.
+    """
+    policy = options.tiling
+    rect = page.rect
+    overview_zoom = min(fallback_zoom, policy.overview_long_edge / max(rect.width, rect.height, 1))
+
+    try:
+        if page.rotation:
+            regions = []
+        else:
+            overview, pixmap = extract_page_array(page, zoom=overview_zoom)
+            gray = cv2.cvtColor(overview, cv2.COLOR_BGR2GRAY)
+            regions = [] if _needs_deskew(page, gray, options.preprocess) else detect_table_regions(gray, policy)
+            table_lines = count_table_lines(gray) if options.table_lines else 0
+            page_area = gray.size
+            if sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions) > policy.max_region_fraction * page_area:
+                regions = []
+    except Exception as page_error:
+        print(f"Error detecting tables on page {page.number + 1}: {str(page_error)}", file=sys.stderr)
+        regions = []
+
+    if not regions:
+        return render_pdf_page(
+            page,
+            zoom=fallback_zoom,
+            encoding=options.encoding,
+            with_signature=options.triage is not None,
+            preprocess=options.preprocess,
+            with_table_lines=options.table_lines,
+        )
+
+    try:
+        # Pixel boxes on the overview map back to page coordinates through its zoom
+        processed_image = preprocess_pdf_page_image(overview, encoding=options.encoding, policy=options.preprocess)
+        processed_image.page_number = page.number
+        processed_image.zoom = overview_zoom
+        processed_image.table_lines = table_lines
+        if options.triage is not None:
+            processed_image.signature = compute_page_signature(overview, page.get_text("text"))
+        del overview, gray, pixmap
+
+        for x0, y0, x1, y1 in regions:
+            clip = fitz.Rect(x0, y0, x1, y1) / overview_zoom
+            # Never coarser than the overview, even for a region too large for tile_long_edge
+            tile_zoom = max(overview_zoom, min(policy.max_tile_zoom, policy.tile_long_edge / max(clip.width, clip.height, 1)))
+            tile_array, tile_pixmap = extract_page_array(page, zoom=tile_zoom, clip=clip)
+            tile = preprocess_pdf_page_image(tile_array, encoding=options.encoding, policy=options.preprocess)
+            tile.page_number = page.number
+            tile.zoom = tile_zoom
+            processed_image.tiles.append(tile)
+            del tile_array, tile_pixmap
+
+        return processed_image
+
+    except Exception as page_error:
+        print(f"Error tiling page {page.number + 1}: {str(page_error)}", file=sys.stderr)
+        return None
+
+def _render_planned_page(page: fitz.Page, options: RenderOptions) -> Optional[PDFPageImage]:
+    """Render a page at the options' fixed zoom if set, otherwise at the budget's planned zoom."""
+    zoom = options.zoom if options.zoom is not None else plan_page_zoom(page.rect, options.budget)
+    if options.tiling is not None:
+        return render_tiled_pdf_page(page, options, fallback_zoom=zoom)
+    return render_pdf_page(
+        page,
+        zoom=zoom,
+        encoding=options.encoding,
+        with_signature=options.triage is not None,
+        preprocess=options.preprocess,
+        with_table_lines=options.table_lines,
+    )
+
+def _render_pdf_pages(pdf_bytes: bytes, page_numbers: list[int], options: RenderOptions) -> list[Optional[PDFPageImage]]:
+    """Render a run of pages from one document. Executed inside a render pool worker."""
+    with fitz.Document(stream=pdf_bytes, filetype="pdf") as doc:
+        return [_render_planned_page(doc[page_num], options) for page_num in page_numbers]
+
+def _warm_render_worker() -> None:
+    """Pool initializer: load PyMuPDF and OpenCV once so the first job doesn't pay for it."""
+    fitz.TOOLS.mupdf_display_errors(False)
+    cv2.setNumThreads(1)  # one process per core already; avoid oversubscription
+    with fitz.open() as doc:
+        doc.new_page().get_pixmap()
+
+_render_pool: Optional[ProcessPoolExecutor] = None
+_render_pool_workers = 0
+_render_pool_pid: Optional[int] = None
+_render_pool_lock = threading.Lock()
+
+def get_render_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Return the process-wide rasterization pool, creating it on first use.
+
+    The pool is kept alive between documents so workers stay warm. It is rebuilt
+    if the requested size changes or if we are in a forked child (e.g. a gunicorn
+    worker forked after the master touched the pool).
+    """
+    global _render_pool, _render_pool_workers, _render_pool_pid
+    with _render_pool_lock:
+        if _render_pool is not None and (_render_pool_pid != os.getpid() or _render_pool_workers != workers):
+            if _render_pool_pid == os.getpid():
+                _render_pool.shutdown(wait=False, cancel_futures=True)
+            _render_pool = None
+
+        if _render_pool is None:
+            _render_pool = ProcessPoolExecutor(
+                max_workers=workers,
+                # spawn rather than fork: the parent is a threaded web worker
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_render_worker,
+            )
+            _render_pool_workers = workers
+            _render_pool_pid = os.getpid()
+        return _render_pool
+
+def shutdown_render_pool() -> None:
+    """Stop the rasterization pool, if one was started in this process."""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is not None and _render_pool_pid == os.getpid():
+            _render_pool.shutdown(wait=True, cancel_futures=True)
+        _render_pool = None
+
+def _chunk_pages(page_count: int, workers: int) -> list[list[int]]:
+    """Split page indices into contiguous runs, about two per worker for load balancing."""
+    chunk_size = max(1, -(-page_count // (workers * 2)))
+    return [list(range(start, min(start + chunk_size, page_count))) for start in range(0, page_count, chunk_size)]
+
+def _iter_pages_parallel(
+    pdf_bytes: bytes,
+    page_count: int,
+    workers: int,
+    options: RenderOptions,
+) -> Iterator[Optional[PDFPageImage]]:
+    """
+    Render pages across the pool and yield them in page order.
+
+    Only a small window of chunks is in flight at once, so finished pages don't
+    pile up in this process while the consumer is still busy with earlier ones.
+    """
+    pool = get_render_pool(workers)
+    pending = deque()
+    chunks = iter(_chunk_pages(page_count, workers))
+    for chunk in islice(chunks, workers * 2):
+        pending.append(pool.submit(_render_pdf_pages, pdf_bytes, chunk, options))
+
+    try:
+        while pending:
+            chunk_images = pending.popleft().result()
+            for chunk in islice(chunks, 1):
+                pending.append(pool.submit(_render_pdf_pages, pdf_bytes, chunk, options))
+            yield from chunk_images
+    finally:
+        # The consumer may stop early; don't leave queued work behind in the shared pool
+        for future in pending:
+            future.cancel()
+
+def _iter_sandboxed_rendered_pages(
+    pdf_bytes: bytes,
+    workers: int,
+    options: RenderOptions,
+    stats: Optional[RenderStats] = None,
+) -> Iterator[PDFPageImage]:
+    """Render up to the sandbox's page cap in sandboxed children, skipping pages that fail or time out."""
+    with fitz.Document(stream=pdf_bytes, filetype="pdf") as doc:
+        page_count = len(doc)
+    max_pages = options.sandbox.max_pages
+    if page_count > max_pages:
+        print(f"Rendering only the first {max_pages} of {page_count} pages", file=sys.stderr)
+        if stats is not None:
+            stats.pages_over_limit = page_count - max_pages
+
+    for _, page_image, failure in iter_sandboxed_pages(
+        pdf_bytes, range(min(page_count, max_pages)), _render_planned_page, (options,), options.sandbox, workers,
+    ):
+        if failure is not None and stats is not None:
+            stats.failed_pages.append(asdict(failure))
+        if page_image is not None:
+            yield page_image
+
+def _iter_rendered_pages(
+    pdf_bytes: bytes,
+    workers: int,
+    options: RenderOptions,
+    stats: Optional[RenderStats] = None,
+) -> Iterator[PDFPageImage]:
+    """
+    Render every page in order, via the pool when worthwhile, skipping failures.
+
+    If the pool breaks, the remaining pages are rendered sequentially in this
+    process. With options.sandbox, every page is rendered in a sandboxed child
+    instead.
+    """
+    if options.sandbox is not None:
+        yield from _iter_sandboxed_rendered_pages(pdf_bytes, workers, options, stats)
+        return
+
+    with fitz.Document(stream=pdf_bytes, filetype="pdf") as doc:
+        page_count = len(doc)
+        next_page = 0
+
+        if workers > 1 and page_count >= MIN_PAGES_FOR_PARALLEL_RENDER:
+            try:
+                for page_image in _iter_pages_parallel(pdf_bytes, page_count, min(workers, page_count), options):
+                    next_page += 1
+                    if page_image is not None:
+                        yield page_image
+            except (BrokenProcessPool, OSError) as pool_error:
+                # A crashed worker poisons the whole pool; drop it and render the rest here instead
+                print(f"Render pool failed, falling back to sequential rendering: {pool_error}", file=sys.stderr)
+                shutdown_render_pool()
+
+        for page_num in range(next_page, page_count):
+            page_image = _render_planned_page(doc[page_num], options)
+            if page_image is not None:
+                yield page_image
+
+# Plain fields of a PDFPageImage kept in its page cache metadata
+_CACHED_PAGE_FIELDS = (
+    "width", "height", "applied_rotation", "elapsed_time", "page_number", "zoom", "media_type", "table_lines",
+)
+
+def _page_cache_entry(page_image: PDFPageImage, images: list[bytes]) -> dict:
+    """
+    Describe a page for the page cache, appending its encoded images to images.
+
+    The metadata refers to the page's image, its signature thumbnail (as a
+    PNG) and its tiles' images by their index in images.
+    """
+    metadata = {name: getattr(page_image, name) for name in _CACHED_PAGE_FIELDS}
+    metadata["data"] = len(images)
+    images.append(page_image.data)
+    signature = page_image.signature
+    if signature is not None:
+        _, thumbnail = cv2.imencode(".png", signature.thumbnail)
+        metadata["signature"] = {
+            "ink_coverage": signature.ink_coverage,
+            "intensity_std": signature.intensity_std,
+            "phash": signature.phash,
+            "text_digest": signature.text_digest,
+            "thumbnail": len(images),
+        }
+        images.append(thumbnail.tobytes())
+    metadata["tiles"] = [_page_cache_entry(tile, images) for tile in page_image.tiles]
+    return metadata
+
+def _page_from_cache_entry(metadata: dict, images: list[bytes]) -> PDFPageImage:
+    """Rebuild a page from its page cache metadata and images (see _page_cache_entry)."""
+    signature = None
+    if metadata.get("signature") is not None:
+        fields = dict(metadata["signature"])
+        thumbnail = np.frombuffer(images[fields.pop("thumbnail")], dtype=np.uint8)
+        signature = PageSignature(**fields, thumbnail=cv2.imdecode(thumbnail, cv2.IMREAD_GRAYSCALE))
+    return PDFPageImage(
+        data=images[metadata["data"]],
+        signature=signature,
+        tiles=[_page_from_cache_entry(tile, images) for tile in metadata["tiles"]],
+        **{name: metadata[name] for name in _CACHED_PAGE_FIELDS},
+    )
+
+def _get_cached_page(cache: PageCache, key: str, page_num: int) -> Optional[PDFPageImage]:
+    entry = cache.get_page(key, page_num)
+    if entry is None:
+        return None
+    try:
+        return _page_from_cache_entry(*entry)
+    except Exception as e:
+        print(f"Discarding malformed cached page {page_num} of {key[:12]}: {str(e)}", file=sys.stderr)
+        return None
+
+def _put_cached_page(cache: PageCache, key: str, page_image: PDFPageImage) -> None:
+    images: list[bytes] = []
+    metadata = _page_cache_entry(page_image, images)
+    cache.put_page(key, page_image.page_number, metadata, images)
+
+def _iter_cached_pages(
+    pdf_bytes: bytes,
+    workers: int,
+    options: RenderOptions,
+    cache: PageCache,
+    stats: Optional[RenderStats] = None,
+) -> Iterator[PDFPageImage]:
+    """
+    Serve a document's pages from the page cache, rendering and caching them on a miss.
+
+    A document only counts as cached once a render ran to completion, so a
+    partially consumed render is never mistaken for the whole document.
+    """
+    key = document_key(pdf_bytes, options)
+    page_numbers = cache.get_manifest(key)
+
+    if page_numbers is not None:
+        if stats is not None:
+            stats.page_cache = 'hit'
+        doc = None
+        try:
+            for page_num in page_numbers:
+                page_image = _get_cached_page(cache, key, page_num)
+                if page_image is not None:
+                    yield page_image
+                    continue
+                # Evicted or corrupted since the manifest was read; render just this page
+                if options.sandbox is not None:
+                    _, page_image, _ = next(iter_sandboxed_pages(
+                        pdf_bytes, [page_num], _render_planned_page, (options,), options.sandbox,
+                    ))
+                else:
+                    if doc is None:
+                        doc = fitz.Document(stream=pdf_bytes, filetype="pdf")
+                    page_image = _render_planned_page(doc[page_num], options)
+                if page_image is not None:
+                    _put_cached_page(cache, key, page_image)
+                    yield page_image
+        finally:
+            if doc is not None:
+                doc.close()
+        return
+
+    if stats is not None:
+        stats.page_cache = 'miss'
+    rendered = []
+    for page_image in _iter_rendered_pages(pdf_bytes, workers, options, stats=stats):
+        _put_cached_page(cache, key, page_image)
+        rendered.append(page_image.page_number)
+        yield page_image
+    cache.put_manifest(key, rendered)
+
+def iter_pdf_pages(
+    pdf_bytes: bytes,
+    workers: int = 1,
+    options: Optional[RenderOptions] = None,
+    stats: Optional[RenderStats] = None,
+    cache: Optional[PageCache] = None,
+) -> Iterator[PDFPageImage]:
+    """
+    Lazily render a PDF, yielding one preprocessed page image at a time in page order.
+
+    Pages that fail to render are skipped. With workers > 1 pages are rendered by
+    the shared process pool. When options.triage is set, blank and duplicate
+    pages are dropped and every decision is recorded in stats; if every page
+    would be dropped as blank, the first one is sent anyway. With a cache,
+    previously rendered pages are loaded from disk instead of re-rasterized.
+
+    Args:
+        pdf_bytes: Raw PDF file contents
+        workers: Number of render processes (1 renders in the calling thread)
+        options: Zoom, resolution budget, encoding and triage settings (default: RenderOptions())
+        stats: Optional accumulator that records size, token and triage figures per page
+        cache: Optional on-disk page cache checked before PyMuPDF is used
+    """
+    options = options or RenderOptions()
+    triage = PageTriage(options.triage) if options.triage else None
+    yielded = False
+    first_blank = None
+
+    if cache is not None:
+        rendered_pages = _iter_cached_pages(pdf_bytes, workers, options, cache, stats=stats)
+    else:
+        rendered_pages = _iter_rendered_pages(pdf_bytes, workers, options, stats=stats)
+
+    for page_image in rendered_pages:
+        if triage is not None and page_image.signature is not None:
+            decision = triage.decide(page_image.page_number, page_image.signature)
+            if stats is not None:
+                stats.record_triage(decision)
+            if decision.action != TRIAGE_KEEP:
+                print(f"Skipping page {page_image.page_number + 1}: {decision.reason}", file=sys.stderr)
+                if decision.action == TRIAGE_SKIP_BLANK and first_blank is None:
+                    first_blank = page_image
+                continue
+
+        if stats is not None:
+            stats.record(page_image)
+        yielded = True
+        yield page_image
+
+    if not yielded and first_blank is not None:
+        # An all-blank document still needs something for the model to classify
+        if stats is not None:
+            stats.record(first_blank)
+        yield first_blank
+
+def iter_image_from_pdf(
+    pdf_bytes: bytes,
+    workers: int = 1,
+    options: Optional[RenderOptions] = None,
+    stats: Optional[RenderStats] = None,
+    cache: Optional[PageCache] = None,
+) -> Iterator[ImagePayload]:
+    """
+    Lazily convert a PDF to base64 encoded images, one per successfully rendered page.
+
+    Tiled pages yield their overview followed by each table crop, captioned so
+    the model reads the crops as close-ups rather than as extra pages.
+    """
+    for page_image in iter_pdf_pages(pdf_bytes, workers=workers, options=options, stats=stats, cache=cache):
+        page_label = page_image.page_number + 1
+        yield ImagePayload(
+            data=base64.b64encode(page_image.data).decode("utf-8"),
+            media_type=page_image.media_type,
+            caption=f"Page {page_label} (reduced-resolution overview):" if page_image.tiles else None,
+            page_number=page_image.page_number,
+        )
+        for tile_number, tile in enumerate(page_image.tiles, start=1):
+            yield ImagePayload(
+                data=base64.b64encode(tile.data).decode("utf-8"),
+                media_type=tile.media_type,
+                caption=(
+                    f"Close-up {tile_number} of {len(page_image.tiles)} of a table on page {page_label}, "
+                    f"at higher resolution. It repeats content from the overview above; read line items "
+                    f"from it, but do not count them twice:"
+                ),
+                page_number=page_image.page_number,
+            )
+
+def _render_overview_page(page: fitz.Page, long_edge: int, encoding: Optional[EncodingPolicy]) -> Optional[PDFPageImage]:
+    zoom = long_edge / max(page.rect.width, page.rect.height, 1)
+    return render_pdf_page(page, zoom=zoom, encoding=encoding)
+
+def render_overview_image(
+    pdf_bytes: bytes,
+    long_edge: int,
+    encoding: Optional[EncodingPolicy] = None,
+    sandbox: Optional[SandboxPolicy] = None,
+) -> Optional[ImagePayload]:
+    """Render a small image of a PDF's first page, e.g. to accompany its text layer."""
     try:
-        images = []
         with fitz.Document(stream=pdf_bytes, filetype="pdf") as doc:
-            # Process each page
-            for page_num in range(len(doc)):
-                try:
-                    page = doc[page_num]
-                    # Extract image with higher zoom for better quality
-                    image_bytes = extract_image_page_bytes(page, zoom=3.0)
-                    
-                    # Convert to OpenCV format
-                    cv_image = bytes_to_cv2(image_bytes)
-                    if cv_image is None:
-                        print(f"Failed to decode image for page {page_num + 1}", file=sys.stderr)
-                        continue
-                        
-                    # Preprocess
-                    processed_image = preprocess_pdf_page_image(cv_image)
-                    
-                    # Verify the processed image data
-                    if not processed_image.data:
-                        print(f"Empty image data for page {page_num + 1}", file=sys.stderr)
-                        continue
-                        
-                    # Convert to base64 and add to list
-                    base64_str = base64.b64encode(processed_image.data).decode("utf-8")
-                    if base64_str:
-                        images.append(base64_str)
-                    else:
-                        print(f"Failed to encode page {page_num + 1} to base64", file=sys.stderr)
-                        
-                except Exception as page_error:
-                    print(f"Error processing page {page_num + 1}: {str(page_error)}", file=sys.stderr)
-                    continue  # Skip this page and continue with others
-                    
+            if not len(doc):
+                return None
+            if sandbox is None:
+                page_image = _render_overview_page(doc[0], long_edge, encoding)
+        if sandbox is not None:
+            _, page_image, _ = next(iter_sandboxed_pages(
+                pdf_bytes, [0], _render_overview_page, (long_edge, encoding), sandbox,
+            ))
+    except Exception as e:
+        print(f"Error rendering overview image: {str(e)}", file=sys.stderr)
+        return None
+
+    if page_image is None:
+        return None
+    return ImagePayload(
+        data=base64.b64encode(page_image.data).decode("utf-8"),
+        media_type=page_image.media_type,
+    )
+
+def shrink_image(image_bytes: bytes, long_edge: int) -> Optional[ImagePayload]:
+    """A JPEG of an uploaded image scaled down to long_edge (if larger), e.g. for classifying it."""
+    image = bytes_to_cv2(image_bytes)
+    if image is None:
+        return None
+    height, width = image.shape[:2]
+    scale = long_edge / max(height, width)
+    if scale < 1:
+        image = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+    return ImagePayload(data=base64.b64encode(cv2_to_bytes(image)).decode("utf-8"), media_type=JPEG_MEDIA_TYPE)
+
+class PageSpool:
+    """
+    Append-only store of base64 page images backed by a temporary file.
+
+    Pages are kept in memory up to max_memory_bytes and spill to disk beyond
+    that, so a document's pages can be produced up front and handed to an LLM
+    client without holding every page in RAM. Iterating reads pages back one at
+    a time; the spool can be iterated more than once (e.g. on retry), and
+    indexed, from several threads at once.
+    """
+
+    def __init__(self, max_memory_bytes: int = DEFAULT_SPOOL_MEMORY_BYTES):
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_memory_bytes)
+        self._extents: list[tuple[int, int, str, Optional[str], Optional[int]]] = []
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def append(self, image: ImageInput) -> None:
+        if isinstance(image, str):
+            image = ImagePayload(data=image)
+        data = image.data.encode("ascii")
+        with self._lock:
+            self._file.seek(self._end)
+            self._file.write(data)
+            # Published only once written, so a reader never sees a page's extent before its bytes
+            self._extents.append((self._end, len(data), image.media_type, image.caption, image.page_number))
+            self._end += len(data)
+
+    def __len__(self) -> int:
+        return len(self._extents)
+
+    def __getitem__(self, index: int) -> ImagePayload:
+        offset, length, media_type, caption, page_number = self._extents[index]
+        with self._lock:
+            self._file.seek(offset)
+            data = self._file.read(length)
+        return ImagePayload(data=data.decode("ascii"), media_type=media_type, caption=caption, page_number=page_number)
+
+    def __iter__(self) -> Iterator[ImagePayload]:
+        for index in range(len(self._extents)):
+            yield self[index]
+
+    def layout(self) -> list[tuple[Optional[int], int]]:
+        """(page number, size in bytes) of every spooled image, without reading them back."""
+        return [(page_number, length) for _, length, _, _, page_number in self._extents]
+
+    @property
+    def size_bytes(self) -> int:
+        return self._end
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "PageSpool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def spool_image_from_pdf(
+    pdf_bytes: bytes,
+    workers: int = 1,
+    options: Optional[RenderOptions] = None,
+    stats: Optional[RenderStats] = None,
+    max_memory_bytes: int = DEFAULT_SPOOL_MEMORY_BYTES,
+    cache: Optional[PageCache] = None,
+) -> Optional[PageSpool]:
+    """
+    Render a PDF into a PageSpool. Only one rendered page is held in memory at
+    a time, regardless of document length.
+
+    Returns:
+        The spool (caller must close it), or None if nothing could be rendered
+    """
+    spool = PageSpool(max_memory_bytes=max_memory_bytes)
+    try:
+        for image in iter_image_from_pdf(pdf_bytes, workers=workers, options=options, stats=stats, cache=cache):
+            spool.append(image)
+    except Exception as e:
+        print(f"Error processing PDF: {str(e)}", file=sys.stderr)
+        spool.close()
+        return None
+
+    if not len(spool):
+        print("No valid images were extracted from the PDF", file=sys.stderr)
+        spool.close()
+        return None
+
+    print(f"Successfully processed {len(spool)} pages from PDF ({spool.size_bytes} bytes spooled)", file=sys.stderr)
+    return spool
+
+def get_image_from_pdf(
+    pdf_bytes: bytes,
+    workers: int = 1,
+    options: Optional[RenderOptions] = None,
+    stats: Optional[RenderStats] = None,
+    cache: Optional[PageCache] = None,
+) -> Optional[list[ImagePayload]]:
+    """
+    Convert PDF to list of base64 encoded images, one per page.
+
+    Prefer iter_image_from_pdf or spool_image_from_pdf for long documents; this
+    keeps every page in memory at once.
+
+    Args:
+        pdf_bytes: Raw PDF file contents
+        workers: Number of render processes. 1 (the default) renders sequentially
+            in the calling thread; larger values use the shared process pool.
+        options: Zoom, resolution budget and encoding settings (default: RenderOptions())
+        stats: Optional accumulator that records size and token figures per page
+        cache: Optional on-disk page cache; cached pages skip PyMuPDF entirely
+
+    Returns:
+        Base64 encoded image per page in page order, or None if nothing could be rendered
+    """
+    try:
+        images = list(iter_image_from_pdf(pdf_bytes, workers=workers, options=options, stats=stats, cache=cache))
+
         if not images:
             print("No valid images were extracted from the PDF", file=sys.stderr)
             return None
-            
+
         print(f"Successfully processed {len(images)} pages from PDF", file=sys.stderr)
         return images
-        
+
     except Exception as e:
         print(f"Error processing PDF: {str(e)}", file=sys.stderr)
-        return None 
\ No newline at end of file
+        return None
@@ -0,0 +1,169 @@
+"""
+Incremental JSON Parsing
+
+This module parses the model's JSON answer while it is still being generated,
+so callers can act on each invoice (and on key fields such as its PO number) as
+soon as the model has written it, instead of waiting for the whole completion.
+
+The parser:
+1. Is fed text chunks as they stream in, and scans each character once
+2. Skips any text before the first '{' or '[' and after the document ends
+3. Reports every value (scalar, object or array) up to max_depth the moment it
+   is complete, with its path from the root, e.g. ('invoices', 0, 'po_number')
+
+ExtractionEvents and invoice_stream_parser turn those values into the events
+the extraction pipeline cares about: a key field of an invoice, and a whole
+invoice.
+"""
+
+import json
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+# Invoice fields reported as soon as they are written
+KEY_FIELDS = ('number', 'po_number', 'vendor', 'amount', 'currency_code')
+
+_WHITESPACE = ' \t\r\n'
+
+
+@dataclass
+class _Frame:
+    """An object or array being parsed, and the key or index of its current value."""
+    kind: str
+    start: int
+    key: Any = None
+    expecting_key: bool = False
+
+
+class IncrementalJSONParser:
+    """
+    Parse one JSON document from chunks, reporting values as they complete.
+
+    on_value(path, value) is called for every completed value whose path is at
+    most max_depth long (the root's path is empty); deeper values are only
+    parsed as part of their enclosing value.
+    """
+
+    def __init__(self, on_value: Callable[[tuple, Any], None], max_depth: int = 3):
+        self.on_value = on_value
+        self.max_depth = max_depth
+        self.buffer = ''
+        self.done = False
+        self._position = 0
+        self._frames: list[_Frame] = []
+        self._started = False
+        self._string_start: Optional[int] = None
+        self._string_is_key = False
+        self._escaped = False
+        self._scalar_start: Optional[int] = None
+
+    def feed(self, chunk: str) -> None:
+        """Parse the next chunk of the document."""
+        if self.done:
+            return
+        self.buffer += chunk
+        buffer = self.buffer
+        while self._position < len(buffer) and not self.done:
+            index = self._position
+            self._position += 1
+            char = buffer[index]
+
+            if self._string_start is not None:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    start, self._string_start = self._string_start, None
+                    if self._string_is_key:
+                        self._frames[-1].key = json.loads(buffer[start:index + 1])
+                    else:
+                        self._complete(start, index + 1)
+                continue
+
+            if self._scalar_start is not None:
+                if char not in _WHITESPACE and char not in ',]}':
+                    continue
+                start, self._scalar_start = self._scalar_start, None
+                self._complete(start, index)
+                if self.done:
+                    return
+
+            if not self._started:
+                if char not in '{[':
+                    continue
+                self._started = True
+
+            if char in '{[':
+                kind = 'object' if char == '{' else 'array'
+                self._frames.append(_Frame(kind, index, key=0 if kind == 'array' else None, expecting_key=kind == 'object'))
+            elif char in '}]':
+                frame = self._frames.pop()
+                self._complete(frame.start, index + 1)
+            elif char == '"':
+                self._string_start = index
+                self._string_is_key = bool(self._frames) and self._frames[-1].expecting_key
+            elif char == ':':
+                self._frames[-1].expecting_key = False
+            elif char == ',':
+                frame = self._frames[-1]
+                if frame.kind == 'object':
+                    frame.expecting_key = True
+                else:
+                    frame.key += 1
+            elif char not in _WHITESPACE:
+                self._scalar_start = index
+
+    def _complete(self, start: int, end: int) -> None:
+        """Report the value buffer[start:end], which sits inside the open frames."""
+        if not self._frames:
+            self.done = True
+        if len(self._frames) <= self.max_depth:
+            path = tuple(frame.key for frame in self._frames)
+            self.on_value(path, json.loads(self.buffer[start:end]))
+
+
+@dataclass
+class ExtractionEvents:
+    """
+    Callbacks for an extraction streamed from the model.
+
+    Attributes:
+        on_field: Called with (invoice index, field, value) once one of fields
+            of an invoice has been written; values are as the model wrote them
+        on_invoice: Called with (invoice index, invoice) once an invoice,
+            including its line items, has been written
+        fields: Invoice fields reported to on_field
+    """
+    on_field: Optional[Callable[[int, str, Any], None]] = None
+    on_invoice: Optional[Callable[[int, dict], None]] = None
+    fields: tuple = KEY_FIELDS
+
+
+def output_started(parser: Optional[IncrementalJSONParser]) -> Callable[[], bool]:
+    """
+    A check of whether a streamed answer has started reaching the parser since
+    now; a call that fails after that can't be replayed into the same parser.
+    """
+    fed = len(parser.buffer) if parser is not None else 0
+    return lambda: parser is not None and len(parser.buffer) > fed
+
+
+def invoice_stream_parser(events: ExtractionEvents, normalize: Optional[Callable[[dict], dict]] = None) -> IncrementalJSONParser:
+    """
+    A parser of the extraction answer that reports events for its invoices.
+
+    Args:
+        events: Callbacks to report to
+        normalize: Applied to each invoice before on_invoice, e.g. the client's
+            numeric parsing
+    """
+    def on_value(path: tuple, value: Any) -> None:
+        if len(path) < 2 or path[0] != 'invoices' or not isinstance(path[1], int):
+            return
+        if len(path) == 3 and path[2] in events.fields and events.on_field is not None:
+            events.on_field(path[1], path[2], value)
+        elif len(path) == 2 and isinstance(value, dict) and events.on_invoice is not None:
+            events.on_invoice(path[1], normalize(value) if normalize else value)
+
+    return IncrementalJSONParser(on_value, max_depth=3)
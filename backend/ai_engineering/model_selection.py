@@ -0,0 +1,118 @@
+"""
+Model Selection
+
+This module picks the model tier and output budget of each extraction from
+how complex the document looks, so a one-page invoice with a few line items
+is read by a small, fast model and only long, dense or table-heavy documents
+(multi-page statements, invoices with dozens of lines) go to the large one.
+
+The selector:
+1. Takes three signals known before any LLM call: the page count, the text
+   layer's density (characters per page, when the PDF has a trustworthy text
+   layer) and the number of table lines (text rows inside the pages' table
+   regions, counted by the image processor, or the amount-carrying lines of
+   the text layer)
+2. Rates the document simple only when its table lines were counted (a
+   positive count) and every known signal is within its threshold; a
+   document without table lines found, e.g. a scan whose table has no
+   rulings for the image processor to find, is treated as complex
+3. Picks the fast tier for simple documents and the standard tier for complex
+   ones, and sizes the output budget from the table lines (see
+   structured_output.output_budget), capped at the fast model's output limit
+
+The decision, with the signals and the thresholds they exceeded, is recorded
+on the extraction job so the thresholds can be tuned against the results.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from .structured_output import OutputPolicy, expected_line_items, output_budget
+
+FAST = 'fast'
+STANDARD = 'standard'
+
+
+@dataclass(frozen=True)
+class SelectionPolicy:
+    """
+    Thresholds under which a document is simple enough for the fast tier.
+
+    Attributes:
+        simple_max_pages: Most pages of a simple document
+        simple_max_chars_per_page: Densest text layer of a simple document
+        simple_max_table_lines: Most table lines of a simple document
+        fast_max_tokens: Output limit of the fast tier's model
+    """
+    simple_max_pages: int = 2
+    simple_max_chars_per_page: int = 4000
+    simple_max_table_lines: int = 20
+    fast_max_tokens: int = 4096
+
+
+@dataclass(frozen=True)
+class DocumentComplexity:
+    """
+    The signals a document's model is chosen from; None when a signal isn't known.
+
+    Attributes:
+        page_count: Pages sent to the model
+        chars_per_page: Characters per page of the text layer
+        table_lines: Text rows in the pages' table regions (or amount lines of the text)
+    """
+    page_count: int
+    chars_per_page: Optional[float] = None
+    table_lines: Optional[int] = None
+
+
+@dataclass(frozen=True)
+class ModelSelection:
+    """The chosen tier and output budget, and why (the signals that rule out the fast tier)."""
+    tier: str
+    max_tokens: int
+    complexity: DocumentComplexity
+    exceeded: Tuple[str, ...] = ()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'tier': self.tier,
+            'max_tokens': self.max_tokens,
+            'page_count': self.complexity.page_count,
+            'chars_per_page': None if self.complexity.chars_per_page is None else round(self.complexity.chars_per_page),
+            'table_lines': self.complexity.table_lines,
+            'exceeded': list(self.exceeded),
+        }
+
+
+def text_complexity(page_count: int, char_count: int, document_text: str) -> DocumentComplexity:
+    """The complexity of a document read from its text layer; table lines are its amount-carrying lines."""
+    return DocumentComplexity(
+        page_count=page_count,
+        chars_per_page=char_count / max(1, page_count),
+        table_lines=expected_line_items(page_count, document_text, OutputPolicy()),
+    )
+
+
+def select_model(
+    complexity: DocumentComplexity,
+    policy: Optional[SelectionPolicy] = None,
+    output_policy: Optional[OutputPolicy] = None,
+) -> ModelSelection:
+    """Choose the model tier and output budget for a document of the given complexity."""
+    policy = policy or SelectionPolicy()
+    exceeded = []
+    if complexity.page_count > policy.simple_max_pages:
+        exceeded.append('pages')
+    if complexity.chars_per_page is not None and complexity.chars_per_page > policy.simple_max_chars_per_page:
+        exceeded.append('chars_per_page')
+    if not complexity.table_lines:
+        # Nothing says the document is short; a table may just not have been found
+        exceeded.append('table_lines_unknown')
+    elif complexity.table_lines > policy.simple_max_table_lines:
+        exceeded.append('table_lines')
+
+    # A document whose table lines weren't counted (or found) gets a budget estimated from its pages
+    max_tokens = output_budget(complexity.page_count, policy=output_policy, line_items=complexity.table_lines or None)
+    if exceeded:
+        return ModelSelection(STANDARD, max_tokens, complexity, tuple(exceeded))
+    return ModelSelection(FAST, min(max_tokens, policy.fast_max_tokens), complexity)
@@ -0,0 +1,239 @@
+"""
+Rendered Page Cache
+
+This module keeps rendered PDF pages on disk so that re-processing the same
+upload (retries, re-runs with a different match threshold, support re-running
+a job) does not rasterize it again.
+
+The cache:
+1. Keys every document by the SHA-256 of its bytes plus a digest of the render
+   settings, so changing zoom, encoding or preprocessing never serves stale images
+2. Stores each page as its encoded images (the page, and whatever images its
+   metadata refers to) plus a JSON metadata file, never as pickled objects, so
+   a cache directory anyone can write to can't run code in the workers; a
+   manifest written once every page is in lists the pages a complete render
+   produced
+3. Bounds its total size, evicting the least recently used documents first
+4. Counts hits, misses, writes and evictions for monitoring
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from dataclasses import asdict, is_dataclass
+from typing import Any, Optional, Sequence
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+def document_key(pdf_bytes: bytes, options: Any = None) -> str:
+    """
+    Build the cache key for a document rendered with the given options.
+
+    Options are digested from their dataclass fields, so any setting that can
+    change the output image also changes the key.
+    """
+    digest = hashlib.sha256(pdf_bytes).hexdigest()
+    if options is None:
+        return digest
+    fields = asdict(options) if is_dataclass(options) else options
+    options_digest = hashlib.sha256(
+        json.dumps(fields, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()[:16]
+    return f"{digest}-{options_digest}"
+
+
+class PageCache:
+    """
+    Size-bounded, least recently used on-disk cache of rendered pages.
+
+    Pages are written atomically (temp file then rename), so concurrent
+    workers and processes sharing a directory never read partial entries. The
+    recency of a document is its directory's modification time, refreshed on
+    every hit.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._size_bytes: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _document_dir(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _write_atomic(self, path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def get_manifest(self, key: str) -> Optional[list[int]]:
+        """Return the page numbers of a completely cached document, or None on a miss."""
+        document_dir = self._document_dir(key)
+        try:
+            with open(os.path.join(document_dir, MANIFEST_FILENAME), "r") as manifest_file:
+                page_numbers = json.load(manifest_file)["pages"]
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        try:
+            os.utime(document_dir)
+        except OSError:
+            pass
+        return page_numbers
+
+    def get_page(self, key: str, page_number: int) -> Optional[tuple[dict, list[bytes]]]:
+        """Load one cached page as its metadata and images, or None if it is missing or unreadable."""
+        document_dir = self._document_dir(key)
+        try:
+            with open(os.path.join(document_dir, f"{page_number}.json"), "r") as metadata_file:
+                entry = json.load(metadata_file)
+            images = []
+            for index in range(entry["images"]):
+                with open(os.path.join(document_dir, f"{page_number}.{index}.img"), "rb") as image_file:
+                    images.append(image_file.read())
+            return entry["page"], images
+        except Exception as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"Discarding unreadable cached page {page_number} of {key[:12]}: {str(e)}", file=sys.stderr)
+            return None
+
+    def put_page(self, key: str, page_number: int, metadata: dict, images: Sequence[bytes]) -> None:
+        """
+        Store one rendered page as its JSON-serializable metadata and encoded images.
+
+        The metadata is written last, so a page is only ever read once all of
+        its images are in. Failures are logged and otherwise ignored.
+        """
+        document_dir = self._document_dir(key)
+        try:
+            for index, image in enumerate(images):
+                self._write_atomic(os.path.join(document_dir, f"{page_number}.{index}.img"), image)
+            entry = json.dumps({"images": len(images), "page": metadata}).encode("utf-8")
+            self._write_atomic(os.path.join(document_dir, f"{page_number}.json"), entry)
+            with self._lock:
+                self.writes += 1
+            self._grow(len(entry) + sum(len(image) for image in images), keep=document_dir)
+        except Exception as e:
+            print(f"Failed to cache page {page_number} of {key[:12]}: {str(e)}", file=sys.stderr)
+
+    def put_manifest(self, key: str, page_numbers: list[int]) -> None:
+        """Mark a document as completely cached with the pages it rendered to."""
+        try:
+            self._write_atomic(
+                os.path.join(self._document_dir(key), MANIFEST_FILENAME),
+                json.dumps({"pages": page_numbers}).encode("utf-8"),
+            )
+        except OSError as e:
+            print(f"Failed to write page cache manifest for {key[:12]}: {str(e)}", file=sys.stderr)
+
+    def _scan(self) -> list[tuple[float, int, str]]:
+        """
+        List cached documents as (last used, size in bytes, path).
+
+        Other processes evict (and write) documents while this runs, so entries
+        that vanish mid-scan are skipped rather than failing it.
+        """
+        documents = []
+        try:
+            shards = list(os.scandir(self.directory))
+        except OSError:
+            return documents
+        for shard in shards:
+            try:
+                if not shard.is_dir():
+                    continue
+                shard_documents = list(os.scandir(shard.path))
+            except OSError:
+                continue
+            for document in shard_documents:
+                try:
+                    if not document.is_dir():
+                        continue
+                    documents.append((document.stat().st_mtime, self._size(document.path), document.path))
+                except OSError:
+                    continue
+        return documents
+
+    @staticmethod
+    def _size(path: str) -> int:
+        """Bytes of the files in a document directory, skipping any deleted while counting."""
+        size = 0
+        for entry in os.scandir(path):
+            try:
+                if entry.is_file():
+                    size += entry.stat().st_size
+            except OSError:
+                continue
+        return size
+
+    def _grow(self, added_bytes: int, keep: str) -> None:
+        with self._lock:
+            if self._size_bytes is None:
+                self._size_bytes = sum(size for _, size, _ in self._scan())
+            else:
+                self._size_bytes += added_bytes
+            if self._size_bytes > self.max_bytes:
+                self._evict(keep)
+
+    def _evict(self, keep: str) -> None:
+        """
+        Delete least recently used documents until the cache is back under 90% of its bound.
+
+        The document being written (keep) is never evicted, even if it alone exceeds the bound.
+        """
+        # Other processes write to the same directory, so re-measure from disk
+        documents = sorted(self._scan())
+        size_bytes = sum(size for _, size, _ in documents)
+        target = int(self.max_bytes * 0.9)
+        for _, size, path in documents:
+            if size_bytes <= target:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            size_bytes -= size
+            self.evictions += 1
+        self._size_bytes = size_bytes
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+
+_page_caches: dict[str, PageCache] = {}
+_page_caches_lock = threading.Lock()
+
+
+def get_page_cache(directory: str, max_bytes: int) -> PageCache:
+    """Return the process-wide cache for a directory, so its counters accumulate across jobs."""
+    with _page_caches_lock:
+        cache = _page_caches.get(directory)
+        if cache is None:
+            cache = PageCache(directory, max_bytes)
+            _page_caches[directory] = cache
+        cache.max_bytes = max_bytes
+        return cache
@@ -0,0 +1,96 @@
+"""
+Prompt Caching
+
+This module lets the LLM clients mark the static start of a request (the
+extraction instructions, the assignment rules) as cacheable, so repeated
+requests read it from the provider's prompt cache at a fraction of the input
+token price and latency instead of processing it again.
+
+The helpers:
+1. cached_text_block builds a text content block carrying a cache_control
+   breakpoint; everything up to and including the block is cached
+2. usage_from_response reads a response's token counts, including the cache
+   read and cache write counts, from an SDK response or a raw Bedrock body
+3. combine_usage adds up the usage of several calls (windows, segments) into
+   one total for the job
+4. usage_cost prices a usage by its model's per-token prices
+
+A prefix is only cached once it reaches the model's minimum (1024 tokens for
+Claude 3.5 Sonnet); shorter prefixes are processed as usual, at no extra cost.
+"""
+
+import sys
+from typing import Any, Iterable, Optional
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+USAGE_FIELDS = ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens')
+
+# USD per million tokens of each usage field, by model family (Anthropic and Bedrock on-demand prices)
+MODEL_PRICES = {
+    'sonnet': {'input_tokens': 3.00, 'output_tokens': 15.00, 'cache_read_input_tokens': 0.30, 'cache_creation_input_tokens': 3.75},
+    'haiku': {'input_tokens': 0.25, 'output_tokens': 1.25, 'cache_read_input_tokens': 0.03, 'cache_creation_input_tokens': 0.30},
+}
+
+
+def cached_text_block(text: str, cache: bool = True) -> dict:
+    """A text content block that ends a cacheable prefix (a plain block if cache is False)."""
+    block = {"type": "text", "text": text}
+    if cache:
+        block["cache_control"] = CACHE_CONTROL
+    return block
+
+
+def usage_from_response(usage: Any) -> dict:
+    """
+    Token counts of one call, from the SDK's usage object or a Bedrock body's
+    usage dict (or of several, from a combine_usage total).
+
+    Counts the provider leaves out (e.g. cache counts when caching is off) are 0.
+    """
+    if usage is None:
+        return {**{field: 0 for field in USAGE_FIELDS}, 'calls': 1}
+    if isinstance(usage, dict):
+        return {**{field: usage.get(field) or 0 for field in USAGE_FIELDS}, 'calls': usage.get('calls', 1)}
+    return {**{field: getattr(usage, field, None) or 0 for field in USAGE_FIELDS}, 'calls': 1}
+
+
+def log_usage(provider: str, usage: dict) -> None:
+    print(
+        f"{provider} usage: {usage['input_tokens']} input, {usage['cache_read_input_tokens']} cache read, "
+        f"{usage['cache_creation_input_tokens']} cache write, {usage['output_tokens']} output tokens",
+        file=sys.stderr,
+    )
+
+
+def combine_usage(usages: Iterable[Optional[dict]]) -> Optional[dict]:
+    """
+    Sum the usage of several calls, with the number of calls; None if none reported any.
+
+    The total keeps the calls' model if they all used the same one.
+    """
+    total = {field: 0 for field in USAGE_FIELDS}
+    calls = 0
+    models = set()
+    for usage in usages:
+        if not usage:
+            continue
+        for field in USAGE_FIELDS:
+            total[field] += usage.get(field) or 0
+        calls += usage.get('calls', 1)
+        models.add(usage.get('model'))
+    if not calls:
+        return None
+    total['calls'] = calls
+    if len(models) == 1 and None not in models:
+        total['model'] = models.pop()
+    return total
+
+
+def usage_cost(usage: Optional[dict]) -> Optional[float]:
+    """The price in USD of a usage, or None if its model (or its price) isn't known."""
+    model = (usage or {}).get('model') or ''
+    prices = next((prices for family, prices in MODEL_PRICES.items() if family in model), None)
+    if prices is None:
+        return None
+    return round(sum(usage.get(field, 0) * price for field, price in prices.items()) / 1_000_000, 6)
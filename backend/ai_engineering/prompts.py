@@ -1,6 +1,6 @@
 INVOICE_EXTRACTION_PROMPT = """These images are pages from a document sent to an accounts payable inbox. 
 Your job is to identify the type of document and extract details for a number of different fields 
-if the document is an invoice, credit note, or a reminder document, and return those in JSON format. 
+if the document is an invoice, credit note, or a reminder document, and record them with the record_invoices tool. 
 Before extracting any information, you need to classify the document to one of the following types:
 # invoice: If the any of the images contain an invoice then return 'invoice'
 # statement: If the document is a statement, then return 'statement'
@@ -57,13 +57,13 @@ then return the number of days as a string (e.g. "30 days" or "55 days"). If no
 If no explicit payment method is specified but bank details are present (e.g. account number + sort code, IBAN, routing number), 
 assume it's a "Bank Transfer" and return that. If no payment method or bank details are found, return an empty string.
 
-Your response should be formatted in JSON format, with two keys in a dictionary: 
+Record your answer by calling the record_invoices tool, whose input has two keys: 
 "document_type" and "invoices". 
 "document_type" should contain your classification of the document, and "invoices" should be a list of 
 dictionaries containing invoice details for every extracted invoice. 
 Remember, if the document is not classified as 'invoice', 'reminder', or 'credit_note', "invoices" must be an empty list.
 
-Here is an example output format for a document classified as 'invoice' containing one invoice with line items:
+Here is an example of the tool's input for a document classified as 'invoice' containing one invoice with line items:
 {
     "document_type": "invoice",
     "invoices": [{
@@ -88,4 +88,27 @@ Here is an example output format for a document classified as 'invoice' containi
     }]
 }
 
-Once again, make sure to return your answers in JSON format and do not return any other text in your answer.""" 
\ No newline at end of file
+Once again, make sure to record your answers with a single call to the record_invoices tool.""" 
+
+TEXT_LAYER_PROMPT_PREFIX = """The document has been sent as text instead of page images: it is the text layer of a 
+digitally generated PDF, laid out in monospaced columns that mirror the printed page. Words on the same printed 
+line share a line of text and table columns stay aligned. Pages are separated by "=== Page N ===" markers. 
+Any image that follows the text is a low-resolution view of the first page, for logos and overall layout only; 
+take all values from the text. Wherever the instructions below refer to images, apply them to this text.
+
+"""
+
+INVOICE_TEXT_EXTRACTION_PROMPT = TEXT_LAYER_PROMPT_PREFIX + INVOICE_EXTRACTION_PROMPT
+
+DOCUMENT_CLASSIFICATION_PROMPT = """This is the first page of a document sent to an accounts payable inbox, as a 
+low-resolution image and/or its text. Classify the document as one of the following types:
+# invoice: If the page contains an invoice
+# statement: If the document is a statement of account
+# reminder: If the document is marked as a reminder, or is a reminder letter, list of open/pending invoices, 
+or aging report
+# credit_note: If the document is a credit note
+# purchase_order: If the document is a purchase order
+# remittance_advice: If the document is a remittance advice
+# other: If the document is none of the above
+
+Record the type, and how confident you are in it (0 to 1), with the record_document_type tool."""
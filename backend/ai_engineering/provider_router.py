@@ -0,0 +1,330 @@
+"""
+LLM Provider Routing
+
+This module picks which configured provider (Anthropic or Bedrock) serves each
+extraction, from how fast and how reliably each has answered lately, instead
+of always using the first one configured.
+
+The router:
+1. Keeps an exponentially weighted moving average (EWMA) of each provider's
+   latency, its recent latencies for percentiles, and its successes and
+   failures over a sliding time window
+2. Ranks providers: healthy ones (error rate within the limit) by EWMA
+   latency, with providers not tried yet first so every provider gets
+   measured; unhealthy ones, and those whose circuit is open, last
+3. Sends the call to the first provider and fails over to the next when it
+   returns nothing or raises
+4. Optionally hedges: if the first provider hasn't answered by its own
+   latency percentile (e.g. p95), the same call is also sent to the second
+   provider and whichever answers first wins. The slower call still runs to
+   completion (and is billed); its latency feeds the statistics. It is
+   abandoned: attempt_abandoned() tells its callbacks to stay quiet, and the
+   call's inputs are only released once it has finished
+
+Statistics are per process; each worker learns from its own calls.
+"""
+
+import sys
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+from .circuit_breaker import get_circuit_breaker
+
+
+@dataclass(frozen=True)
+class RouterPolicy:
+    """
+    How providers are ranked and when calls are hedged.
+
+    Attributes:
+        ewma_alpha: Weight of the newest latency in the moving average
+        error_window_seconds: Outcomes older than this no longer count towards
+            the error rate, so a provider that failed recovers once retried
+        max_error_rate: Providers failing more often than this are unhealthy
+        min_samples: Outcomes (or latencies) needed before a provider's error
+            rate (or latency percentile) is trusted
+        latency_samples: Recent latencies kept per provider for percentiles
+        hedging: Send a second, hedged request when the first is slow
+        hedge_percentile: Latency percentile of the first provider after which
+            the hedged request is sent
+    """
+    ewma_alpha: float = 0.3
+    error_window_seconds: float = 300.0
+    max_error_rate: float = 0.5
+    min_samples: int = 5
+    latency_samples: int = 100
+    hedging: bool = False
+    hedge_percentile: float = 95.0
+
+
+@dataclass
+class ProviderStats:
+    """Recent latency and outcomes of one provider."""
+    ewma_latency: Optional[float] = None
+    latencies: Deque[float] = field(default_factory=deque)
+    outcomes: Deque[Tuple[float, bool]] = field(default_factory=deque)
+
+    def error_rate(self, now: float, policy: RouterPolicy) -> Optional[float]:
+        while self.outcomes and self.outcomes[0][0] < now - policy.error_window_seconds:
+            self.outcomes.popleft()
+        if len(self.outcomes) < policy.min_samples:
+            return None
+        return sum(1 for _, ok in self.outcomes if not ok) / len(self.outcomes)
+
+    def percentile(self, percentile: float) -> float:
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+@dataclass
+class RoutedCall:
+    """The outcome of a routed call: who answered, with what, and every attempt made."""
+    provider: Optional[str]
+    result: Any
+    attempts: List[Dict[str, Any]] = field(default_factory=list)
+    hedged: bool = False
+    # Set once the call has returned; attempts still running then were abandoned
+    settled: threading.Event = field(default_factory=threading.Event)
+    futures: List[Future] = field(default_factory=list)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'provider': self.provider, 'hedged': self.hedged, 'attempts': self.attempts}
+
+
+# The routed call of the attempt running in this context
+_current_call: ContextVar[Optional[RoutedCall]] = ContextVar('routed_call', default=None)
+
+
+def attempt_abandoned() -> bool:
+    """
+    Whether the routed attempt running in this context was abandoned, i.e. its
+    call already returned another attempt's answer; such an attempt should no
+    longer report events or touch its caller's state.
+    """
+    routed = _current_call.get()
+    return routed is not None and routed.settled.is_set()
+
+
+class ProviderRouter:
+    """Routes calls across providers by recent latency and health."""
+
+    def __init__(self, policy: Optional[RouterPolicy] = None):
+        self.policy = policy or RouterPolicy()
+        self._stats: Dict[str, ProviderStats] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, policy: RouterPolicy) -> None:
+        with self._lock:
+            self.policy = policy
+
+    def record(self, provider: str, latency: float, ok: bool) -> None:
+        """Add one call's latency and outcome to a provider's statistics."""
+        with self._lock:
+            stats = self._stats.setdefault(provider, ProviderStats())
+            stats.outcomes.append((monotonic(), ok))
+            if not ok:
+                # A fast failure says nothing about how fast answers are
+                return
+            alpha = self.policy.ewma_alpha
+            stats.ewma_latency = latency if stats.ewma_latency is None else alpha * latency + (1 - alpha) * stats.ewma_latency
+            stats.latencies.append(latency)
+            while len(stats.latencies) > self.policy.latency_samples:
+                stats.latencies.popleft()
+
+    def ranked(self, providers: Sequence[str]) -> List[str]:
+        """Providers in the order to try them; ties keep the given (preference) order."""
+        now = monotonic()
+        # Providers whose circuit is open refuse calls at once, so they come last
+        circuit_breaker = get_circuit_breaker()
+        open_circuits = {provider for provider in providers if circuit_breaker.is_open(provider)}
+        with self._lock:
+            def key(item: Tuple[int, str]) -> tuple:
+                index, provider = item
+                stats = self._stats.get(provider)
+                if provider in open_circuits:
+                    return (True, 0.0, index)
+                if stats is None:
+                    return (False, 0.0, index)
+                error_rate = stats.error_rate(now, self.policy)
+                unhealthy = error_rate is not None and error_rate > self.policy.max_error_rate
+                return (unhealthy, stats.ewma_latency or 0.0, index)
+            return [provider for _, provider in sorted(enumerate(providers), key=key)]
+
+    def hedge_delay(self, provider: str) -> Optional[float]:
+        """Seconds to wait for a provider before hedging, or None while its latencies are too few to tell."""
+        with self._lock:
+            stats = self._stats.get(provider)
+            if stats is None or len(stats.latencies) < self.policy.min_samples:
+                return None
+            return stats.percentile(self.policy.hedge_percentile)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Current statistics per provider, for logging and admin views."""
+        now = monotonic()
+        with self._lock:
+            return {
+                provider: {
+                    'ewma_latency': stats.ewma_latency,
+                    'error_rate': stats.error_rate(now, self.policy),
+                    'samples': len(stats.outcomes),
+                }
+                for provider, stats in self._stats.items()
+            }
+
+    def _attempt(self, provider: str, get_client: Callable[[], Any], function: Callable[[Any], Any], routed: RoutedCall) -> Any:
+        """Run the call on one provider, recording its latency and outcome (exceptions are re-raised)."""
+        start = monotonic()
+        error = None
+        context = _current_call.set(routed)
+        try:
+            result = function(get_client())
+        except Exception as e:
+            print(f"{provider} call failed: {str(e)}", file=sys.stderr)
+            result, error = None, e
+        finally:
+            _current_call.reset(context)
+        latency = monotonic() - start
+        # A hedged call that fails after the other one answered was abandoned;
+        # its failure may be down to that rather than the provider
+        if result or routed.result is None:
+            self.record(provider, latency, bool(result))
+        routed.attempts.append({'provider': provider, 'seconds': round(latency, 3), 'ok': bool(result)})
+        if error is not None:
+            raise error
+        return result
+
+    def call(
+        self,
+        clients: Dict[str, Callable[[], Any]],
+        function: Callable[[Any], Any],
+        release: Optional[Callable[[], None]] = None,
+    ) -> RoutedCall:
+        """
+        Run function(client) on the best provider, failing over (or hedging) to the others.
+
+        Args:
+            clients: Client getters of the configured providers, in preference order
+            function: The call; a falsy result counts as a failure
+            release: Frees the call's inputs (e.g. closes a page spool); called
+                once no attempt uses them, which for an abandoned hedged
+                attempt is after the call has returned
+
+        Returns:
+            The first truthy result and its provider, or a None result (with the
+            first provider tried) if every provider failed
+
+        Raises:
+            Exception: The last provider's exception, if every provider failed
+                and the last one raised
+        """
+        order = self.ranked(list(clients))
+        routed = RoutedCall(provider=order[0] if order else None, result=None)
+        try:
+            return self._call(clients, function, order, routed)
+        finally:
+            routed.settled.set()
+            if release is not None:
+                self._release_after_attempts(routed, release)
+
+    def _call(
+        self,
+        clients: Dict[str, Callable[[], Any]],
+        function: Callable[[Any], Any],
+        order: List[str],
+        routed: RoutedCall,
+    ) -> RoutedCall:
+        last_error = None
+
+        remaining = order
+        if self.policy.hedging and len(order) > 1:
+            result, provider, last_error = self._call_hedged(clients, order[0], order[1], function, routed)
+            if result:
+                routed.provider, routed.result = provider, result
+                return routed
+            remaining = order[2:]
+
+        for provider in remaining:
+            try:
+                result = self._attempt(provider, clients[provider], function, routed)
+            except Exception as e:
+                result, last_error = None, e
+            if result:
+                routed.provider, routed.result = provider, result
+                return routed
+            print(f"No result from {provider}; trying the next provider", file=sys.stderr)
+
+        if last_error is not None:
+            raise last_error
+        return routed
+
+    def _call_hedged(
+        self,
+        clients: Dict[str, Callable[[], Any]],
+        primary: str,
+        secondary: str,
+        function: Callable[[Any], Any],
+        routed: RoutedCall,
+    ) -> Tuple[Any, Optional[str], Optional[Exception]]:
+        """Call the primary, adding the secondary once the primary is slower than its percentile or fails."""
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="llm-hedge")
+        futures = {executor.submit(self._attempt, primary, clients[primary], function, routed): primary}
+        routed.futures.extend(futures)
+        last_error = None
+        try:
+            done, _ = wait(futures, timeout=self.hedge_delay(primary))
+            if not done:
+                print(f"{primary} slower than its p{self.policy.hedge_percentile:g}; hedging with {secondary}", file=sys.stderr)
+                routed.hedged = True
+            if not done or not self._succeeded(next(iter(done))):
+                future = executor.submit(self._attempt, secondary, clients[secondary], function, routed)
+                futures[future] = secondary
+                routed.futures.append(future)
+
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    error = future.exception()
+                    if error is not None:
+                        last_error = error
+                    elif future.result():
+                        return future.result(), futures[future], None
+            return None, None, last_error
+        finally:
+            # A losing hedged call is left to finish in the background
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def _succeeded(future) -> bool:
+        return future.exception() is None and bool(future.result())
+
+    @staticmethod
+    def _release_after_attempts(routed: RoutedCall, release: Callable[[], None]) -> None:
+        """Call release now, or once the abandoned attempts still running have finished."""
+        pending = [future for future in routed.futures if not future.done()]
+        if not pending:
+            release()
+            return
+
+        def release_when_done() -> None:
+            wait(pending)
+            release()
+        threading.Thread(target=release_when_done, name="llm-hedge-release", daemon=True).start()
+
+
+_router = ProviderRouter()
+
+
+def configure_router(policy: RouterPolicy) -> None:
+    """Set the routing policy of this process's router (its statistics are kept)."""
+    _router.configure(policy)
+
+
+def get_provider_router() -> ProviderRouter:
+    """Return this process's provider router."""
+    return _router
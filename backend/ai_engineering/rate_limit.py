@@ -0,0 +1,403 @@
+"""
+LLM Rate Limiting
+
+This module keeps every process calling an LLM provider (gunicorn workers,
+management commands such as auto_assign_invoices) within the provider's rate
+limits together, so a burst of uploads queues for capacity instead of running
+into 429s and failing.
+
+The limiter:
+1. Keeps two token buckets per provider, one of requests and one of tokens
+   per minute, in a store all processes share: Redis when configured, else a
+   lock-protected file, which covers the processes of one host
+2. Reserves one request and an estimate of the call's tokens (its prompt,
+   images and output budget) before each call, waiting until both buckets have
+   them; once the call is done, the estimate is corrected to the tokens used
+3. On a 429 (or Bedrock throttling), blocks the provider for every process
+   until its retry-after (or, without one, an exponential backoff), then
+   queues the call again, up to max_retries times; a streamed call whose
+   answer had already started is not queued again, since its output was
+   already consumed
+4. Gives up with RateLimitTimeout when a call would wait longer than
+   max_wait_seconds in all
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from time import monotonic
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; the file store only locks within the process there
+    fcntl = None
+
+# Tokens one image costs at most (Claude scales images down to about 1.15 megapixels)
+IMAGE_TOKENS = 1600
+
+# Characters per token, for estimating a prompt's tokens before sending it
+CHARS_PER_TOKEN = 4
+
+# Seconds an idle provider's bucket is kept in the store
+STATE_TTL_SECONDS = 3600
+
+_TAKE_SCRIPT = """
+local rpm, tpm, wanted = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'updated', 'blocked_until')
+local elapsed = math.max(0, now - (tonumber(state[3]) or now))
+local requests = math.min(rpm, (tonumber(state[1]) or rpm) + elapsed * rpm / 60)
+local tokens = math.min(tpm, (tonumber(state[2]) or tpm) + elapsed * tpm / 60)
+local wait = math.max(0, (tonumber(state[4]) or 0) - now, (1 - requests) * 60 / rpm, (wanted - tokens) * 60 / tpm)
+if wait <= 0 then
+    requests = requests - 1
+    tokens = tokens - wanted
+end
+redis.call('HSET', KEYS[1], 'requests', requests, 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return tostring(wait)
+"""
+
+_BLOCK_SCRIPT = """
+local time = redis.call('TIME')
+local blocked_until = tonumber(time[1]) + tonumber(time[2]) / 1000000 + tonumber(ARGV[1])
+if blocked_until > (tonumber(redis.call('HGET', KEYS[1], 'blocked_until')) or 0) then
+    redis.call('HSET', KEYS[1], 'blocked_until', blocked_until)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+"""
+
+_SETTLE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBYFLOAT', KEYS[1], 'tokens', ARGV[1])
+end
+"""
+
+
+class RateLimitTimeout(Exception):
+    """A call would have waited longer than the policy's max_wait_seconds for capacity."""
+
+
+@dataclass(frozen=True)
+class RateLimitPolicy:
+    """
+    The providers' rate limits and how calls wait for them.
+
+    Attributes:
+        enabled: Limit calls; when off, calls go straight to the provider
+        requests_per_minute: Requests per minute per provider, across all processes
+        tokens_per_minute: Input and output tokens per minute per provider
+        max_wait_seconds: Longest a call waits for capacity before giving up
+        max_retries: Times a call rejected with a 429 is queued again
+        backoff_seconds: First backoff after a 429 without retry-after; doubles
+            with each further 429 in a row
+        max_backoff_seconds: Longest backoff after a 429
+        redis_url: Redis shared by every host's processes; when empty (or
+            unreachable) the buckets live in state_dir
+        state_dir: Directory of the file store, shared by one host's processes
+    """
+    enabled: bool = True
+    requests_per_minute: int = 50
+    tokens_per_minute: int = 400_000
+    max_wait_seconds: float = 300.0
+    max_retries: int = 3
+    backoff_seconds: float = 2.0
+    max_backoff_seconds: float = 60.0
+    redis_url: str = ""
+    state_dir: str = ""
+
+
+def estimate_tokens(text_chars: int, image_count: int, max_tokens: int) -> int:
+    """Tokens a request may use: its text and images, plus its whole output budget."""
+    return text_chars // CHARS_PER_TOKEN + image_count * IMAGE_TOKENS + max_tokens
+
+
+def message_tokens(messages: Iterable[dict], max_tokens: int, system: Any = None) -> int:
+    """estimate_tokens of a Messages API request's system prompt and messages."""
+    text_chars, image_count = 0, 0
+    blocks = list(system) if isinstance(system, list) else [{"type": "text", "text": system or ""}]
+    for message in messages:
+        content = message["content"]
+        blocks.extend(content if isinstance(content, list) else [{"type": "text", "text": content}])
+    for block in blocks:
+        if block.get("type") == "image":
+            image_count += 1
+        else:
+            text_chars += len(block.get("text") or "")
+    return estimate_tokens(text_chars, image_count, max_tokens)
+
+
+def used_tokens(usage: dict) -> int:
+    """Tokens a call counted against the rate limit (cache reads don't)."""
+    return usage['input_tokens'] + usage['cache_creation_input_tokens'] + usage['output_tokens']
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """Whether an error is the provider refusing a call for its rate limit."""
+    status_code = getattr(error, "status_code", None)
+    if status_code == 429:
+        return True
+    # botocore ClientError (and EventStreamError, for throttling mid-stream)
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        code = response.get("Error", {}).get("Code", "")
+        return code in ("ThrottlingException", "throttlingException", "TooManyRequestsException")
+    return False
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds a rate-limited error asks to wait before retrying, if it says."""
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    else:
+        headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        # An HTTP date rather than seconds; fall back to the backoff
+        pass
+    return None
+
+
+def _take(state: dict, now: float, rpm: float, tpm: float, wanted: float) -> float:
+    """Refill a bucket state and take a request and wanted tokens from it; returns the seconds to wait instead."""
+    elapsed = max(0.0, now - state.get('updated', now))
+    requests = min(rpm, state.get('requests', rpm) + elapsed * rpm / 60)
+    tokens = min(tpm, state.get('tokens', tpm) + elapsed * tpm / 60)
+    wait = max(0.0, state.get('blocked_until', 0.0) - now, (1 - requests) * 60 / rpm, (wanted - tokens) * 60 / tpm)
+    if wait <= 0:
+        requests -= 1
+        tokens -= wanted
+    state.update(requests=requests, tokens=tokens, updated=now)
+    return wait
+
+
+class FileBucketStore:
+    """Buckets in JSON files, updated under an exclusive file lock, for the processes of one host."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def _update(self, provider: str, change: Callable[[dict, float], Any]) -> Any:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{provider}.json")
+        with self._lock, open(f"{path}.lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(path) as state_file:
+                    state = json.load(state_file)
+            except (OSError, ValueError):
+                state = {}
+            result = change(state, time.time())
+            with open(path, "w") as state_file:
+                json.dump(state, state_file)
+            return result
+
+    def take(self, provider: str, rpm: float, tpm: float, tokens: float) -> float:
+        return self._update(provider, lambda state, now: _take(state, now, rpm, tpm, tokens))
+
+    def block(self, provider: str, seconds: float) -> None:
+        def change(state: dict, now: float) -> None:
+            state['blocked_until'] = max(state.get('blocked_until', 0.0), now + seconds)
+        self._update(provider, change)
+
+    def settle(self, provider: str, tokens: float) -> None:
+        def change(state: dict, now: float) -> None:
+            if 'tokens' in state:
+                state['tokens'] += tokens
+        self._update(provider, change)
+
+
+class RedisBucketStore:
+    """Buckets in Redis hashes, updated by scripts on Redis's clock, for every host."""
+
+    def __init__(self, url: str):
+        import redis
+
+        self.client = redis.Redis.from_url(url, socket_timeout=5, socket_connect_timeout=5)
+        self._take = self.client.register_script(_TAKE_SCRIPT)
+        self._block = self.client.register_script(_BLOCK_SCRIPT)
+        self._settle = self.client.register_script(_SETTLE_SCRIPT)
+
+    @staticmethod
+    def _key(provider: str) -> str:
+        return f"llm-rate-limit:{provider}"
+
+    def take(self, provider: str, rpm: float, tpm: float, tokens: float) -> float:
+        return float(self._take(keys=[self._key(provider)], args=[rpm, tpm, tokens, STATE_TTL_SECONDS]))
+
+    def block(self, provider: str, seconds: float) -> None:
+        self._block(keys=[self._key(provider)], args=[seconds, STATE_TTL_SECONDS])
+
+    def settle(self, provider: str, tokens: float) -> None:
+        self._settle(keys=[self._key(provider)], args=[tokens])
+
+
+class RateLimiter:
+    """Queues calls to each provider within its shared request and token budgets."""
+
+    def __init__(self, policy: Optional[RateLimitPolicy] = None):
+        self.policy = policy or RateLimitPolicy()
+        self._consecutive_limits: dict[str, int] = {}
+        self._build_stores()
+
+    def _build_stores(self) -> None:
+        self.file_store = FileBucketStore(self.policy.state_dir or os.path.join(tempfile.gettempdir(), "llm-rate-limit"))
+        self.redis_store = None
+        if self.policy.redis_url:
+            try:
+                self.redis_store = RedisBucketStore(self.policy.redis_url)
+            except Exception as e:
+                print(f"Rate limit store unavailable, limiting per host: {str(e)}", file=sys.stderr)
+
+    def configure(self, policy: RateLimitPolicy) -> None:
+        if policy != self.policy:
+            self.policy = policy
+            self._build_stores()
+
+    def _store_call(self, operation: str, *args) -> Any:
+        """Run a store operation on Redis, or on the file store if Redis is not configured or fails."""
+        if self.redis_store is not None:
+            try:
+                return getattr(self.redis_store, operation)(*args)
+            except Exception as e:
+                print(f"Rate limit store error, limiting per host: {str(e)}", file=sys.stderr)
+        return getattr(self.file_store, operation)(*args)
+
+    def _reserve(self, provider: str, tokens: int, deadline: float) -> float:
+        """Try to reserve a call's capacity; returns 0 once reserved, else the seconds to wait first."""
+        # A call larger than the whole budget can never fit; let it through once the bucket is full
+        tokens = min(tokens, self.policy.tokens_per_minute)
+        wait = self._store_call('take', provider, self.policy.requests_per_minute, self.policy.tokens_per_minute, tokens)
+        if wait <= 0:
+            return 0.0
+        if monotonic() + wait > deadline:
+            raise RateLimitTimeout(f"{provider} rate limit: no capacity within {self.policy.max_wait_seconds:g}s")
+        print(f"{provider} rate limit reached; queueing for {wait:.1f}s", file=sys.stderr)
+        # Spread out the processes woken at the same moment
+        return wait * random.uniform(1.0, 1.1)
+
+    def acquire(self, provider: str, tokens: int) -> None:
+        """Wait until one request and tokens are available to this provider, and reserve them."""
+        deadline = monotonic() + self.policy.max_wait_seconds
+        while True:
+            wait = self._reserve(provider, tokens, deadline)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, provider: str, tokens: int) -> None:
+        """acquire, waiting on the event loop rather than blocking it."""
+        deadline = monotonic() + self.policy.max_wait_seconds
+        while True:
+            wait = self._reserve(provider, tokens, deadline)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def settle(self, provider: str, reserved: int, usage: Optional[dict]) -> None:
+        """Correct a call's reserved tokens to the tokens its usage reports."""
+        if not self.policy.enabled or usage is None:
+            return
+        self._consecutive_limits.pop(provider, None)
+        refund = min(reserved, self.policy.tokens_per_minute) - used_tokens(usage)
+        if refund:
+            self._store_call('settle', provider, refund)
+
+    def _limited(self, provider: str, reserved: int, error: Exception, attempt: int, started: bool = False) -> bool:
+        """
+        Handle a failed call: block the provider on a 429 and say whether to queue the call again.
+
+        A call throttled after its answer started streaming (started) isn't queued again.
+        """
+        if not is_rate_limited(error):
+            return False
+        if not started:
+            # The refused call used nothing
+            self._store_call('settle', provider, min(reserved, self.policy.tokens_per_minute))
+        count = self._consecutive_limits.get(provider, 0)
+        self._consecutive_limits[provider] = count + 1
+        delay = retry_after(error)
+        if delay is None:
+            delay = min(self.policy.max_backoff_seconds, self.policy.backoff_seconds * 2 ** count)
+        print(f"{provider} rate limited; pausing every caller for {delay:.1f}s", file=sys.stderr)
+        self._store_call('block', provider, delay)
+        return not started and attempt < self.policy.max_retries
+
+    def call(
+        self,
+        provider: str,
+        tokens: int,
+        function: Callable[[], Any],
+        started: Optional[Callable[[], bool]] = None,
+    ) -> Any:
+        """
+        Run function once the provider has capacity for it, queueing it again after a 429.
+
+        The caller settles the reservation with the call's usage (see settle).
+        started, if given, says whether a streamed answer has started reaching
+        its consumer; a call throttled after that is not queued again (see
+        json_stream.output_started).
+
+        Raises:
+            RateLimitTimeout: If capacity doesn't free up within max_wait_seconds
+            Exception: The call's own error, or its last 429 once max_retries are used up
+        """
+        if not self.policy.enabled:
+            return function()
+        attempt = 0
+        while True:
+            self.acquire(provider, tokens)
+            try:
+                return function()
+            except Exception as e:
+                if not self._limited(provider, tokens, e, attempt, started is not None and started()):
+                    raise
+            attempt += 1
+
+    async def call_async(
+        self,
+        provider: str,
+        tokens: int,
+        function: Callable[[], Awaitable[Any]],
+        started: Optional[Callable[[], bool]] = None,
+    ) -> Any:
+        """Async version of call, for a function returning an awaitable."""
+        if not self.policy.enabled:
+            return await function()
+        attempt = 0
+        while True:
+            await self.acquire_async(provider, tokens)
+            try:
+                return await function()
+            except Exception as e:
+                if not self._limited(provider, tokens, e, attempt, started is not None and started()):
+                    raise
+            attempt += 1
+
+
+_rate_limiter = RateLimiter()
+
+
+def configure_rate_limiter(policy: RateLimitPolicy) -> None:
+    """Set the rate limits and store of this process's limiter."""
+    _rate_limiter.configure(policy)
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Return this process's rate limiter (its buckets are shared through the store)."""
+    return _rate_limiter
@@ -0,0 +1,279 @@
+"""
+Sandboxed PDF Rendering
+
+This module renders PDF pages in isolated child processes, so a malformed or
+pathological upload (a huge vector drawing, a decompression bomb) costs one job
+a few pages instead of pinning the web worker inside MuPDF.
+
+The sandbox:
+1. Keeps a few warm child processes per worker process, each with an address
+   space limit (RLIMIT_AS) so a runaway allocation fails inside the child
+2. Sends each child the document once, then one page at a time, with a
+   wall-clock deadline per page
+3. Kills a child whose page misses its deadline or that dies, and reports the
+   page as failed so the caller can skip it; a fresh child takes its place
+4. Renders at most max_pages pages of any document
+
+Page functions run in the child, so they must be module-level (picklable) and
+take the fitz.Page as their first argument.
+"""
+
+import atexit
+import hashlib
+import multiprocessing
+import os
+import sys
+import threading
+from collections import deque
+from dataclasses import dataclass
+from multiprocessing.connection import wait
+from time import monotonic
+from typing import Any, Callable, Iterator, Optional, Sequence
+
+import cv2
+import fitz
+
+try:
+    import resource
+except ImportError:  # not available on Windows; the memory limit is skipped there
+    resource = None
+
+# Seconds a new child may take to start (importing PyMuPDF and OpenCV) before
+# its first page's deadline starts
+SANDBOX_START_TIMEOUT = 60.0
+
+PAGE_TIMED_OUT = 'timeout'
+PAGE_CRASHED = 'crashed'
+PAGE_FAILED = 'error'
+
+
+@dataclass
+class SandboxPolicy:
+    """
+    Limits applied to sandboxed page rendering.
+
+    Attributes:
+        page_timeout: Seconds a page may take (including opening the document
+            in a fresh child) before its child is killed and the page skipped
+        memory_limit_mb: Address space limit of each child in MiB; 0 disables it
+        max_pages: Pages beyond this many are not rendered at all
+    """
+    page_timeout: float = 30.0
+    memory_limit_mb: int = 2048
+    max_pages: int = 200
+
+
+@dataclass
+class PageFailure:
+    """Why a sandboxed page produced no result."""
+    page_number: int
+    reason: str
+    detail: str = ''
+
+
+def _sandbox_main(conn, memory_limit_bytes: int) -> None:
+    """Child process loop: open documents and run page functions on request."""
+    fitz.TOOLS.mupdf_display_errors(False)
+    cv2.setNumThreads(1)  # several children already run side by side
+    if memory_limit_bytes and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit_bytes, memory_limit_bytes))
+    conn.send(('ready', None))
+
+    doc, open_error = None, None
+    while True:
+        try:
+            command, payload = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        if command == 'open':
+            if doc is not None:
+                doc.close()
+            doc, open_error = None, None
+            try:
+                doc = fitz.Document(stream=payload, filetype="pdf")
+            except Exception as e:
+                open_error = f"could not open document: {str(e)}"
+        elif command == 'page':
+            function, page_number, args = payload
+            if doc is None:
+                conn.send((PAGE_FAILED, open_error or "no document open"))
+                continue
+            try:
+                conn.send(('ok', function(doc[page_number], *args)))
+            except MemoryError:
+                conn.send((PAGE_FAILED, "memory limit exceeded"))
+            except Exception as e:
+                conn.send((PAGE_FAILED, str(e)))
+
+
+class RenderSandbox:
+    """One warm child process that renders pages of the document it was last sent."""
+
+    def __init__(self, memory_limit_mb: int):
+        context = multiprocessing.get_context("spawn")
+        self.memory_limit_mb = memory_limit_mb
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_sandbox_main,
+            args=(child_conn, memory_limit_mb * 1024 * 1024),
+            name="pdf-render-sandbox",
+        )
+        self.process.start()
+        child_conn.close()
+        self.document_key: Optional[str] = None
+        self.ready = False
+
+    @property
+    def alive(self) -> bool:
+        return self.process.is_alive() and not self.conn.closed
+
+    def submit(self, document_key: str, pdf_bytes: bytes, function: Callable, page_number: int, args: tuple) -> None:
+        if self.document_key != document_key:
+            self.conn.send(('open', pdf_bytes))
+            self.document_key = document_key
+        self.conn.send(('page', (function, page_number, args)))
+
+    def kill(self) -> None:
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def close(self) -> None:
+        """Ask the child to exit; it does once the pipe closes."""
+        self.conn.close()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+_idle_sandboxes: list[RenderSandbox] = []
+_sandbox_pid: Optional[int] = None
+_sandbox_lock = threading.Lock()
+
+
+def _acquire_sandboxes(count: int, memory_limit_mb: int) -> list[RenderSandbox]:
+    """Take warm sandboxes from this process's idle list, starting new ones as needed."""
+    global _idle_sandboxes, _sandbox_pid
+    with _sandbox_lock:
+        if _sandbox_pid != os.getpid():
+            # Forked (e.g. a gunicorn worker): the idle children belong to the parent
+            _idle_sandboxes = []
+            _sandbox_pid = os.getpid()
+        sandboxes = []
+        while _idle_sandboxes and len(sandboxes) < count:
+            sandbox = _idle_sandboxes.pop()
+            if sandbox.alive and sandbox.memory_limit_mb == memory_limit_mb:
+                sandboxes.append(sandbox)
+            else:
+                sandbox.kill()
+    while len(sandboxes) < count:
+        sandboxes.append(RenderSandbox(memory_limit_mb))
+    return sandboxes
+
+
+def _release_sandbox(sandbox: RenderSandbox) -> None:
+    with _sandbox_lock:
+        if sandbox.alive and _sandbox_pid == os.getpid():
+            _idle_sandboxes.append(sandbox)
+            return
+    sandbox.kill()
+
+
+def shutdown_render_sandboxes() -> None:
+    """Stop this process's idle sandboxes."""
+    global _idle_sandboxes
+    with _sandbox_lock:
+        sandboxes = _idle_sandboxes if _sandbox_pid == os.getpid() else []
+        _idle_sandboxes = []
+    for sandbox in sandboxes:
+        sandbox.close()
+
+
+atexit.register(shutdown_render_sandboxes)
+
+
+def iter_sandboxed_pages(
+    pdf_bytes: bytes,
+    page_numbers: Sequence[int],
+    function: Callable,
+    args: tuple = (),
+    policy: Optional[SandboxPolicy] = None,
+    workers: int = 1,
+) -> Iterator[tuple[int, Any, Optional[PageFailure]]]:
+    """
+    Run function(page, *args) on each page in sandboxed children, yielding in page order.
+
+    Yields:
+        (page number, result, None) for pages that completed, and
+        (page number, None, failure) for pages that failed, timed out or
+        crashed their child
+    """
+    policy = policy or SandboxPolicy()
+    page_numbers = list(page_numbers)
+    if not page_numbers:
+        return
+    document_key = hashlib.sha256(pdf_bytes).hexdigest()
+    sandboxes = _acquire_sandboxes(max(1, min(workers, len(page_numbers))), policy.memory_limit_mb)
+    queued = deque(page_numbers)
+    in_flight: dict[RenderSandbox, tuple[int, float]] = {}
+    finished: dict[int, tuple[Any, Optional[PageFailure]]] = {}
+    next_index = 0
+
+    try:
+        while next_index < len(page_numbers):
+            # Keep every child busy, without running too far ahead of the consumer
+            for index, sandbox in enumerate(sandboxes):
+                if sandbox in in_flight or not queued:
+                    continue
+                if len(finished) >= 2 * len(sandboxes):
+                    break
+                if not sandbox.alive:
+                    sandbox.kill()
+                    sandbox = sandboxes[index] = RenderSandbox(policy.memory_limit_mb)
+                page_number = queued.popleft()
+                sandbox.submit(document_key, pdf_bytes, function, page_number, args)
+                start_allowance = 0.0 if sandbox.ready else SANDBOX_START_TIMEOUT
+                in_flight[sandbox] = (page_number, monotonic() + start_allowance + policy.page_timeout)
+
+            if in_flight:
+                timeout = max(0.0, min(deadline for _, deadline in in_flight.values()) - monotonic())
+                ready = wait([sandbox.conn for sandbox in in_flight], timeout=timeout)
+                for sandbox, (page_number, deadline) in list(in_flight.items()):
+                    if sandbox.conn in ready:
+                        try:
+                            status, value = sandbox.conn.recv()
+                        except (EOFError, OSError):
+                            sandbox.kill()
+                            status, value = PAGE_CRASHED, f"render process exited with code {sandbox.process.exitcode}"
+                        if status == 'ready':
+                            # Started up; the page's own deadline starts now
+                            sandbox.ready = True
+                            in_flight[sandbox] = (page_number, monotonic() + policy.page_timeout)
+                            continue
+                    elif monotonic() >= deadline:
+                        sandbox.kill()
+                        status, value = PAGE_TIMED_OUT, f"took longer than {policy.page_timeout:g}s"
+                    else:
+                        continue
+                    del in_flight[sandbox]
+                    if status == 'ok':
+                        finished[page_number] = (value, None)
+                    else:
+                        print(f"Sandboxed render of page {page_number + 1} failed ({status}): {value}", file=sys.stderr)
+                        finished[page_number] = (None, PageFailure(page_number, status, value))
+
+            while next_index < len(page_numbers) and page_numbers[next_index] in finished:
+                page_number = page_numbers[next_index]
+                result, failure = finished.pop(page_number)
+                next_index += 1
+                yield page_number, result, failure
+    finally:
+        # A consumer that stops early leaves pages in flight; their children are killed
+        for sandbox in sandboxes:
+            if sandbox in in_flight:
+                sandbox.kill()
+            else:
+                _release_sandbox(sandbox)
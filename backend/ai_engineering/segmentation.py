@@ -0,0 +1,257 @@
+"""
+Multi-Invoice PDF Segmentation
+
+This module splits a bundled PDF (several invoices scanned or exported into
+one file) into per-invoice page ranges, so each invoice can be extracted in
+its own, smaller LLM request instead of one request for the whole bundle.
+
+Boundaries come from cheap per-page cues, strongest first:
+1. "Page X of Y" markers: page 1 starts an invoice, later pages continue one,
+   and the page after "Y of Y" starts the next
+2. Invoice numbers in the text layer: a page whose header shows a labelled
+   invoice number ("Invoice No.", "Invoice #") different from the current
+   invoice's starts a new one. Documents listing several invoice numbers on a
+   page (statements, reminders, remittances) are never split on them
+3. Page similarity (off by default): a page without text cues whose header
+   band (letterhead) matches the first page of the current invoice starts a
+   new one, but only if the page before it shows the invoice's total. A
+   continuation page repeats the letterhead too, so similarity alone never
+   splits; scans without a text layer have no total to find and stay whole
+
+A page with no cue continues the current invoice, so documents without
+recognizable boundaries stay in one piece.
+"""
+
+import re
+import sys
+from dataclasses import dataclass
+from typing import Optional
+
+import fitz
+import numpy as np
+
+from .image_processor import hamming_distance, perceptual_hash
+from .render_sandbox import SandboxPolicy, iter_sandboxed_pages
+
+# "Page 2 of 3", "Page 2/3", "page 2 / 3"
+PAGE_OF_PATTERN = re.compile(r"\bpage\s*(\d{1,3})\s*(?:of|/)\s*(\d{1,3})\b", re.IGNORECASE)
+
+# A labelled invoice number field: "Invoice No. 123", "Invoice #: INV-0042",
+# "INVOICE\n# P215396"; the number must contain a digit
+INVOICE_NUMBER_PATTERN = re.compile(
+    r"\b(?:tax\s+)?invoice\s*(?:(?:number|num\.?|no\.?|nr\.?)\s*[:#.]?|[:#])\s*#?\s*"
+    r"([A-Z0-9][A-Z0-9\-/]*\d[A-Z0-9\-/]*)",
+    re.IGNORECASE,
+)
+
+# Any number printed after "Invoice", labelled or not, e.g. each row of a statement
+INVOICE_REFERENCE_PATTERN = re.compile(
+    r"\b(?:tax\s+)?invoice\s*(?:number|num\.?|no\.?|nr\.?|#)?\s*[:#.]?\s*#?\s*"
+    r"([A-Z0-9][A-Z0-9\-/]*\d[A-Z0-9\-/]*)",
+    re.IGNORECASE,
+)
+
+# Lines at the top of a page (in reading order) searched for its invoice number
+HEADER_LINES = 20
+
+# The closing total of an invoice: "Total Due", "Amount Payable", "Balance Due", "Grand Total"
+TOTAL_DUE_PATTERN = re.compile(
+    r"\b(?:grand\s+total|total\s+(?:due|payable|amount\s+due)|(?:amount|balance)\s+(?:due|payable))\b",
+    re.IGNORECASE,
+)
+
+# Top fraction of a page hashed for its layout: the letterhead a template repeats
+HEADER_BAND = 0.25
+
+BOUNDARY_PAGE_MARKER = 'page_marker'
+BOUNDARY_INVOICE_NUMBER = 'invoice_number'
+BOUNDARY_SIMILAR_LAYOUT = 'similar_layout'
+
+
+@dataclass
+class SegmentationPolicy:
+    """
+    How eagerly to split a document into invoices.
+
+    Attributes:
+        use_page_markers: Split on "Page 1 of N" markers
+        use_invoice_numbers: Split where the invoice number in the text layer changes
+        use_page_similarity: Split pages without text cues whose letterhead matches
+            the current invoice's first page, after a page showing a total
+        max_layout_hamming: Largest perceptual hash distance, over the header
+            band, for a page to count as another first page of the same template
+        min_invoice_number_length: Shorter matches are ignored as noise
+        sandbox: Render pages for layout hashes in sandboxed child processes
+            with these limits
+    """
+    use_page_markers: bool = True
+    use_invoice_numbers: bool = True
+    use_page_similarity: bool = False
+    max_layout_hamming: int = 6
+    min_invoice_number_length: int = 3
+    sandbox: Optional[SandboxPolicy] = None
+
+
+@dataclass
+class PageCues:
+    """Boundary evidence found on one page."""
+    page_number: int
+    page_of: Optional[tuple[int, int]] = None
+    invoice_number: Optional[str] = None
+    invoice_references: int = 0
+    has_text: bool = False
+    shows_total: bool = False
+    layout_hash: Optional[int] = None
+
+
+@dataclass
+class Segment:
+    """A run of consecutive pages holding one invoice (0-based, end exclusive)."""
+    start: int
+    end: int
+    reason: str = ''
+    invoice_number: Optional[str] = None
+
+    @property
+    def page_count(self) -> int:
+        return self.end - self.start
+
+
+def find_page_of(text: str) -> Optional[tuple[int, int]]:
+    """Return (page, total) from the first plausible "Page X of Y" marker in a page's text."""
+    for match in PAGE_OF_PATTERN.finditer(text):
+        page, total = int(match.group(1)), int(match.group(2))
+        if 1 <= page <= total:
+            return page, total
+    return None
+
+
+def find_invoice_number(text: str, min_length: int = 3) -> Optional[str]:
+    """Return the invoice number of a labelled field in the page's header, upper-cased."""
+    header = "\n".join(line for line in text.splitlines() if line.strip())
+    header = "\n".join(header.splitlines()[:HEADER_LINES])
+    for match in INVOICE_NUMBER_PATTERN.finditer(header):
+        number = match.group(1).strip("-/").upper()
+        if len(number) >= min_length:
+            return number
+    return None
+
+
+def count_invoice_references(text: str, min_length: int = 3) -> int:
+    """Count the distinct invoice numbers printed anywhere on a page, labelled or not."""
+    numbers = {match.group(1).strip("-/").upper() for match in INVOICE_REFERENCE_PATTERN.finditer(text)}
+    return sum(1 for number in numbers if len(number) >= min_length)
+
+
+def _layout_hash(page: fitz.Page) -> int:
+    """Perceptual hash of a low-resolution grayscale render of the page's header band."""
+    rect = page.rect
+    zoom = 256 / max(rect.width, 1.0)
+    header = fitz.Rect(rect.x0, rect.y0, rect.x1, rect.y0 + rect.height * HEADER_BAND)
+    pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False, clip=header)
+    gray = np.frombuffer(pixmap.samples, np.uint8).reshape(pixmap.height, pixmap.stride)[:, :pixmap.width]
+    return perceptual_hash(gray)
+
+
+def collect_page_cues(doc: fitz.Document, policy: SegmentationPolicy) -> list[PageCues]:
+    """Gather boundary cues for every page of a document."""
+    cues = []
+    for page in doc:
+        # Reading order, so a label and its value stay adjacent whatever order they were drawn in
+        text = page.get_text(sort=True)
+        page_cues = PageCues(page_number=page.number, has_text=bool(text.strip()))
+        if policy.use_page_markers:
+            page_cues.page_of = find_page_of(text)
+        if policy.use_invoice_numbers:
+            page_cues.invoice_number = find_invoice_number(text, policy.min_invoice_number_length)
+            page_cues.invoice_references = count_invoice_references(text, policy.min_invoice_number_length)
+        if policy.use_page_similarity:
+            page_cues.shows_total = bool(TOTAL_DUE_PATTERN.search(text))
+            if policy.sandbox is None:
+                page_cues.layout_hash = _layout_hash(page)
+        cues.append(page_cues)
+    return cues
+
+
+def _boundary_reason(
+    cues: PageCues,
+    previous: PageCues,
+    segment: Segment,
+    first: PageCues,
+    policy: SegmentationPolicy,
+    use_invoice_numbers: bool = True,
+) -> Optional[str]:
+    """Why a page starts a new invoice, or None if it continues the current one."""
+    if cues.page_of is not None:
+        return BOUNDARY_PAGE_MARKER if cues.page_of[0] == 1 else None
+    if previous.page_of is not None and previous.page_of[0] == previous.page_of[1]:
+        return BOUNDARY_PAGE_MARKER
+
+    if use_invoice_numbers and cues.invoice_number is not None:
+        if segment.invoice_number is not None and cues.invoice_number != segment.invoice_number:
+            return BOUNDARY_INVOICE_NUMBER
+        return None
+
+    # The letterhead alone doesn't tell a new invoice from a continuation page;
+    # the previous page must also have closed the current invoice with its total
+    if (policy.use_page_similarity and previous.shows_total and cues.layout_hash is not None and first.layout_hash is not None
+            and hamming_distance(cues.layout_hash, first.layout_hash) <= policy.max_layout_hamming):
+        return BOUNDARY_SIMILAR_LAYOUT
+    return None
+
+
+def segment_pages(cues: list[PageCues], policy: Optional[SegmentationPolicy] = None) -> list[Segment]:
+    """Split a document's pages into per-invoice segments from their cues."""
+    policy = policy or SegmentationPolicy()
+    # A page listing several invoice numbers belongs to a statement, reminder or
+    # remittance, whose numbers say nothing about where an invoice starts
+    use_invoice_numbers = all(page_cues.invoice_references <= 1 for page_cues in cues)
+    segments: list[Segment] = []
+    for index, page_cues in enumerate(cues):
+        reason = None
+        if segments:
+            segment = segments[-1]
+            reason = _boundary_reason(page_cues, cues[index - 1], segment, cues[segment.start], policy, use_invoice_numbers)
+        if not segments or reason:
+            segments.append(Segment(start=index, end=index, reason=reason or ''))
+        segment = segments[-1]
+        segment.end = index + 1
+        if segment.invoice_number is None:
+            segment.invoice_number = page_cues.invoice_number
+    return segments
+
+
+def segment_pdf(pdf_bytes: bytes, policy: Optional[SegmentationPolicy] = None) -> list[Segment]:
+    """
+    Split a PDF into per-invoice page ranges.
+
+    Returns:
+        Segments in page order (a single one when no boundaries are found), or
+        an empty list if the PDF can't be read
+    """
+    policy = policy or SegmentationPolicy()
+    try:
+        with fitz.Document(stream=pdf_bytes, filetype="pdf") as doc:
+            page_count = doc.page_count
+            if page_count < 2:
+                return [Segment(start=0, end=page_count)]
+            cues = collect_page_cues(doc, policy)
+        if policy.use_page_similarity and policy.sandbox is not None:
+            page_numbers = [page_cues.page_number for page_cues in cues]
+            for page_number, layout_hash, _ in iter_sandboxed_pages(pdf_bytes, page_numbers, _layout_hash, (), policy.sandbox):
+                cues[page_number].layout_hash = layout_hash
+        return segment_pages(cues, policy)
+    except Exception as e:
+        print(f"Error segmenting PDF: {str(e)}", file=sys.stderr)
+        return []
+
+
+def split_pdf(pdf_bytes: bytes, segments: list[Segment]) -> list[bytes]:
+    """Copy each segment's pages into a PDF of their own."""
+    segment_pdfs = []
+    with fitz.Document(stream=pdf_bytes, filetype="pdf") as doc:
+        for segment in segments:
+            with fitz.Document() as segment_doc:
+                segment_doc.insert_pdf(doc, from_page=segment.start, to_page=segment.end - 1)
+                segment_pdfs.append(segment_doc.tobytes(garbage=1))
+    return segment_pdfs
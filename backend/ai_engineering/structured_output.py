@@ -0,0 +1,198 @@
+"""
+Structured Extraction Output
+
+This module makes the model's extraction answer arrive whole and well-formed:
+the answer is a forced tool call whose input follows a JSON schema, its output
+budget is sized to the document rather than fixed, and an answer cut off at the
+budget is continued rather than thrown away.
+
+The output handling:
+1. EXTRACTION_TOOL describes the answer (document type and invoices) as a tool
+   input schema; the request forces the model to call it (CLASSIFICATION_TOOL
+   does the same for the document type alone, see cascade)
+2. output_budget sizes max_tokens from the page count and the expected number
+   of line items (counted from the text layer when there is one)
+3. When the model stops at max_tokens, the clients send the answer so far back
+   as the start of the assistant's turn and let the model continue it, up to
+   max_continuations times, then join the parts
+"""
+
+import re
+from dataclasses import dataclass
+from typing import Any, Optional
+
+EXTRACTION_TOOL_NAME = "record_invoices"
+CLASSIFICATION_TOOL_NAME = "record_document_type"
+
+DOCUMENT_TYPES = (
+    "invoice", "statement", "reminder", "credit_note",
+    "purchase_order", "remittance_advice", "other",
+)
+
+_TEXT_OR_NUMBER = {"type": ["number", "string", "null"]}
+_TEXT = {"type": ["string", "null"]}
+
+EXTRACTION_TOOL = {
+    "name": EXTRACTION_TOOL_NAME,
+    "description": "Record the document's type and the details of every invoice extracted from it.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "document_type": {"type": "string", "enum": list(DOCUMENT_TYPES)},
+            "invoices": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "number": _TEXT,
+                        "po_number": _TEXT,
+                        "amount": _TEXT_OR_NUMBER,
+                        "tax_amount": _TEXT_OR_NUMBER,
+                        "currency_code": _TEXT,
+                        "date": _TEXT,
+                        "due_date": _TEXT,
+                        "payment_term_days": _TEXT,
+                        "vendor": _TEXT,
+                        "billing_address": _TEXT,
+                        "shipping_address": _TEXT,
+                        "payment_method": _TEXT,
+                        "line_items": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "description": _TEXT,
+                                    "quantity": _TEXT_OR_NUMBER,
+                                    "unit_price": _TEXT_OR_NUMBER,
+                                    "total": _TEXT_OR_NUMBER,
+                                },
+                                "required": ["description", "quantity", "unit_price", "total"],
+                            },
+                        },
+                    },
+                    "required": ["number", "amount", "vendor", "line_items"],
+                },
+            },
+        },
+        "required": ["document_type", "invoices"],
+    },
+}
+
+EXTRACTION_TOOL_CHOICE = {"type": "tool", "name": EXTRACTION_TOOL_NAME}
+
+CLASSIFICATION_TOOL = {
+    "name": CLASSIFICATION_TOOL_NAME,
+    "description": "Record the document's type and the confidence in it.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "document_type": {"type": "string", "enum": list(DOCUMENT_TYPES)},
+            "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+        },
+        "required": ["document_type", "confidence"],
+    },
+}
+
+CLASSIFICATION_TOOL_CHOICE = {"type": "tool", "name": CLASSIFICATION_TOOL_NAME}
+
+# A classification answer is one short tool call
+CLASSIFICATION_MAX_TOKENS = 100
+
+# A text line carrying a money-like figure ("1,250.00", "99,50"), the usual mark of a line item
+_AMOUNT_LINE = re.compile(r"\d[.,]\d{2}\b")
+
+
+@dataclass(frozen=True)
+class OutputPolicy:
+    """
+    How much output an extraction may generate.
+
+    Attributes:
+        base_tokens: Budget for the document type and one invoice's header fields
+        tokens_per_line_item: Budget per expected line item
+        line_items_per_page: Expected line items per page when there's no text
+            layer to count them from
+        min_tokens: Smallest budget, whatever the estimate
+        max_tokens: Largest budget per request (the model's output limit)
+        max_continuations: Follow-up requests for an answer cut off at the budget
+    """
+    base_tokens: int = 512
+    tokens_per_line_item: int = 60
+    line_items_per_page: int = 15
+    min_tokens: int = 1024
+    max_tokens: int = 8192
+    max_continuations: int = 2
+
+
+def expected_line_items(page_count: int, document_text: Optional[str], policy: OutputPolicy) -> int:
+    """Estimate a document's line items from the amount-carrying lines of its text, or from its pages."""
+    if document_text:
+        return sum(1 for line in document_text.splitlines() if _AMOUNT_LINE.search(line))
+    return max(1, page_count) * policy.line_items_per_page
+
+
+def output_budget(
+    page_count: int,
+    document_text: Optional[str] = None,
+    policy: Optional[OutputPolicy] = None,
+    line_items: Optional[int] = None,
+) -> int:
+    """
+    max_tokens for extracting a document of page_count pages (and its text layer, if any).
+
+    line_items, when known (e.g. the table lines counted on its pages), replaces the estimate.
+    """
+    policy = policy or OutputPolicy()
+    if line_items is None:
+        line_items = expected_line_items(page_count, document_text, policy)
+    estimate = policy.base_tokens + policy.tokens_per_line_item * line_items
+    return max(policy.min_tokens, min(policy.max_tokens, estimate))
+
+
+def tool_input(content: Any, name: str) -> Optional[dict]:
+    """The input of a (non-streamed) answer's call of the named tool, from SDK content blocks or raw dicts."""
+    for block in content or []:
+        if _field(block, "type") == "tool_use" and _field(block, "name") == name:
+            return _field(block, "input")
+    return None
+
+
+def _field(obj: Any, name: str) -> Any:
+    return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+
+def event_output_text(event: Any) -> Optional[str]:
+    """
+    The answer text carried by a streamed message event (an SDK event or a raw
+    Bedrock event dict): tool input JSON, or text in a continuation.
+    """
+    if _field(event, "type") != "content_block_delta":
+        return None
+    delta = _field(event, "delta")
+    delta_type = _field(delta, "type")
+    if delta_type == "input_json_delta":
+        return _field(delta, "partial_json")
+    if delta_type == "text_delta":
+        return _field(delta, "text")
+    return None
+
+
+def continuation_messages(content: list, answer_so_far: str) -> list:
+    """
+    Messages that have the model continue a cut-off answer: the original
+    request, then the answer so far as the start of the assistant's turn.
+
+    The answer must not end in whitespace, which the API rejects at the end of
+    an assistant turn; see trim_answer.
+    """
+    return [{"role": "user", "content": content}, assistant_prefill(answer_so_far)]
+
+
+def assistant_prefill(answer_so_far: str) -> dict:
+    """The start of the assistant's turn, which the model continues."""
+    return {"role": "assistant", "content": [{"type": "text", "text": answer_so_far}]}
+
+
+def trim_answer(answer: str) -> str:
+    """Drop trailing whitespace from a cut-off answer before it is continued (insignificant between JSON tokens)."""
+    return answer.rstrip()
@@ -0,0 +1,87 @@
+import fitz
+from django.test import SimpleTestCase
+
+from .segmentation import (
+    BOUNDARY_INVOICE_NUMBER,
+    BOUNDARY_PAGE_MARKER,
+    BOUNDARY_SIMILAR_LAYOUT,
+    PageCues,
+    SegmentationPolicy,
+    segment_pages,
+    segment_pdf,
+)
+
+LETTERHEAD_HASH = 0x9F1F17E0E0E078CC
+SIMILARITY = SegmentationPolicy(use_page_similarity=True)
+
+
+def _spans(segments):
+    return [(segment.start, segment.end, segment.reason) for segment in segments]
+
+
+class SegmentPagesTests(SimpleTestCase):
+    def test_scanned_continuation_page_repeating_letterhead_is_not_split(self):
+        cues = [
+            PageCues(page_number=0, layout_hash=LETTERHEAD_HASH),
+            PageCues(page_number=1, layout_hash=LETTERHEAD_HASH),
+        ]
+        self.assertEqual(_spans(segment_pages(cues, SIMILARITY)), [(0, 2, '')])
+
+    def test_text_continuation_page_repeating_letterhead_is_not_split(self):
+        cues = [
+            PageCues(page_number=0, has_text=True, layout_hash=LETTERHEAD_HASH),
+            PageCues(page_number=1, has_text=True, shows_total=True, layout_hash=LETTERHEAD_HASH),
+        ]
+        self.assertEqual(_spans(segment_pages(cues, SIMILARITY)), [(0, 2, '')])
+
+    def test_letterhead_after_a_total_starts_a_new_invoice(self):
+        cues = [
+            PageCues(page_number=0, has_text=True, layout_hash=LETTERHEAD_HASH),
+            PageCues(page_number=1, has_text=True, shows_total=True, layout_hash=LETTERHEAD_HASH ^ 0xFF00),
+            PageCues(page_number=2, has_text=True, layout_hash=LETTERHEAD_HASH ^ 0b11),
+        ]
+        self.assertEqual(
+            _spans(segment_pages(cues, SIMILARITY)),
+            [(0, 2, ''), (2, 3, BOUNDARY_SIMILAR_LAYOUT)],
+        )
+
+    def test_page_similarity_is_off_by_default(self):
+        cues = [
+            PageCues(page_number=0, has_text=True, shows_total=True, layout_hash=LETTERHEAD_HASH),
+            PageCues(page_number=1, has_text=True, layout_hash=LETTERHEAD_HASH),
+        ]
+        self.assertEqual(_spans(segment_pages(cues)), [(0, 2, '')])
+
+    def test_page_markers_and_invoice_numbers_split(self):
+        cues = [
+            PageCues(page_number=0, page_of=(1, 2), invoice_number='INV-1001', invoice_references=1),
+            PageCues(page_number=1, page_of=(2, 2), invoice_number='INV-1001', invoice_references=1),
+            PageCues(page_number=2, invoice_number='INV-1002', invoice_references=1),
+            PageCues(page_number=3, invoice_number='INV-1003', invoice_references=1),
+        ]
+        self.assertEqual(
+            _spans(segment_pages(cues)),
+            [(0, 2, ''), (2, 3, BOUNDARY_PAGE_MARKER), (3, 4, BOUNDARY_INVOICE_NUMBER)],
+        )
+
+    def test_pages_listing_several_invoice_numbers_are_not_split_on_them(self):
+        cues = [
+            PageCues(page_number=0, invoice_number='INV-1001', invoice_references=6),
+            PageCues(page_number=1, invoice_number='INV-1010', invoice_references=4),
+        ]
+        self.assertEqual(_spans(segment_pages(cues)), [(0, 2, '')])
+
+
+class SegmentPdfTests(SimpleTestCase):
+    def test_two_page_scan_of_one_invoice_stays_whole(self):
+        # No text layer; both pages carry the same letterhead, only the body differs
+        with fitz.Document() as doc:
+            for body_rows in (12, 4):
+                page = doc.new_page(width=595, height=842)
+                page.draw_rect(fitz.Rect(40, 40, 300, 120), color=(0, 0, 0), fill=(0, 0, 0))
+                for row in range(body_rows):
+                    y = 260 + row * 40
+                    page.draw_rect(fitz.Rect(40, y, 555, y + 12), color=(0, 0, 0), fill=(0.3, 0.3, 0.3))
+            pdf_bytes = doc.tobytes()
+
+        self.assertEqual(_spans(segment_pdf(pdf_bytes, SIMILARITY)), [(0, 2, '')])
@@ -0,0 +1,469 @@
+"""
+Vendor Template Learning
+
+This module learns where a vendor prints each invoice field, from a few LLM
+extractions of that vendor's born-digital invoices, and then extracts later
+invoices with the same layout directly from the PDF text layer, without an
+LLM call.
+
+The process:
+1. Split each page's text layer into segments: runs of words on one printed
+   line separated by wide gaps (e.g. "PO Number:" and "WBS2385-224")
+2. Observe a successful LLM extraction: for every field, find the segments
+   holding the extracted value and note their anchors (the label to their
+   left, the label above them, or a literal prefix in the same segment), and
+   where each line item column sits
+3. Learn a template once enough observations agree: keep anchors present in
+   every observation, fields whose value never changes as constants, and the
+   text common to every observation as the vendor's identity
+4. Apply a template to a document whose segments match its identity, and
+   validate the result before trusting it
+"""
+
+import re
+from datetime import datetime
+from typing import Any, Optional
+
+from .text_layer import TextLayer, char_width, group_lines, line_height
+
+# Date formats tried when locating an extracted ISO date on the page
+DATE_FORMATS = (
+    "%Y-%m-%d", "%d/%m/%Y", "%m/%d/%Y", "%d.%m.%Y", "%d-%m-%Y", "%m-%d-%Y",
+    "%b %d, %Y", "%B %d, %Y", "%b %d %Y", "%B %d %Y", "%d %b %Y", "%d %B %Y",
+    "%d-%b-%Y", "%d/%m/%y", "%m/%d/%y",
+)
+
+AMOUNT_FIELDS = ("amount", "tax_amount")
+DATE_FIELDS = ("date", "due_date")
+LINE_ITEM_COLUMNS = ("description", "quantity", "unit_price", "total")
+
+# Fields a template must be able to locate; they are never learned as constants
+REQUIRED_FIELDS = ("number", "amount", "date")
+
+_ANCHOR_PRIORITY = {"prefix": 0, "right": 1, "below": 2}
+
+
+def normalize(text: str) -> str:
+    return " ".join(str(text).split()).casefold()
+
+
+def parse_amount(text: str) -> Optional[float]:
+    """Parse a printed amount such as "US$3,981.94", "1.234,50" or "(91.65)"."""
+    text = str(text).strip()
+    negative = (text.startswith("(") and text.endswith(")")) or bool(re.match(r"^[^0-9]*-", text))
+    cleaned = re.sub(r"[^0-9.,]", "", text)
+    if not cleaned or not any(char.isdigit() for char in cleaned):
+        return None
+    if "," in cleaned and "." in cleaned:
+        # Whichever separator comes last is the decimal point
+        if cleaned.rfind(",") > cleaned.rfind("."):
+            cleaned = cleaned.replace(".", "").replace(",", ".")
+        else:
+            cleaned = cleaned.replace(",", "")
+    elif "," in cleaned:
+        whole, _, fraction = cleaned.rpartition(",")
+        cleaned = f"{whole.replace(',', '')}.{fraction}" if len(fraction) == 2 else cleaned.replace(",", "")
+    try:
+        value = float(cleaned)
+    except ValueError:
+        return None
+    return -value if negative else value
+
+
+def _amounts_equal(a: Optional[float], b: Optional[float]) -> bool:
+    return a is not None and b is not None and abs(a - b) < 0.005
+
+
+def parse_date(text: str, date_format: str) -> Optional[str]:
+    """Parse a printed date with a known format into ISO yyyy-mm-dd."""
+    try:
+        return datetime.strptime(" ".join(str(text).split()), date_format).date().isoformat()
+    except ValueError:
+        return None
+
+
+def document_segments(text_layer: TextLayer) -> list[list[list[dict]]]:
+    """
+    Split a text layer into segments, per page and printed line.
+
+    A segment is a run of words whose gaps are narrower than two characters.
+
+    Returns:
+        pages -> lines -> segments, each segment a dict with page, line, x0, y0, x1, y1 and text
+    """
+    document = []
+    for page_number, words in enumerate(text_layer.words):
+        if not words:
+            document.append([])
+            continue
+        gap = 2 * char_width(words)
+        lines = []
+        for line_number, (_, line_words) in enumerate(group_lines(words)):
+            segments = []
+            for x0, y0, x1, y1, text, *_ in line_words:
+                if segments and x0 - segments[-1]["x1"] <= gap:
+                    segment = segments[-1]
+                    segment["text"] += " " + text
+                    segment["x1"] = max(segment["x1"], x1)
+                    segment["y0"] = min(segment["y0"], y0)
+                    segment["y1"] = max(segment["y1"], y1)
+                else:
+                    segments.append({
+                        "page": page_number, "line": line_number,
+                        "x0": x0, "y0": y0, "x1": x1, "y1": y1, "text": text,
+                    })
+            lines.append(segments)
+        document.append(lines)
+    return document
+
+
+def _iter_segments(document: list[list[list[dict]]]):
+    for lines in document:
+        for segments in lines:
+            yield from segments
+
+
+def identity_texts(document: list[list[list[dict]]]) -> set[str]:
+    """Normalized segment texts of a document, the raw material for vendor identity."""
+    return {normalize(segment["text"]) for segment in _iter_segments(document)}
+
+
+def _left_neighbour(document, segment: dict) -> Optional[dict]:
+    line = document[segment["page"]][segment["line"]]
+    index = line.index(segment)
+    return line[index - 1] if index > 0 else None
+
+
+def _label_above(document, segment: dict) -> Optional[dict]:
+    """The nearest segment on an earlier line, within three lines, that overlaps horizontally."""
+    lines = document[segment["page"]]
+    for line_number in range(segment["line"] - 1, max(-1, segment["line"] - 4), -1):
+        for candidate in lines[line_number]:
+            if candidate["x0"] < segment["x1"] and candidate["x1"] > segment["x0"]:
+                return candidate
+    return None
+
+
+def _anchors_for(document, segment: dict, value_text: Optional[str] = None) -> list[dict]:
+    """Candidate anchors pointing at a segment that holds a field's value."""
+    anchors = []
+    if value_text is not None:
+        collapsed = " ".join(segment["text"].split())
+        position = collapsed.casefold().rfind(value_text.casefold())
+        if position > 0 and position + len(value_text) == len(collapsed):
+            anchors.append({"kind": "prefix", "label": normalize(collapsed[:position])})
+    left = _left_neighbour(document, segment)
+    if left is not None:
+        anchors.append({"kind": "right", "label": normalize(left["text"])})
+    above = _label_above(document, segment)
+    if above is not None:
+        anchors.append({"kind": "below", "label": normalize(above["text"])})
+    return anchors
+
+
+def _anchor_key(anchor: dict) -> str:
+    return "|".join(str(anchor.get(key, "")) for key in ("kind", "label", "format"))
+
+
+def _observe_field(document, field: str, value: Any) -> list[dict]:
+    """Find every segment holding a field's value and return their anchors."""
+    anchors = []
+    if value in (None, ""):
+        return anchors
+
+    for segment in _iter_segments(document):
+        text = segment["text"]
+        if field in AMOUNT_FIELDS:
+            if _amounts_equal(parse_amount(text), _to_float(value)):
+                anchors.extend(_anchors_for(document, segment))
+        elif field in DATE_FIELDS:
+            for date_format in DATE_FORMATS:
+                if parse_date(text, date_format) == value:
+                    anchors.extend({**anchor, "format": date_format} for anchor in _anchors_for(document, segment))
+        else:
+            value_text = " ".join(str(value).split())
+            if normalize(text) == normalize(value_text):
+                anchors.extend(_anchors_for(document, segment))
+            elif normalize(text).endswith(normalize(value_text)):
+                anchors.extend(a for a in _anchors_for(document, segment, value_text) if a["kind"] == "prefix")
+    return anchors
+
+
+def _to_float(value: Any) -> Optional[float]:
+    if isinstance(value, (int, float)):
+        return float(value)
+    return parse_amount(value) if value not in (None, "") else None
+
+
+def _observe_table(document, line_items: list[dict]) -> Optional[dict]:
+    """Locate every line item on the page; return the table header and column extents, or None."""
+    columns: dict[str, list[float]] = {}
+    first_row = None
+    for item in line_items:
+        description = normalize(item.get("description") or "")
+        row = None
+        for segment in _iter_segments(document):
+            if description and normalize(segment["text"]) == description:
+                row = document[segment["page"]][segment["line"]]
+                break
+        if row is None:
+            return None
+        if first_row is None:
+            first_row = row
+
+        used = []
+        for column in LINE_ITEM_COLUMNS:
+            if column == "description":
+                cell = next(s for s in row if normalize(s["text"]) == description)
+            else:
+                value = _to_float(item.get(column))
+                if value is None:
+                    continue
+                matches = [s for s in row if s not in used and _amounts_equal(parse_amount(s["text"]), value)]
+                if not matches:
+                    return None
+                # Totals sit in the rightmost column; e.g. unit price == total when quantity is 1
+                cell = matches[-1] if column == "total" else matches[0]
+            used.append(cell)
+            extent = columns.setdefault(column, [cell["x0"], cell["x1"]])
+            extent[0], extent[1] = min(extent[0], cell["x0"]), max(extent[1], cell["x1"])
+
+    page, line = first_row[0]["page"], first_row[0]["line"]
+    header = next((document[page][n] for n in range(line - 1, -1, -1) if document[page][n]), None)
+    if header is None or "total" not in columns:
+        return None
+    return {"header": " | ".join(normalize(s["text"]) for s in header), "columns": columns}
+
+
+def observe_extraction(text_layer: TextLayer, invoice: dict) -> dict:
+    """
+    Record where a successfully extracted invoice's values appear in its text layer.
+
+    Returns:
+        An observation (JSON-serializable) to keep for learning
+    """
+    document = document_segments(text_layer)
+    fields = {}
+    for field, value in invoice.items():
+        if field == "line_items":
+            continue
+        fields[field] = {
+            "value": value,
+            "anchors": [_anchor_key(anchor) for anchor in _observe_field(document, field, value)],
+        }
+
+    line_items = invoice.get("line_items") or []
+    return {
+        "identity": sorted(identity_texts(document)),
+        "fields": fields,
+        "line_item_count": len(line_items),
+        "table": _observe_table(document, line_items) if line_items else None,
+    }
+
+
+def _parse_anchor_key(key: str) -> dict:
+    kind, label, date_format = key.split("|", 2)
+    return {"kind": kind, "label": label, "format": date_format or None}
+
+
+def learn_template(observations: list[dict]) -> Optional[dict]:
+    """
+    Learn a template from observations of one vendor's invoices.
+
+    Every field must be locatable through an anchor seen in all observations,
+    or (except REQUIRED_FIELDS) have the same value in all of them. Returns
+    None when the observations don't agree well enough.
+    """
+    if not observations:
+        return None
+
+    field_names = set().union(*(obs["fields"].keys() for obs in observations))
+    fields = {}
+    for field in sorted(field_names):
+        entries = [obs["fields"].get(field, {"value": None, "anchors": []}) for obs in observations]
+        common = set.intersection(*(set(entry["anchors"]) for entry in entries))
+        if common:
+            best = min(common, key=lambda key: (_ANCHOR_PRIORITY[key.split("|", 1)[0]], len(key), key))
+            fields[field] = {"anchor": _parse_anchor_key(best)}
+            continue
+        values = [entry["value"] for entry in entries]
+        if field not in REQUIRED_FIELDS and all(value == values[0] for value in values):
+            fields[field] = {"constant": values[0]}
+            continue
+        return None
+
+    if any(field not in fields or "anchor" not in fields[field] for field in REQUIRED_FIELDS):
+        return None
+
+    table = None
+    if any(obs["line_item_count"] for obs in observations):
+        tables = [obs["table"] for obs in observations]
+        if any(t is None for t in tables) or len({t["header"] for t in tables}) != 1:
+            return None
+        columns = {}
+        for column in LINE_ITEM_COLUMNS:
+            extents = [t["columns"][column] for t in tables if column in t["columns"]]
+            if extents:
+                columns[column] = [min(e[0] for e in extents), max(e[1] for e in extents)]
+        table = {"header": tables[0]["header"], "columns": columns}
+
+    identity = set.intersection(*(set(obs["identity"]) for obs in observations))
+    return {"fields": fields, "table": table, "identity": sorted(identity)}
+
+
+def _find_label(document, label: str):
+    for segment in _iter_segments(document):
+        if normalize(segment["text"]) == label:
+            yield segment
+
+
+def _locate(document, anchor: dict) -> Optional[str]:
+    """Return the raw text a learned anchor points at, or None if it isn't on the page."""
+    kind, label = anchor["kind"], anchor["label"]
+    if kind == "prefix":
+        for segment in _iter_segments(document):
+            collapsed = " ".join(segment["text"].split())
+            if normalize(collapsed).startswith(label) and len(collapsed) > len(label):
+                return collapsed[len(label):].strip()
+        return None
+
+    for label_segment in _find_label(document, label):
+        if kind == "right":
+            line = document[label_segment["page"]][label_segment["line"]]
+            index = line.index(label_segment)
+            if index + 1 < len(line):
+                return line[index + 1]["text"]
+        elif kind == "below":
+            lines = document[label_segment["page"]]
+            for line_number in range(label_segment["line"] + 1, min(len(lines), label_segment["line"] + 4)):
+                for candidate in lines[line_number]:
+                    if candidate["x0"] < label_segment["x1"] and candidate["x1"] > label_segment["x0"]:
+                        return candidate["text"]
+    return None
+
+
+def _extract_table(document, table: dict, text_layer: TextLayer) -> list[dict]:
+    header_segments = None
+    for lines in document:
+        for segments in lines:
+            if segments and " | ".join(normalize(s["text"]) for s in segments) == table["header"]:
+                header_segments = segments
+                break
+        if header_segments:
+            break
+    if header_segments is None:
+        return []
+
+    page = header_segments[0]["page"]
+    lines = document[page]
+    words = text_layer.words[page]
+    max_gap = 2.5 * line_height(words)
+    tolerance = 2 * char_width(words)
+    columns = table["columns"]
+
+    def column_of(segment: dict) -> Optional[str]:
+        best, best_overlap = None, 0.0
+        for column, (x0, x1) in columns.items():
+            overlap = min(segment["x1"], x1 + tolerance) - max(segment["x0"], x0 - tolerance)
+            if overlap > best_overlap:
+                best, best_overlap = column, overlap
+        return best
+
+    rows = []
+    previous_bottom = header_segments[0]["y1"]
+    for segments in lines[header_segments[0]["line"] + 1:]:
+        if not segments:
+            continue
+        top = min(s["y0"] for s in segments)
+        if top - previous_bottom > max_gap:
+            break
+        cells = {}
+        for segment in segments:
+            column = column_of(segment)
+            if column:
+                cells[column] = f"{cells[column]} {segment['text']}" if column in cells else segment["text"]
+        total = parse_amount(cells["total"]) if "total" in cells else None
+        if total is not None and cells.get("description"):
+            rows.append({
+                "description": cells["description"],
+                "quantity": parse_amount(cells["quantity"]) if "quantity" in cells else None,
+                "unit_price": parse_amount(cells["unit_price"]) if "unit_price" in cells else None,
+                "total": total,
+            })
+        elif cells.get("description") and total is None and rows and len(cells) == 1:
+            # Wrapped description continuing the previous row
+            rows[-1]["description"] += " " + cells["description"]
+        else:
+            break
+        previous_bottom = max(s["y1"] for s in segments)
+    return rows
+
+
+def identity_score(template: dict, document_identity: set[str]) -> float:
+    """Fraction of a template's identity texts present in a document."""
+    identity = template.get("identity") or []
+    if not identity:
+        return 0.0
+    return sum(1 for text in identity if text in document_identity) / len(identity)
+
+
+def apply_template(template: dict, text_layer: TextLayer) -> tuple[Optional[dict], Optional[str]]:
+    """
+    Extract an invoice with a learned template.
+
+    Returns:
+        (invoice, None) on success, or (None, reason) when a field can't be
+        found or the result fails validation
+    """
+    document = document_segments(text_layer)
+    invoice: dict[str, Any] = {}
+    for field, spec in template["fields"].items():
+        if "constant" in spec:
+            invoice[field] = spec["constant"]
+            continue
+        raw = _locate(document, spec["anchor"])
+        if raw is None:
+            return None, f"{field} anchor '{spec['anchor']['label']}' not found"
+        if field in AMOUNT_FIELDS:
+            value = parse_amount(raw)
+            if value is None:
+                return None, f"{field} '{raw}' is not an amount"
+        elif field in DATE_FIELDS:
+            value = parse_date(raw, spec["anchor"]["format"])
+            if value is None:
+                return None, f"{field} '{raw}' does not match {spec['anchor']['format']}"
+        else:
+            value = " ".join(raw.split())
+        invoice[field] = value
+
+    invoice["line_items"] = []
+    if template.get("table"):
+        invoice["line_items"] = _extract_table(document, template["table"], text_layer)
+
+    reason = validate_invoice(invoice, template)
+    if reason:
+        return None, reason
+    return invoice, None
+
+
+def validate_invoice(invoice: dict, template: dict) -> Optional[str]:
+    """Return why a template-extracted invoice can't be trusted, or None if it passes."""
+    if not invoice.get("number"):
+        return "missing invoice number"
+    amount = invoice.get("amount")
+    if amount is None:
+        return "missing amount"
+    tax_amount = invoice.get("tax_amount")
+    if isinstance(tax_amount, float) and abs(tax_amount) > abs(amount):
+        return "tax amount exceeds total"
+    if template.get("table"):
+        if not invoice["line_items"]:
+            return "no line items found under the learned table header"
+        for item in invoice["line_items"]:
+            quantity, unit_price, total = item["quantity"], item["unit_price"], item["total"]
+            if quantity is not None and unit_price is not None and abs(quantity * unit_price - total) > max(0.01, 0.005 * abs(total)):
+                return f"line item '{item['description']}' does not add up"
+        line_total = sum(item["total"] for item in invoice["line_items"])
+        if abs(line_total) > abs(amount) * 1.5 + 0.01:
+            return "line items exceed the invoice amount"
+    return None
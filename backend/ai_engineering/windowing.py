@@ -0,0 +1,284 @@
+"""
+Windowed Extraction
+
+This module extracts documents that are too long for one LLM request (statements
+and reminder letters running to dozens of pages exceed the per-request image
+count and payload limits) by sending their pages in overlapping windows.
+
+The windowed extraction:
+1. Groups the rendered images by page, so a tiled page's overview and its
+   close-ups always travel together
+2. Packs consecutive pages into windows within the image and byte limits,
+   repeating the last overlap_pages pages of each window at the start of the
+   next so an invoice spanning a window edge is seen whole at least once
+3. Extracts the windows concurrently (on threads, or as async requests on one
+   event loop), each introduced by a caption saying which pages of the
+   document it holds
+4. Merges the windows' invoices, treating invoices with the same number and
+   amount as one (an invoice repeated in an overlap, or split across two
+   windows with its total only visible in one of them), and adds up the
+   windows' token usage
+"""
+
+import re
+import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from typing import Any, Awaitable, Callable, Optional, Sequence
+
+from .concurrency import gather_limited
+from .image_encoding import ImagePayload
+from .prompt_cache import combine_usage
+
+# Fields merged from the first window that has a value for them
+INVOICE_FIELDS = (
+    'number', 'po_number', 'amount', 'tax_amount', 'currency_code', 'date', 'due_date',
+    'payment_term_days', 'vendor', 'billing_address', 'shipping_address', 'payment_method',
+)
+
+# Line items can run across a window edge but repeat in the overlap
+LINE_ITEM_KEY_FIELDS = ('description', 'quantity', 'unit_price', 'total')
+
+
+@dataclass
+class WindowPolicy:
+    """
+    How a long document is split into requests.
+
+    Attributes:
+        max_images: Most images sent in one request
+        max_bytes: Most base64 image bytes sent in one request
+        overlap_pages: Pages repeated at the start of the next window
+        max_workers: Windows extracted at the same time
+    """
+    max_images: int = 20
+    max_bytes: int = 20 * 1024 * 1024
+    overlap_pages: int = 1
+    max_workers: int = 4
+
+
+@dataclass
+class Window:
+    """A run of consecutive images sent in one request (end exclusive)."""
+    start: int
+    end: int
+    first_page: Optional[int] = None
+    last_page: Optional[int] = None
+
+    @property
+    def image_count(self) -> int:
+        return self.end - self.start
+
+
+def needs_windows(layout: Sequence[tuple[Optional[int], int]], policy: WindowPolicy) -> bool:
+    """Whether a document's images, as (page number, size) pairs, exceed one request's limits."""
+    return len(layout) > policy.max_images or sum(size for _, size in layout) > policy.max_bytes
+
+
+def _page_groups(layout: Sequence[tuple[Optional[int], int]]) -> list[tuple[int, int, Optional[int], int]]:
+    """Split images into (start, end, page number, size) runs belonging to the same page."""
+    groups = []
+    for index, (page_number, size) in enumerate(layout):
+        if groups and page_number is not None and groups[-1][2] == page_number:
+            start, _, _, group_size = groups[-1]
+            groups[-1] = (start, index + 1, page_number, group_size + size)
+        else:
+            groups.append((index, index + 1, page_number, size))
+    return groups
+
+
+def plan_windows(layout: Sequence[tuple[Optional[int], int]], policy: Optional[WindowPolicy] = None) -> list[Window]:
+    """
+    Pack a document's images, as (page number, size) pairs, into overlapping windows.
+
+    A window always holds at least one whole page, even one that alone exceeds
+    the limits, and always advances by at least one page.
+    """
+    policy = policy or WindowPolicy()
+    groups = _page_groups(layout)
+    windows = []
+    first = 0
+    while first < len(groups):
+        last = first
+        images, size = groups[first][1] - groups[first][0], groups[first][3]
+        while last + 1 < len(groups):
+            start, end, _, group_size = groups[last + 1]
+            if images + end - start > policy.max_images or size + group_size > policy.max_bytes:
+                break
+            last += 1
+            images += end - start
+            size += group_size
+        page_numbers = [group[2] for group in groups[first:last + 1] if group[2] is not None]
+        windows.append(Window(
+            start=groups[first][0],
+            end=groups[last][1],
+            first_page=page_numbers[0] if page_numbers else None,
+            last_page=page_numbers[-1] if page_numbers else None,
+        ))
+        if last == len(groups) - 1:
+            break
+        first = max(last + 1 - policy.overlap_pages, first + 1)
+    return windows
+
+
+def window_caption(window: Window) -> Optional[str]:
+    """Tell the model which part of the document a window holds."""
+    if window.first_page is None or window.last_page is None:
+        return None
+    return (
+        f"The following images are pages {window.first_page + 1} to {window.last_page + 1} of a longer document. "
+        f"Invoices may start before or continue after these pages; extract every invoice visible here, "
+        f"including partial ones, and leave fields you cannot see empty."
+    )
+
+
+def window_images(images: Sequence[ImagePayload], window: Window) -> list[ImagePayload]:
+    """Read a window's images, with the window caption prepended to the first one's."""
+    payloads = [images[index] for index in range(window.start, window.end)]
+    caption = window_caption(window)
+    if caption and payloads:
+        first = payloads[0]
+        payloads[0] = replace(first, caption=f"{caption}\n\n{first.caption}" if first.caption else caption)
+    return payloads
+
+
+def _normalize_number(number: Any) -> str:
+    return re.sub(r'[^A-Z0-9]', '', str(number or '').upper())
+
+
+def _amount(invoice: dict) -> Optional[float]:
+    amount = invoice.get('amount')
+    return round(float(amount), 2) if isinstance(amount, (int, float)) else None
+
+
+def _line_item_key(item: dict) -> tuple:
+    return tuple(str(item.get(field, '')).strip().casefold() for field in LINE_ITEM_KEY_FIELDS)
+
+
+def _is_empty(value: Any) -> bool:
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def _merge_invoice(merged: dict, invoice: dict) -> None:
+    """Fill a merged invoice's missing fields from another sighting and add its new line items."""
+    for field in INVOICE_FIELDS:
+        if _is_empty(merged.get(field)) and not _is_empty(invoice.get(field)):
+            merged[field] = invoice[field]
+    # An item seen n times already is only added for its (n+1)th occurrence,
+    # so genuinely repeated lines on one invoice survive
+    seen = Counter(_line_item_key(item) for item in merged.get('line_items', []))
+    for item in invoice.get('line_items') or []:
+        key = _line_item_key(item)
+        if seen[key]:
+            seen[key] -= 1
+        else:
+            merged.setdefault('line_items', []).append(item)
+
+
+def merge_window_results(results: Sequence[dict]) -> dict:
+    """
+    Combine the extractions of a document's windows into one, in page order.
+
+    Invoices with the same normalized number are merged when their amounts
+    agree or one of them has none; invoices without a number are only merged
+    with an identical-looking one (same amount, date and vendor).
+    """
+    invoices: list[dict] = []
+    by_number: dict[str, list[dict]] = {}
+    for result in results:
+        for invoice in result.get('invoices') or []:
+            number = _normalize_number(invoice.get('number'))
+            amount = _amount(invoice)
+            if number:
+                candidates = by_number.get(number, [])
+                match = next(
+                    (merged for merged in candidates
+                     if amount is None or _amount(merged) is None or _amount(merged) == amount),
+                    None,
+                )
+            else:
+                match = next(
+                    (merged for merged in invoices
+                     if not _normalize_number(merged.get('number')) and amount is not None
+                     and _amount(merged) == amount
+                     and merged.get('date') == invoice.get('date')
+                     and merged.get('vendor') == invoice.get('vendor')),
+                    None,
+                )
+
+            if match is not None:
+                _merge_invoice(match, invoice)
+                continue
+            merged = {**invoice, 'line_items': list(invoice.get('line_items') or [])}
+            invoices.append(merged)
+            if number:
+                by_number.setdefault(number, []).append(merged)
+
+    # The document type comes from the first window that recognised one
+    document_types = [result.get('document_type') for result in results]
+    document_type = next((t for t in document_types if t and t != 'other'), document_types[0] if document_types else 'other')
+    merged = {'document_type': document_type, 'invoices': invoices}
+    usage = combine_usage(result.get('usage') for result in results)
+    if usage is not None:
+        merged['usage'] = usage
+    return merged
+
+
+def extract_in_windows(
+    extract: Callable[[list[ImagePayload]], Optional[dict]],
+    images: Sequence[ImagePayload],
+    windows: list[Window],
+    policy: Optional[WindowPolicy] = None,
+) -> Optional[dict]:
+    """
+    Extract every window concurrently and merge the results.
+
+    Args:
+        extract: The LLM client's extraction call for a list of images
+        images: The document's images; must support concurrent indexed reads
+        windows: Windows planned over the images
+
+    Returns:
+        The merged extraction, or None if any window failed (a partial result
+        would silently drop invoices)
+    """
+    policy = policy or WindowPolicy()
+
+    def extract_window(window: Window) -> Optional[dict]:
+        return extract(window_images(images, window))
+
+    print(f"Extracting {len(images)} images in {len(windows)} windows", file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=max(1, policy.max_workers)) as executor:
+        results = list(executor.map(extract_window, windows))
+
+    return _merge_or_fail(results)
+
+
+async def extract_in_windows_async(
+    extract: Callable[[list[ImagePayload]], Awaitable[Optional[dict]]],
+    images: Sequence[ImagePayload],
+    windows: list[Window],
+    policy: Optional[WindowPolicy] = None,
+) -> Optional[dict]:
+    """
+    Async version of extract_in_windows: every window is a request in flight on
+    one event loop, at most policy.max_workers at a time, rather than a thread.
+    """
+    policy = policy or WindowPolicy()
+
+    async def extract_window(window: Window) -> Optional[dict]:
+        # Pages are read once the window's turn comes, not all up front
+        return await extract(window_images(images, window))
+
+    print(f"Extracting {len(images)} images in {len(windows)} windows", file=sys.stderr)
+    results = await gather_limited((extract_window(window) for window in windows), policy.max_workers)
+    return _merge_or_fail(results)
+
+
+def _merge_or_fail(results: list[Optional[dict]]) -> Optional[dict]:
+    failed = [index for index, result in enumerate(results) if not result]
+    if failed:
+        print(f"Windowed extraction failed for windows {failed}", file=sys.stderr)
+        return None
+    return merge_window_results(results)
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 import os
+import tempfile
 import environ
 from pathlib import Path
 import logging
@@ -235,3 +236,189 @@ ANTHROPIC_API_KEY = env('ANTHROPIC_API_KEY', default='')
 AWS_DEFAULT_REGION = env('AWS_DEFAULT_REGION', default='us-east-1')
 AWS_ACCESS_KEY_ID = env('AWS_ACCESS_KEY_ID', default='')
 AWS_SECRET_ACCESS_KEY = env('AWS_SECRET_ACCESS_KEY', default='')
+
+# PDF rasterization
+# Number of processes used to render PDF pages; 1 renders sequentially in the request thread
+PDF_RENDER_WORKERS = env.int('PDF_RENDER_WORKERS', default=min(os.cpu_count() or 1, 4))
+# Bytes of rendered page data kept in memory per job before spooling to a temp file
+PDF_PAGE_SPOOL_MAX_MEMORY = env.int('PDF_PAGE_SPOOL_MAX_MEMORY', default=8 * 1024 * 1024)
+# Each page's zoom is planned to fit these limits (0 disables a limit); the defaults match
+# the size Claude downscales images to, so larger renders only cost CPU and upload time
+PDF_RENDER_TARGET_LONG_EDGE = env.int('PDF_RENDER_TARGET_LONG_EDGE', default=1568)
+PDF_RENDER_MAX_MEGAPIXELS = env.float('PDF_RENDER_MAX_MEGAPIXELS', default=1.15)
+PDF_RENDER_MIN_ZOOM = env.float('PDF_RENDER_MIN_ZOOM', default=1.0)
+PDF_RENDER_MAX_ZOOM = env.float('PDF_RENDER_MAX_ZOOM', default=3.0)
+
+# Page image encoding: search grayscale/colour, JPEG quality and PNG for the smallest
+# payload whose edge map still matches the original page (min F1 score, 0-1)
+PAGE_ENCODING_OPTIMIZE = env.bool('PAGE_ENCODING_OPTIMIZE', default=True)
+PAGE_ENCODING_ALLOW_GRAYSCALE = env.bool('PAGE_ENCODING_ALLOW_GRAYSCALE', default=True)
+PAGE_ENCODING_ALLOW_PNG = env.bool('PAGE_ENCODING_ALLOW_PNG', default=True)
+PAGE_ENCODING_MIN_EDGE_F1 = env.float('PAGE_ENCODING_MIN_EDGE_F1', default=0.98)
+
+# Page triage: drop blank pages (ink coverage below the threshold) and pages that repeat an
+# earlier one (perceptual hash within PAGE_TRIAGE_MAX_HAMMING bits plus a text/pixel check)
+PAGE_TRIAGE_SKIP_BLANK = env.bool('PAGE_TRIAGE_SKIP_BLANK', default=True)
+PAGE_TRIAGE_SKIP_DUPLICATES = env.bool('PAGE_TRIAGE_SKIP_DUPLICATES', default=True)
+PAGE_TRIAGE_BLANK_INK_COVERAGE = env.float('PAGE_TRIAGE_BLANK_INK_COVERAGE', default=0.0005)
+PAGE_TRIAGE_MAX_HAMMING = env.int('PAGE_TRIAGE_MAX_HAMMING', default=4)
+
+# Page preprocessing: crop blank margins, straighten skewed scans and cap the final
+# long edge in pixels (0 disables the cap)
+PAGE_PREPROCESS_CROP_MARGINS = env.bool('PAGE_PREPROCESS_CROP_MARGINS', default=True)
+PAGE_PREPROCESS_DESKEW = env.bool('PAGE_PREPROCESS_DESKEW', default=True)
+PAGE_PREPROCESS_MAX_LONG_EDGE = env.int('PAGE_PREPROCESS_MAX_LONG_EDGE', default=1568)
+
+# Table tiling: send table-heavy pages as a low-resolution overview (long edge in pixels)
+# plus up to PDF_RENDER_TILING_MAX_TILES sharp crops of the detected table regions
+PDF_RENDER_TILING = env.bool('PDF_RENDER_TILING', default=False)
+PDF_RENDER_TILING_OVERVIEW_LONG_EDGE = env.int('PDF_RENDER_TILING_OVERVIEW_LONG_EDGE', default=1000)
+PDF_RENDER_TILING_MAX_TILES = env.int('PDF_RENDER_TILING_MAX_TILES', default=2)
+
+# Rendered page cache: re-processing an upload reuses its page images instead of
+# re-rasterizing. Keyed by PDF hash and render settings, least recently used evicted first.
+# Kept out of MEDIA_ROOT, which is served and written by uploads
+PDF_PAGE_CACHE_ENABLED = env.bool('PDF_PAGE_CACHE_ENABLED', default=True)
+PDF_PAGE_CACHE_DIR = env('PDF_PAGE_CACHE_DIR', default=os.path.join(tempfile.gettempdir(), 'invoice-processing', 'page_cache'))
+PDF_PAGE_CACHE_MAX_BYTES = env.int('PDF_PAGE_CACHE_MAX_BYTES', default=512 * 1024 * 1024)
+
+# Text layer fast path: born-digital PDFs are sent as layout text (plus, optionally, a
+# small image of the first page) instead of page images. Scans fall back to images
+PDF_TEXT_LAYER_ENABLED = env.bool('PDF_TEXT_LAYER_ENABLED', default=True)
+PDF_TEXT_LAYER_MIN_CHARS_PER_PAGE = env.int('PDF_TEXT_LAYER_MIN_CHARS_PER_PAGE', default=50)
+PDF_TEXT_LAYER_OVERVIEW_IMAGE = env.bool('PDF_TEXT_LAYER_OVERVIEW_IMAGE', default=True)
+PDF_TEXT_LAYER_OVERVIEW_LONG_EDGE = env.int('PDF_TEXT_LAYER_OVERVIEW_LONG_EDGE', default=800)
+
+# Vendor templates: once VENDOR_TEMPLATE_MIN_SAMPLES LLM extractions of a vendor's
+# born-digital invoices agree on a layout, later invoices whose text matches the vendor's
+# identity (fraction of identity lines present, 0-1) are extracted without the LLM.
+# Off unless enabled, since it replaces LLM extraction with locally derived data
+VENDOR_TEMPLATES_ENABLED = env.bool('VENDOR_TEMPLATES_ENABLED', default=False)
+VENDOR_TEMPLATE_MIN_SAMPLES = env.int('VENDOR_TEMPLATE_MIN_SAMPLES', default=3)
+VENDOR_TEMPLATE_MIN_IDENTITY_SCORE = env.float('VENDOR_TEMPLATE_MIN_IDENTITY_SCORE', default=0.9)
+VENDOR_TEMPLATE_CACHE_SECONDS = env.int('VENDOR_TEMPLATE_CACHE_SECONDS', default=60)
+
+# Duplicate detection: uploads matching an earlier completed job (identical file, identical
+# PDF text, or page perceptual hashes within PAGE_FINGERPRINT_MAX_HAMMING bits that still
+# agree pixel by pixel once aligned) reuse its result instead of being extracted again.
+# Off unless enabled, since it returns a copy of another job's data
+DUPLICATE_DETECTION_ENABLED = env.bool('DUPLICATE_DETECTION_ENABLED', default=False)
+PAGE_FINGERPRINT_MAX_HAMMING = env.int('PAGE_FINGERPRINT_MAX_HAMMING', default=8)
+DUPLICATE_DETECTION_MAX_BLOCK_DIFFERENCE = env.int('DUPLICATE_DETECTION_MAX_BLOCK_DIFFERENCE', default=30)
+DUPLICATE_DETECTION_MAX_CANDIDATES = env.int('DUPLICATE_DETECTION_MAX_CANDIDATES', default=3)
+
+# Multi-invoice PDFs: split bundles into per-invoice page ranges ("Page 1 of N" markers,
+# changing invoice numbers and, if PDF_SEGMENTATION_PAGE_SIMILARITY is enabled, pages
+# repeating the first page's letterhead within PDF_SEGMENTATION_MAX_LAYOUT_HAMMING bits
+# right after a page showing a total) and extract up to PDF_SEGMENT_WORKERS at once
+PDF_SEGMENTATION_ENABLED = env.bool('PDF_SEGMENTATION_ENABLED', default=True)
+PDF_SEGMENTATION_PAGE_SIMILARITY = env.bool('PDF_SEGMENTATION_PAGE_SIMILARITY', default=False)
+PDF_SEGMENTATION_MAX_LAYOUT_HAMMING = env.int('PDF_SEGMENTATION_MAX_LAYOUT_HAMMING', default=6)
+PDF_SEGMENT_WORKERS = env.int('PDF_SEGMENT_WORKERS', default=4)
+
+# Windowed extraction: documents whose page images exceed PDF_WINDOW_MAX_IMAGES images or
+# PDF_WINDOW_MAX_BYTES (base64) in one request are sent in windows overlapping by
+# PDF_WINDOW_OVERLAP_PAGES pages, up to PDF_WINDOW_WORKERS at once, and their invoices merged
+PDF_WINDOW_MAX_IMAGES = env.int('PDF_WINDOW_MAX_IMAGES', default=20)
+PDF_WINDOW_MAX_BYTES = env.int('PDF_WINDOW_MAX_BYTES', default=20 * 1024 * 1024)
+PDF_WINDOW_OVERLAP_PAGES = env.int('PDF_WINDOW_OVERLAP_PAGES', default=1)
+PDF_WINDOW_WORKERS = env.int('PDF_WINDOW_WORKERS', default=4)
+
+# Sandboxed rendering: PDF pages are rendered in child processes limited to
+# PDF_RENDER_MEMORY_LIMIT_MB of address space; a page that takes longer than
+# PDF_RENDER_PAGE_TIMEOUT seconds or crashes its child is skipped, and pages beyond
+# PDF_RENDER_MAX_PAGES are not rendered, so one pathological upload can't pin a worker
+PDF_RENDER_SANDBOX_ENABLED = env.bool('PDF_RENDER_SANDBOX_ENABLED', default=True)
+PDF_RENDER_PAGE_TIMEOUT = env.float('PDF_RENDER_PAGE_TIMEOUT', default=30.0)
+PDF_RENDER_MEMORY_LIMIT_MB = env.int('PDF_RENDER_MEMORY_LIMIT_MB', default=2048)
+PDF_RENDER_MAX_PAGES = env.int('PDF_RENDER_MAX_PAGES', default=200)
+
+# LLM clients: one Anthropic and one Bedrock client per process share a keep-alive
+# connection pool of up to LLM_MAX_CONNECTIONS connections (LLM_MAX_KEEPALIVE_CONNECTIONS
+# kept idle for LLM_KEEPALIVE_EXPIRY seconds); timeouts are in seconds
+LLM_MAX_CONNECTIONS = env.int('LLM_MAX_CONNECTIONS', default=20)
+LLM_MAX_KEEPALIVE_CONNECTIONS = env.int('LLM_MAX_KEEPALIVE_CONNECTIONS', default=10)
+LLM_KEEPALIVE_EXPIRY = env.float('LLM_KEEPALIVE_EXPIRY', default=30.0)
+LLM_CONNECT_TIMEOUT = env.float('LLM_CONNECT_TIMEOUT', default=10.0)
+LLM_READ_TIMEOUT = env.float('LLM_READ_TIMEOUT', default=300.0)
+LLM_MAX_RETRIES = env.int('LLM_MAX_RETRIES', default=2)
+
+# Prompt caching: the static extraction and assignment prompts are sent first and
+# marked cacheable, so later requests read them from the provider's prompt cache;
+# Bedrock only caches for models that support it there, so it is off by default
+ANTHROPIC_PROMPT_CACHING = env.bool('ANTHROPIC_PROMPT_CACHING', default=True)
+BEDROCK_PROMPT_CACHING = env.bool('BEDROCK_PROMPT_CACHING', default=False)
+
+# Streaming: single-request extractions started by the extract-and-match workflow
+# stream the model's answer, and each invoice's PO lookup starts (on up to
+# PO_PREFETCH_WORKERS threads) as soon as its PO number has been written
+LLM_STREAMING_ENABLED = env.bool('LLM_STREAMING_ENABLED', default=True)
+PO_PREFETCH_WORKERS = env.int('PO_PREFETCH_WORKERS', default=2)
+
+# Extraction output: the answer is a schema-constrained tool call whose max_tokens is
+# sized from the expected line items (counted from the text layer, or
+# LLM_OUTPUT_LINE_ITEMS_PER_PAGE per page image) at LLM_OUTPUT_TOKENS_PER_LINE_ITEM each,
+# between LLM_OUTPUT_MIN_TOKENS and LLM_OUTPUT_MAX_TOKENS; an answer cut off at the
+# budget is continued up to LLM_OUTPUT_MAX_CONTINUATIONS times
+LLM_OUTPUT_TOKENS_PER_LINE_ITEM = env.int('LLM_OUTPUT_TOKENS_PER_LINE_ITEM', default=60)
+LLM_OUTPUT_LINE_ITEMS_PER_PAGE = env.int('LLM_OUTPUT_LINE_ITEMS_PER_PAGE', default=15)
+LLM_OUTPUT_MIN_TOKENS = env.int('LLM_OUTPUT_MIN_TOKENS', default=1024)
+LLM_OUTPUT_MAX_TOKENS = env.int('LLM_OUTPUT_MAX_TOKENS', default=8192)
+LLM_OUTPUT_MAX_CONTINUATIONS = env.int('LLM_OUTPUT_MAX_CONTINUATIONS', default=2)
+
+# Provider routing: each extraction goes to the configured LLM provider (Anthropic or
+# Bedrock) with the lowest moving-average latency (LLM_ROUTER_EWMA_ALPHA) among those
+# failing less than LLM_ROUTER_MAX_ERROR_RATE of calls over the last
+# LLM_ROUTER_ERROR_WINDOW_SECONDS, and fails over to the next; with LLM_HEDGING_ENABLED,
+# a call still running after the provider's LLM_HEDGE_PERCENTILE latency is also sent
+# to the next provider and the first answer wins (the other is still billed)
+LLM_ROUTER_EWMA_ALPHA = env.float('LLM_ROUTER_EWMA_ALPHA', default=0.3)
+LLM_ROUTER_ERROR_WINDOW_SECONDS = env.float('LLM_ROUTER_ERROR_WINDOW_SECONDS', default=300.0)
+LLM_ROUTER_MAX_ERROR_RATE = env.float('LLM_ROUTER_MAX_ERROR_RATE', default=0.5)
+LLM_ROUTER_MIN_SAMPLES = env.int('LLM_ROUTER_MIN_SAMPLES', default=5)
+LLM_HEDGING_ENABLED = env.bool('LLM_HEDGING_ENABLED', default=False)
+LLM_HEDGE_PERCENTILE = env.float('LLM_HEDGE_PERCENTILE', default=95.0)
+
+# Rate limiting: every process's LLM calls share each provider's budget of requests
+# and tokens per minute (set them to the account's limits), kept in Redis at
+# LLM_RATE_LIMIT_REDIS_URL or, without it, in files under LLM_RATE_LIMIT_DIR (one
+# host). Calls over budget, or refused with a 429, wait for capacity for up to
+# LLM_RATE_LIMIT_MAX_WAIT_SECONDS instead of failing
+LLM_RATE_LIMIT_ENABLED = env.bool('LLM_RATE_LIMIT_ENABLED', default=True)
+LLM_RATE_LIMIT_REQUESTS_PER_MINUTE = env.int('LLM_RATE_LIMIT_REQUESTS_PER_MINUTE', default=50)
+LLM_RATE_LIMIT_TOKENS_PER_MINUTE = env.int('LLM_RATE_LIMIT_TOKENS_PER_MINUTE', default=400000)
+LLM_RATE_LIMIT_MAX_WAIT_SECONDS = env.float('LLM_RATE_LIMIT_MAX_WAIT_SECONDS', default=300.0)
+LLM_RATE_LIMIT_MAX_RETRIES = env.int('LLM_RATE_LIMIT_MAX_RETRIES', default=3)
+LLM_RATE_LIMIT_REDIS_URL = env('LLM_RATE_LIMIT_REDIS_URL', default='')
+LLM_RATE_LIMIT_DIR = env('LLM_RATE_LIMIT_DIR', default='')
+
+# Circuit breaking: after LLM_CIRCUIT_FAILURE_THRESHOLD provider failures in a row
+# (timeouts, connection errors, 5xx), calls to that provider are refused at once and
+# routed to the other one for LLM_CIRCUIT_OPEN_SECONDS, then a single probe call
+# decides whether it is back. The state is shared like the rate limits
+LLM_CIRCUIT_BREAKER_ENABLED = env.bool('LLM_CIRCUIT_BREAKER_ENABLED', default=True)
+LLM_CIRCUIT_FAILURE_THRESHOLD = env.int('LLM_CIRCUIT_FAILURE_THRESHOLD', default=5)
+LLM_CIRCUIT_FAILURE_WINDOW_SECONDS = env.float('LLM_CIRCUIT_FAILURE_WINDOW_SECONDS', default=60.0)
+LLM_CIRCUIT_OPEN_SECONDS = env.float('LLM_CIRCUIT_OPEN_SECONDS', default=30.0)
+LLM_CIRCUIT_REDIS_URL = env('LLM_CIRCUIT_REDIS_URL', default=LLM_RATE_LIMIT_REDIS_URL)
+LLM_CIRCUIT_DIR = env('LLM_CIRCUIT_DIR', default='')
+
+# Classification cascade: before the full extraction, a document's type is read off
+# its first page's title or, failing that, asked of a small, fast model from the
+# first page's text or a low-resolution image of it; only invoices, credit notes and
+# reminders (or documents classified with less than LLM_CASCADE_MIN_CONFIDENCE) go on
+# to be extracted. Each stage's time and cost is recorded in the job's render_stats
+LLM_CASCADE_ENABLED = env.bool('LLM_CASCADE_ENABLED', default=True)
+LLM_CASCADE_USE_HEURISTIC = env.bool('LLM_CASCADE_USE_HEURISTIC', default=True)
+LLM_CASCADE_IMAGE_LONG_EDGE = env.int('LLM_CASCADE_IMAGE_LONG_EDGE', default=768)
+LLM_CASCADE_MIN_CONFIDENCE = env.float('LLM_CASCADE_MIN_CONFIDENCE', default=0.8)
+
+# Model selection: each document's complexity (page count, text-layer characters per
+# page, table lines counted on its pages) picks the extraction's model tier and output
+# budget. Documents within every LLM_MODEL_SELECTION_SIMPLE_* threshold go to the fast
+# model; the others to the standard one. The decision is recorded on the job's
+# model_selection, so the thresholds can be tuned. Off until they have been
+LLM_MODEL_SELECTION_ENABLED = env.bool('LLM_MODEL_SELECTION_ENABLED', default=False)
+LLM_MODEL_SELECTION_SIMPLE_MAX_PAGES = env.int('LLM_MODEL_SELECTION_SIMPLE_MAX_PAGES', default=2)
+LLM_MODEL_SELECTION_SIMPLE_MAX_CHARS_PER_PAGE = env.int('LLM_MODEL_SELECTION_SIMPLE_MAX_CHARS_PER_PAGE', default=4000)
+LLM_MODEL_SELECTION_SIMPLE_MAX_TABLE_LINES = env.int('LLM_MODEL_SELECTION_SIMPLE_MAX_TABLE_LINES', default=20)
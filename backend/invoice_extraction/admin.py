@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import InvoiceExtractionJob, ExtractedInvoice, ExtractedLineItem
+from .models import InvoiceExtractionJob, ExtractedInvoice, ExtractedLineItem, VendorTemplate
 
 
 class ExtractedLineItemInline(admin.TabularInline):
@@ -14,7 +14,7 @@ class InvoiceExtractionJobAdmin(admin.ModelAdmin):
     list_display = ('id', 'original_filename', 'file_type', 'status', 'ai_service_used', 'processing_time_seconds', 'created_at', 'processed_at')
     list_filter = ('status', 'file_type', 'ai_service_used', 'created_at', 'processed_at')
     search_fields = ('original_filename', 'id', 'error_message')
-    readonly_fields = ('id', 'created_at', 'updated_at', 'processed_at', 'processing_time_seconds')
+    readonly_fields = ('id', 'created_at', 'updated_at', 'processed_at', 'processing_time_seconds', 'render_stats', 'model_selection', 'duplicate_of')
     date_hierarchy = 'created_at'
     ordering = ('-created_at',)
     
@@ -26,7 +26,7 @@ class InvoiceExtractionJobAdmin(admin.ModelAdmin):
             'fields': ('status', 'error_message')
         }),
         ('Processing Details', {
-            'fields': ('ai_service_used', 'processing_time_seconds'),
+            'fields': ('ai_service_used', 'processing_time_seconds', 'render_stats', 'model_selection', 'duplicate_of'),
             'classes': ('collapse',)
         }),
         ('Timestamps', {
@@ -93,3 +93,29 @@ class ExtractedLineItemAdmin(admin.ModelAdmin):
             'classes': ('collapse',)
         }),
     )
+
+
+@admin.register(VendorTemplate)
+class VendorTemplateAdmin(admin.ModelAdmin):
+    list_display = ('vendor_name', 'status', 'sample_count', 'hit_count', 'fallback_count', 'updated_at')
+    list_filter = ('status', 'updated_at')
+    search_fields = ('vendor_name', 'vendor_key', 'last_fallback_reason')
+    readonly_fields = ('vendor_key', 'sample_count', 'hit_count', 'fallback_count', 'last_fallback_reason', 'created_at', 'updated_at')
+    ordering = ('vendor_name',)
+    
+    fieldsets = (
+        ('Vendor', {
+            'fields': ('vendor_name', 'vendor_key', 'status')
+        }),
+        ('Usage', {
+            'fields': ('sample_count', 'hit_count', 'fallback_count', 'last_fallback_reason')
+        }),
+        ('Learned Layout', {
+            'fields': ('template', 'observations'),
+            'classes': ('collapse',)
+        }),
+        ('System Information', {
+            'fields': ('created_at', 'updated_at'),
+            'classes': ('collapse',)
+        }),
+    )
@@ -4,3 +4,55 @@ from django.apps import AppConfig
 class InvoiceExtractionConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'invoice_extraction'
+
+    def ready(self):
+        from django.conf import settings
+        from ai_engineering.client_registry import ConnectionSettings, configure_clients
+        from ai_engineering.structured_output import OutputPolicy
+        from ai_engineering.provider_router import RouterPolicy, configure_router
+        from ai_engineering.rate_limit import RateLimitPolicy, configure_rate_limiter
+        from ai_engineering.circuit_breaker import BreakerPolicy, configure_circuit_breaker
+
+        # The shared LLM clients are built lazily; this only sets their connection limits, caching and output budget
+        configure_clients(ConnectionSettings(
+            max_connections=settings.LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.LLM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.LLM_KEEPALIVE_EXPIRY,
+            connect_timeout=settings.LLM_CONNECT_TIMEOUT,
+            read_timeout=settings.LLM_READ_TIMEOUT,
+            max_retries=settings.LLM_MAX_RETRIES,
+            anthropic_prompt_caching=settings.ANTHROPIC_PROMPT_CACHING,
+            bedrock_prompt_caching=settings.BEDROCK_PROMPT_CACHING,
+            output_policy=OutputPolicy(
+                tokens_per_line_item=settings.LLM_OUTPUT_TOKENS_PER_LINE_ITEM,
+                line_items_per_page=settings.LLM_OUTPUT_LINE_ITEMS_PER_PAGE,
+                min_tokens=settings.LLM_OUTPUT_MIN_TOKENS,
+                max_tokens=settings.LLM_OUTPUT_MAX_TOKENS,
+                max_continuations=settings.LLM_OUTPUT_MAX_CONTINUATIONS,
+            ),
+        ))
+        configure_router(RouterPolicy(
+            ewma_alpha=settings.LLM_ROUTER_EWMA_ALPHA,
+            error_window_seconds=settings.LLM_ROUTER_ERROR_WINDOW_SECONDS,
+            max_error_rate=settings.LLM_ROUTER_MAX_ERROR_RATE,
+            min_samples=settings.LLM_ROUTER_MIN_SAMPLES,
+            hedging=settings.LLM_HEDGING_ENABLED,
+            hedge_percentile=settings.LLM_HEDGE_PERCENTILE,
+        ))
+        configure_rate_limiter(RateLimitPolicy(
+            enabled=settings.LLM_RATE_LIMIT_ENABLED,
+            requests_per_minute=settings.LLM_RATE_LIMIT_REQUESTS_PER_MINUTE,
+            tokens_per_minute=settings.LLM_RATE_LIMIT_TOKENS_PER_MINUTE,
+            max_wait_seconds=settings.LLM_RATE_LIMIT_MAX_WAIT_SECONDS,
+            max_retries=settings.LLM_RATE_LIMIT_MAX_RETRIES,
+            redis_url=settings.LLM_RATE_LIMIT_REDIS_URL,
+            state_dir=settings.LLM_RATE_LIMIT_DIR,
+        ))
+        configure_circuit_breaker(BreakerPolicy(
+            enabled=settings.LLM_CIRCUIT_BREAKER_ENABLED,
+            failure_threshold=settings.LLM_CIRCUIT_FAILURE_THRESHOLD,
+            failure_window_seconds=settings.LLM_CIRCUIT_FAILURE_WINDOW_SECONDS,
+            open_seconds=settings.LLM_CIRCUIT_OPEN_SECONDS,
+            redis_url=settings.LLM_CIRCUIT_REDIS_URL,
+            state_dir=settings.LLM_CIRCUIT_DIR,
+        ))
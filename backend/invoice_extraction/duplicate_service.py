@@ -0,0 +1,164 @@
+"""
+Duplicate Document Service
+
+This service records a fingerprint of every uploaded PDF and image and checks
+new uploads against earlier, completed extraction jobs before any LLM call, so
+an invoice a supplier re-sends as a new file is not extracted (and paid for)
+twice.
+
+A new upload is a duplicate of an earlier job when, in order of cost:
+1. Its bytes are identical
+2. Both are born-digital PDFs with identical text
+3. Every page's perceptual hash is within PAGE_FINGERPRINT_MAX_HAMMING bits of
+   the earlier document's, found through the indexed hash bands, and the pages
+   still match once aligned and compared pixel by pixel
+"""
+
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Q
+
+from ai_engineering.document_fingerprint import (
+    HASH_BANDS,
+    DocumentFingerprint as Fingerprint,
+    FingerprintPolicy,
+    band_neighbourhood,
+    band_radius,
+    compute_document_fingerprint,
+    hash_bands,
+    verify_duplicate,
+)
+from ai_engineering.image_processor import hamming_distance
+from ai_engineering.render_sandbox import SandboxPolicy
+
+from .models import DocumentFingerprint, InvoiceExtractionJob, PageFingerprint
+
+logger = logging.getLogger(__name__)
+
+
+class DuplicateDocumentService:
+    """Service for fingerprinting uploads and finding earlier jobs for the same document."""
+
+    def _get_policy(self) -> FingerprintPolicy:
+        """Build the fingerprint policy from settings."""
+        sandbox = None
+        if settings.PDF_RENDER_SANDBOX_ENABLED:
+            sandbox = SandboxPolicy(
+                page_timeout=settings.PDF_RENDER_PAGE_TIMEOUT,
+                memory_limit_mb=settings.PDF_RENDER_MEMORY_LIMIT_MB,
+                max_pages=settings.PDF_RENDER_MAX_PAGES,
+            )
+        return FingerprintPolicy(
+            max_hamming=settings.PAGE_FINGERPRINT_MAX_HAMMING,
+            max_block_difference=settings.DUPLICATE_DETECTION_MAX_BLOCK_DIFFERENCE,
+            sandbox=sandbox,
+        )
+
+    def _originals(self):
+        """Fingerprints of completed jobs that were extracted rather than matched as duplicates."""
+        return DocumentFingerprint.objects.filter(
+            extraction_job__status='COMPLETED',
+            extraction_job__duplicate_of__isnull=True,
+        ).select_related('extraction_job')
+
+    def record(self, job: InvoiceExtractionJob, file_bytes: bytes) -> Optional[Fingerprint]:
+        """Fingerprint a job's upload and store it so later uploads can be matched against it."""
+        fingerprint = compute_document_fingerprint(file_bytes, job.file_type, self._get_policy())
+        if fingerprint is None:
+            return None
+
+        document = DocumentFingerprint.objects.create(
+            extraction_job=job,
+            file_sha256=fingerprint.file_sha256,
+            text_digest=fingerprint.text_digest or '',
+            page_count=fingerprint.page_count,
+        )
+        PageFingerprint.objects.bulk_create([
+            PageFingerprint(
+                document=document,
+                page_number=page_number,
+                phash=f"{phash:016x}",
+                **{f'band_{band}': value for band, value in enumerate(hash_bands(phash))},
+            )
+            for page_number, phash in enumerate(fingerprint.page_hashes)
+        ])
+        return fingerprint
+
+    def find_duplicate(
+        self,
+        job: InvoiceExtractionJob,
+        file_bytes: bytes,
+        fingerprint: Fingerprint,
+    ) -> Optional[Tuple[InvoiceExtractionJob, Dict[str, Any]]]:
+        """
+        Find an earlier completed job for the same document.
+
+        Returns:
+            (earlier job, evidence) or None if the upload is new
+        """
+        originals = self._originals().exclude(extraction_job=job)
+
+        same_file = originals.filter(file_sha256=fingerprint.file_sha256).first()
+        if same_file:
+            return same_file.extraction_job, {'match': 'identical_file'}
+
+        if fingerprint.text_digest:
+            same_text = originals.filter(text_digest=fingerprint.text_digest).first()
+            if same_text:
+                return same_text.extraction_job, {'match': 'identical_text'}
+
+        return self._find_visual_duplicate(job, file_bytes, fingerprint, originals)
+
+    def _find_visual_duplicate(self, job, file_bytes, fingerprint, originals):
+        """Look up candidates by first-page hash bands, then compare every page."""
+        policy = self._get_policy()
+        radius = band_radius(policy.max_hamming)
+        bands = hash_bands(fingerprint.page_hashes[0])
+        band_query = Q()
+        for band in range(HASH_BANDS):
+            band_query |= Q(**{f'band_{band}__in': band_neighbourhood(bands[band], radius)})
+
+        first_pages = PageFingerprint.objects.filter(
+            band_query,
+            page_number=0,
+            document__in=originals.filter(page_count=fingerprint.page_count),
+        ).select_related('document__extraction_job')
+
+        candidates = []
+        for first_page in first_pages:
+            document = first_page.document
+            # Two born-digital PDFs with different text are different documents,
+            # however alike they look
+            if fingerprint.text_digest and document.text_digest:
+                continue
+            page_hashes = [int(page.phash, 16) for page in document.pages.all()]
+            distances = [hamming_distance(a, b) for a, b in zip(fingerprint.page_hashes, page_hashes)]
+            if max(distances) <= policy.max_hamming:
+                candidates.append((max(distances), -document.created_at.timestamp(), document))
+
+        # Pixel verification re-renders the earlier upload, so only the closest few are checked
+        for distance, _, document in sorted(candidates, key=lambda c: c[:2])[:settings.DUPLICATE_DETECTION_MAX_CANDIDATES]:
+            candidate_job = document.extraction_job
+            try:
+                with candidate_job.uploaded_file.open('rb') as candidate_file:
+                    candidate_bytes = candidate_file.read()
+            except (OSError, ValueError) as e:
+                logger.warning(f"Cannot read upload of job {candidate_job.id} to verify a duplicate: {str(e)}")
+                continue
+
+            is_duplicate, difference = verify_duplicate(
+                file_bytes, job.file_type, candidate_bytes, candidate_job.file_type, policy,
+            )
+            logger.info(
+                f"Duplicate candidate {candidate_job.id} for {job.original_filename}: "
+                f"hash distance {distance}, block difference {difference}, duplicate={is_duplicate}"
+            )
+            if is_duplicate:
+                return candidate_job, {
+                    'match': 'visual',
+                    'hamming_distance': distance,
+                    'block_difference': difference,
+                }
+        return None
@@ -0,0 +1,128 @@
+import multiprocessing
+import os
+import resource
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+import fitz
+
+from ai_engineering.image_processor import (
+    DEFAULT_PDF_ZOOM,
+    bytes_to_cv2,
+    cv2_to_bytes,
+    extract_image_page_bytes,
+    extract_page_array,
+    preprocess_pdf_page_image,
+)
+
+
+def _render_legacy(page: fitz.Page, zoom: float) -> bytes:
+    """The original path: JPEG via PIL, decode with OpenCV, copy, re-encode."""
+    image_bytes = extract_image_page_bytes(page, zoom=zoom)
+    cv_image = bytes_to_cv2(image_bytes)
+    copied = cv_image.copy()
+    return cv2_to_bytes(copied)
+
+
+def _render_zero_copy(page: fitz.Page, zoom: float) -> bytes:
+    """The current path: pixmap samples viewed as an array and encoded once."""
+    cv_image, pixmap = extract_page_array(page, zoom=zoom)
+    return preprocess_pdf_page_image(cv_image).data
+
+
+def _max_rss_bytes() -> int:
+    """Peak resident set size of this process; ru_maxrss is in bytes on macOS and KB elsewhere."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _measure_render(pdf_bytes: bytes, render, zoom: float, repeat: int) -> dict:
+    """
+    Time one render path over every page, in a fresh process so its peak RSS
+    (which includes MuPDF's native allocations) belongs to this path alone.
+    """
+    with fitz.Document(stream=pdf_bytes, filetype="pdf") as doc:
+        baseline_rss = _max_rss_bytes()
+        # Warm-up so import and allocator costs don't skew the timings
+        render(doc[0], zoom)
+
+        timings = []
+        output_bytes = 0
+        for _ in range(repeat):
+            for page_num in range(len(doc)):
+                start = perf_counter()
+                data = render(doc[page_num], zoom)
+                timings.append(perf_counter() - start)
+                output_bytes = len(data)
+
+    timings.sort()
+    peak_rss = _max_rss_bytes()
+    return {
+        'median_ms': timings[len(timings) // 2] * 1000,
+        'peak_mb': peak_rss / (1024 * 1024),
+        'render_mb': (peak_rss - baseline_rss) / (1024 * 1024),
+        'output_kb': output_bytes / 1024,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Compare per-page time and peak memory (RSS) of the legacy and zero-copy PDF render paths'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'pdf_path',
+            nargs='?',
+            default=os.path.join(settings.BASE_DIR, 'fixtures', 'Invoice_P215396.pdf'),
+            help='PDF to render (default: fixtures/Invoice_P215396.pdf)'
+        )
+        parser.add_argument(
+            '--zoom',
+            type=float,
+            default=DEFAULT_PDF_ZOOM,
+            help=f'Render zoom factor (default: {DEFAULT_PDF_ZOOM})'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Times to render each page per path (default: 5)'
+        )
+
+    def handle(self, *args, **options):
+        pdf_path = options['pdf_path']
+        zoom = options['zoom']
+        repeat = options['repeat']
+
+        if not os.path.exists(pdf_path):
+            self.stdout.write(self.style.ERROR(f'PDF not found: {pdf_path}'))
+            return
+
+        with open(pdf_path, 'rb') as f:
+            pdf_bytes = f.read()
+
+        with fitz.Document(stream=pdf_bytes, filetype="pdf") as doc:
+            page_count = len(doc)
+        self.stdout.write(f'Rendering {page_count} page(s) x {repeat} at zoom {zoom}')
+
+        results = {}
+        for name, render in (('legacy', _render_legacy), ('zero-copy', _render_zero_copy)):
+            # A spawned child per path: peak RSS never goes down, so paths can't share a process
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                results[name] = executor.submit(_measure_render, pdf_bytes, render, zoom, repeat).result()
+
+        for name, result in results.items():
+            self.stdout.write(
+                f"  {name:<10} {result['median_ms']:8.1f} ms/page   "
+                f"peak RSS {result['peak_mb']:7.1f} MB (+{result['render_mb']:.1f} MB rendering)   "
+                f"last page {result['output_kb']:7.1f} KB"
+            )
+
+        legacy, zero_copy = results['legacy'], results['zero-copy']
+        self.stdout.write(self.style.SUCCESS(
+            f"Saved {legacy['median_ms'] - zero_copy['median_ms']:.1f} ms/page and "
+            f"{legacy['render_mb'] - zero_copy['render_mb']:.1f} MB of peak RSS "
+            f"(process RSS, including MuPDF's native allocations)"
+        ))
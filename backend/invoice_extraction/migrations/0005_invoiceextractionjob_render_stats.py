@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-17 00:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice_extraction', '0004_extractedinvoice_payment_method'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoiceextractionjob',
+            name='render_stats',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
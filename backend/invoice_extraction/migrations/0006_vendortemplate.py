@@ -0,0 +1,33 @@
+# Generated by Django 5.0.1 on 2026-10-17 01:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice_extraction', '0005_invoiceextractionjob_render_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VendorTemplate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vendor_key', models.CharField(max_length=255, unique=True)),
+                ('vendor_name', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('LEARNING', 'Learning'), ('ACTIVE', 'Active'), ('DISABLED', 'Disabled')], default='LEARNING', max_length=20)),
+                ('observations', models.JSONField(blank=True, default=list)),
+                ('template', models.JSONField(blank=True, default=dict)),
+                ('sample_count', models.PositiveIntegerField(default=0)),
+                ('hit_count', models.PositiveIntegerField(default=0)),
+                ('fallback_count', models.PositiveIntegerField(default=0)),
+                ('last_fallback_reason', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['vendor_name'],
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.0.1 on 2026-10-17 01:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice_extraction', '0006_vendortemplate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoiceextractionjob',
+            name='duplicate_of',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='invoice_extraction.invoiceextractionjob'),
+        ),
+        migrations.CreateModel(
+            name='DocumentFingerprint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_sha256', models.CharField(db_index=True, max_length=64)),
+                ('text_digest', models.CharField(blank=True, db_index=True, max_length=64)),
+                ('page_count', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('extraction_job', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='fingerprint', to='invoice_extraction.invoiceextractionjob')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PageFingerprint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('page_number', models.PositiveIntegerField()),
+                ('phash', models.CharField(max_length=16)),
+                ('band_0', models.PositiveIntegerField(db_index=True)),
+                ('band_1', models.PositiveIntegerField(db_index=True)),
+                ('band_2', models.PositiveIntegerField(db_index=True)),
+                ('band_3', models.PositiveIntegerField(db_index=True)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pages', to='invoice_extraction.documentfingerprint')),
+            ],
+            options={
+                'ordering': ['document', 'page_number'],
+                'unique_together': {('document', 'page_number')},
+            },
+        ),
+    ]
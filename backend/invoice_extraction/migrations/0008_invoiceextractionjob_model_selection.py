@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-17 01:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice_extraction', '0007_document_fingerprints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoiceextractionjob',
+            name='model_selection',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
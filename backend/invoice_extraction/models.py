@@ -24,6 +24,9 @@ class InvoiceExtractionJob(models.Model):
     # Processing details
     ai_service_used = models.CharField(max_length=50, blank=True)  # anthropic, bedrock, mock
     processing_time_seconds = models.FloatField(null=True, blank=True)
+    render_stats = models.JSONField(default=dict, blank=True)  # page sizes, bytes and tokens vs fixed-zoom rendering
+    model_selection = models.JSONField(default=dict, blank=True)  # model tier and output budget chosen from the document's complexity
+    duplicate_of = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='duplicates')
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -78,3 +81,68 @@ class ExtractedLineItem(models.Model):
 
     def __str__(self):
         return f"Line Item: {self.description or 'No Description'} ({self.extracted_invoice.invoice_number or 'No Invoice Number'})"
+
+
+class VendorTemplate(models.Model):
+    """Field layout learned from a vendor's invoices, used to extract repeat invoices without an LLM call."""
+    STATUS_CHOICES = [
+        ('LEARNING', 'Learning'),
+        ('ACTIVE', 'Active'),
+        ('DISABLED', 'Disabled'),
+    ]
+
+    vendor_key = models.CharField(max_length=255, unique=True)  # normalized vendor name
+    vendor_name = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='LEARNING')
+
+    # Most recent LLM extractions of this vendor's PDFs, used to (re)learn the template
+    observations = models.JSONField(default=list, blank=True)
+    template = models.JSONField(default=dict, blank=True)
+
+    sample_count = models.PositiveIntegerField(default=0)
+    hit_count = models.PositiveIntegerField(default=0)
+    fallback_count = models.PositiveIntegerField(default=0)
+    last_fallback_reason = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['vendor_name']
+
+    def __str__(self):
+        return f"Vendor Template {self.vendor_name} ({self.get_status_display()})"
+
+
+class DocumentFingerprint(models.Model):
+    """Content hashes of an uploaded document, used to recognise re-sent duplicates before extraction."""
+    extraction_job = models.OneToOneField(InvoiceExtractionJob, on_delete=models.CASCADE, related_name='fingerprint')
+    file_sha256 = models.CharField(max_length=64, db_index=True)
+    text_digest = models.CharField(max_length=64, blank=True, db_index=True)  # empty for scans and images
+    page_count = models.PositiveIntegerField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Fingerprint of {self.extraction_job.original_filename}"
+
+
+class PageFingerprint(models.Model):
+    """Perceptual hash of one page, split into 16-bit bands for multi-index Hamming search."""
+    document = models.ForeignKey(DocumentFingerprint, on_delete=models.CASCADE, related_name='pages')
+    page_number = models.PositiveIntegerField()
+    phash = models.CharField(max_length=16)  # 64-bit hash as hex
+    band_0 = models.PositiveIntegerField(db_index=True)
+    band_1 = models.PositiveIntegerField(db_index=True)
+    band_2 = models.PositiveIntegerField(db_index=True)
+    band_3 = models.PositiveIntegerField(db_index=True)
+
+    class Meta:
+        ordering = ['document', 'page_number']
+        unique_together = ['document', 'page_number']
+
+    def __str__(self):
+        return f"Page {self.page_number + 1} of {self.document.extraction_job.original_filename}: {self.phash}"
@@ -34,7 +34,7 @@ class InvoiceExtractionJobSerializer(serializers.ModelSerializer):
         model = InvoiceExtractionJob
         fields = [
             'id', 'original_filename', 'file_type', 'status', 'ai_service_used',
-            'processing_time_seconds', 'error_message', 'created_at', 'updated_at',
+            'processing_time_seconds', 'render_stats', 'model_selection', 'duplicate_of', 'error_message', 'created_at', 'updated_at',
             'extracted_invoices'
         ]
 
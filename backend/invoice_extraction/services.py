@@ -1,20 +1,37 @@
 import os
 import base64
+import logging
 import tempfile
 import shutil
 from typing import Dict, Any, Optional, List, Tuple
 from django.core.files.uploadedfile import UploadedFile
 from django.conf import settings
+from django.db import connection
 from django.utils import timezone
 from decimal import Decimal
 import json
 from datetime import datetime, timedelta
 import time
 import csv
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from types import SimpleNamespace
 
-from ai_engineering.anthropic_client import AnthropicClient
-from ai_engineering.bedrock_client import BedrockClient
-from ai_engineering.image_processor import get_image_from_pdf
+from ai_engineering.client_registry import get_anthropic_client, get_bedrock_client, get_output_policy
+from ai_engineering.concurrency import run_sync
+from ai_engineering.prompt_cache import combine_usage, usage_cost
+from ai_engineering.cascade import EXTRACTABLE_TYPES, CascadePolicy, classify_from_text, first_page_text, should_extract
+from ai_engineering.json_stream import ExtractionEvents
+from ai_engineering.model_selection import DocumentComplexity, ModelSelection, SelectionPolicy, select_model, text_complexity
+from ai_engineering.provider_router import attempt_abandoned, get_provider_router
+from ai_engineering.image_processor import get_image_from_pdf, spool_image_from_pdf, PageSpool, bytes_to_cv2, count_table_lines, render_overview_image, shrink_image, RenderOptions, ResolutionBudget, RenderStats, TriagePolicy, PreprocessPolicy, TilingPolicy
+from ai_engineering.image_encoding import EncodingPolicy, ImagePayload
+from ai_engineering.page_cache import PageCache, get_page_cache
+from ai_engineering.render_sandbox import SandboxPolicy
+from ai_engineering.text_layer import TextLayer, TextLayerPolicy, extract_text_layer
+from ai_engineering.segmentation import Segment, SegmentationPolicy, segment_pdf, split_pdf
+from ai_engineering.windowing import Window, WindowPolicy, extract_in_windows_async, merge_window_results, needs_windows, plan_windows
 from ai_engineering.document_matching import find_best_match, calculate_match_confidence
 from ai_engineering.data_comparison import perform_comprehensive_comparison
 from purchase_orders.models import PurchaseOrder
@@ -22,16 +39,24 @@ from invoices.models import Invoice, InvoiceLineItem, Company, Vendor, Item
 from invoices.assignment_service import InvoiceAssignmentService
 
 from .models import InvoiceExtractionJob, ExtractedInvoice, ExtractedLineItem
+from .template_service import VendorTemplateService
+from .duplicate_service import DuplicateDocumentService
+
+logger = logging.getLogger(__name__)
 
 
 class InvoiceExtractionService:
     """Service for processing invoice files and extracting data."""
     
     def __init__(self):
-        # Set up references to the AI classes
-        self.AnthropicClient = AnthropicClient
-        self.BedrockClient = BedrockClient
+        # Set up references to the shared, per-process AI clients
+        self.get_anthropic_client = get_anthropic_client
+        self.get_bedrock_client = get_bedrock_client
+        self.router = get_provider_router()
         self.get_image_from_pdf = get_image_from_pdf
+        self.spool_image_from_pdf = spool_image_from_pdf
+        self.template_service = VendorTemplateService()
+        self.duplicate_service = DuplicateDocumentService()
     
     def process_file(self, extraction_job) -> Dict[str, Any]:
         """Process a file and extract invoice data."""
@@ -61,25 +86,26 @@ class InvoiceExtractionService:
             
             # Process based on file type
             if file_extension == '.pdf':
-                # Convert PDF to image
-                image_base64 = self.get_image_from_pdf(file_bytes)
+                # Convert PDF to page images, spooled so only one page is in memory at a time
+                image_base64 = self.spool_image_from_pdf(
+                    file_bytes,
+                    workers=settings.PDF_RENDER_WORKERS,
+                    options=self._get_render_options(),
+                    max_memory_bytes=settings.PDF_PAGE_SPOOL_MAX_MEMORY,
+                    cache=self._get_page_cache(),
+                )
+                del file_bytes
                 if not image_base64:
                     return {"error": "Failed to process PDF file"}
             elif file_extension in ['.jpg', '.jpeg', '.png']:
                 # For image files, encode directly to base64
-                image_base64 = base64.b64encode(file_bytes).decode('utf-8')
+                image_base64 = self._image_payload(file_bytes, file_extension)
             else:
                 return {"error": f"Unsupported file type: {file_extension}"}
             
             # Choose which client to use based on environment variables
-            ai_service_used = 'mock'
-            if settings.ANTHROPIC_API_KEY:
-                client = self.AnthropicClient()
-                ai_service_used = 'anthropic'
-            elif settings.AWS_DEFAULT_REGION and settings.AWS_ACCESS_KEY_ID:
-                client = self.BedrockClient()
-                ai_service_used = 'bedrock'
-            else:
+            clients = self._available_clients()
+            if not clients:
                 # If no API keys are available, return a mock response for testing
                 return {
                     "document_type": "invoice",
@@ -105,10 +131,15 @@ class InvoiceExtractionService:
                     }]
                 }
             
-            # Extract invoice data
-            result = client.extract_invoice_data(image_base64)
+            # Extract invoice data with the fastest healthy AI service
+            try:
+                routed = self.router.call(clients, lambda client: client.extract_invoice_data(image_base64))
+            finally:
+                if hasattr(image_base64, 'close'):
+                    image_base64.close()
+            result = routed.result
             if result:
-                result['ai_service_used'] = ai_service_used
+                result['ai_service_used'] = routed.provider
                 return result
             else:
                 return {"error": "Failed to extract invoice data"}
@@ -223,12 +254,103 @@ class InvoiceExtractionService:
         except (ValueError, TypeError):
             return 0.0
 
-    def extract_invoice_data(self, job: InvoiceExtractionJob) -> Dict[str, Any]:
+    def _get_render_options(self) -> RenderOptions:
+        """Build the default PDF page render options from settings."""
+        encoding = None
+        if settings.PAGE_ENCODING_OPTIMIZE:
+            encoding = EncodingPolicy(
+                allow_grayscale=settings.PAGE_ENCODING_ALLOW_GRAYSCALE,
+                allow_png=settings.PAGE_ENCODING_ALLOW_PNG,
+                min_edge_f1=settings.PAGE_ENCODING_MIN_EDGE_F1,
+            )
+        triage = None
+        if settings.PAGE_TRIAGE_SKIP_BLANK or settings.PAGE_TRIAGE_SKIP_DUPLICATES:
+            triage = TriagePolicy(
+                skip_blank=settings.PAGE_TRIAGE_SKIP_BLANK,
+                skip_duplicates=settings.PAGE_TRIAGE_SKIP_DUPLICATES,
+                blank_ink_coverage=settings.PAGE_TRIAGE_BLANK_INK_COVERAGE,
+                max_hamming=settings.PAGE_TRIAGE_MAX_HAMMING,
+            )
+        preprocess = None
+        if settings.PAGE_PREPROCESS_CROP_MARGINS or settings.PAGE_PREPROCESS_DESKEW or settings.PAGE_PREPROCESS_MAX_LONG_EDGE:
+            preprocess = PreprocessPolicy(
+                crop_margins=settings.PAGE_PREPROCESS_CROP_MARGINS,
+                deskew=settings.PAGE_PREPROCESS_DESKEW,
+                max_long_edge=settings.PAGE_PREPROCESS_MAX_LONG_EDGE or None,
+            )
+        tiling = None
+        if settings.PDF_RENDER_TILING:
+            tiling = TilingPolicy(
+                overview_long_edge=settings.PDF_RENDER_TILING_OVERVIEW_LONG_EDGE,
+                max_tiles=settings.PDF_RENDER_TILING_MAX_TILES,
+            )
+        return RenderOptions(
+            budget=ResolutionBudget(
+                target_long_edge=settings.PDF_RENDER_TARGET_LONG_EDGE or None,
+                max_megapixels=settings.PDF_RENDER_MAX_MEGAPIXELS or None,
+                min_zoom=settings.PDF_RENDER_MIN_ZOOM,
+                max_zoom=settings.PDF_RENDER_MAX_ZOOM,
+            ),
+            encoding=encoding,
+            triage=triage,
+            preprocess=preprocess,
+            tiling=tiling,
+            table_lines=settings.LLM_MODEL_SELECTION_ENABLED,
+            sandbox=self._get_sandbox_policy(),
+        )
+
+    def _get_sandbox_policy(self) -> Optional[SandboxPolicy]:
+        """Build the sandboxed rendering limits from settings, or None to render in-process."""
+        if not settings.PDF_RENDER_SANDBOX_ENABLED:
+            return None
+        return SandboxPolicy(
+            page_timeout=settings.PDF_RENDER_PAGE_TIMEOUT,
+            memory_limit_mb=settings.PDF_RENDER_MEMORY_LIMIT_MB,
+            max_pages=settings.PDF_RENDER_MAX_PAGES,
+        )
+
+    def _get_text_layer_policy(self) -> TextLayerPolicy:
+        """Build the text layer fast path policy from settings."""
+        return TextLayerPolicy(
+            min_chars_per_page=settings.PDF_TEXT_LAYER_MIN_CHARS_PER_PAGE,
+            include_overview_image=settings.PDF_TEXT_LAYER_OVERVIEW_IMAGE,
+            overview_long_edge=settings.PDF_TEXT_LAYER_OVERVIEW_LONG_EDGE,
+        )
+
+    def _get_segmentation_policy(self) -> SegmentationPolicy:
+        """Build the multi-invoice segmentation policy from settings."""
+        return SegmentationPolicy(
+            use_page_similarity=settings.PDF_SEGMENTATION_PAGE_SIMILARITY,
+            max_layout_hamming=settings.PDF_SEGMENTATION_MAX_LAYOUT_HAMMING,
+            sandbox=self._get_sandbox_policy(),
+        )
+
+    def _get_page_cache(self) -> Optional[PageCache]:
+        """Return the shared rendered page cache, or None when caching is disabled."""
+        if not settings.PDF_PAGE_CACHE_ENABLED:
+            return None
+        return get_page_cache(settings.PDF_PAGE_CACHE_DIR, settings.PDF_PAGE_CACHE_MAX_BYTES)
+
+    def _image_payload(self, file_bytes: bytes, file_extension: str) -> ImagePayload:
+        """Wrap an uploaded image file for the LLM, labelled with its real media type."""
+        media_type = 'image/png' if file_extension.lstrip('.') == 'png' else 'image/jpeg'
+        return ImagePayload(data=base64.b64encode(file_bytes).decode('utf-8'), media_type=media_type)
+
+    def extract_invoice_data(
+        self,
+        job: InvoiceExtractionJob,
+        render_options: Optional[RenderOptions] = None,
+        events: Optional[ExtractionEvents] = None,
+    ) -> Dict[str, Any]:
         """
         Extract invoice data from uploaded file.
         
         Args:
             job: InvoiceExtractionJob instance
+            render_options: Per-document override of the PDF page render options
+                (zoom, resolution budget, encoding)
+            events: Callbacks for invoices and their key fields as the model writes
+                them; documents extracted in one request are streamed to report them
             
         Returns:
             Dict containing extraction results in frontend-compatible format
@@ -239,19 +361,26 @@ class InvoiceExtractionService:
         try:
             # Record start time
             start_time = time.time()
+            events = self._unless_abandoned(events)
             
-            # Process the file based on type
-            if job.file_type == 'pdf':
-                extracted_data = self._extract_from_pdf(job)
+            # Re-sent copies of an earlier document reuse its result; otherwise
+            # process the file based on type
+            duplicate_data = self._extract_from_duplicate(job) if settings.DUPLICATE_DETECTION_ENABLED else None
+            if duplicate_data is not None:
+                extracted_data = duplicate_data
+            elif job.file_type == 'pdf':
+                extracted_data = self._extract_from_pdf(job, render_options, events)
             elif job.file_type == 'csv':
                 extracted_data = self._extract_from_csv(job)
             elif job.file_type in ['jpg', 'jpeg', 'png']:
-                extracted_data = self._extract_from_image(job)
+                extracted_data = self._extract_from_image(job, events)
             else:
                 raise ValueError(f"Unsupported file type: {job.file_type}")
             
-            # Record processing time
+            # Record processing time and the LLM tokens spent, including prompt cache reads and writes
             job.processing_time_seconds = time.time() - start_time
+            if extracted_data.get('usage'):
+                job.render_stats = {**job.render_stats, 'llm_usage': extracted_data['usage']}
             job.processed_at = timezone.now()
             
             # Create ExtractedInvoice model instances
@@ -291,7 +420,7 @@ class InvoiceExtractionService:
                 extracted_invoices.append(invoice_data)
             
             return {
-                'document_type': 'invoice',
+                'document_type': extracted_data.get('document_type') or 'invoice',
                 'extracted_invoices': extracted_invoices
             }
                 
@@ -301,43 +430,457 @@ class InvoiceExtractionService:
             job.save()
             raise e
 
-    def _extract_from_pdf(self, job: InvoiceExtractionJob) -> Dict[str, Any]:
+    @staticmethod
+    def _unless_abandoned(events: Optional[ExtractionEvents]) -> Optional[ExtractionEvents]:
+        """Events whose callbacks are skipped when reported by a hedged attempt that lost."""
+        if events is None:
+            return None
+        
+        def guarded(callback):
+            if callback is None:
+                return None
+            return lambda *args: None if attempt_abandoned() else callback(*args)
+        
+        return ExtractionEvents(on_field=guarded(events.on_field), on_invoice=guarded(events.on_invoice), fields=events.fields)
+
+    def _extract_from_duplicate(self, job: InvoiceExtractionJob) -> Optional[Dict[str, Any]]:
+        """Return an earlier job's result if this upload is a re-sent copy of its document."""
+        if job.file_type not in ['pdf', 'jpg', 'jpeg', 'png']:
+            return None
+        
+        try:
+            with open(job.uploaded_file.path, 'rb') as f:
+                file_bytes = f.read()
+            fingerprint = self.duplicate_service.record(job, file_bytes)
+            match = self.duplicate_service.find_duplicate(job, file_bytes, fingerprint) if fingerprint else None
+        except Exception as e:
+            # Duplicate detection is an optimization; never fail the extraction over it
+            logger.warning(f"Duplicate check failed for {job.original_filename}: {str(e)}")
+            return None
+        if match is None:
+            return None
+        
+        original_job, evidence = match
+        logger.info(f"{job.original_filename} is a duplicate of job {original_job.id} ({evidence['match']})")
+        job.duplicate_of = original_job
+        job.ai_service_used = 'duplicate'
+        job.render_stats = {'input_mode': 'duplicate', 'duplicate_of': str(original_job.id), **evidence}
+        
+        invoices = []
+        for extracted_invoice in original_job.extracted_invoices.order_by('id'):
+            invoices.append({
+                'number': extracted_invoice.invoice_number,
+                'po_number': extracted_invoice.po_number,
+                'amount': extracted_invoice.amount,
+                'tax_amount': extracted_invoice.tax_amount,
+                'currency_code': extracted_invoice.currency_code,
+                'date': extracted_invoice.date,
+                'due_date': extracted_invoice.due_date,
+                'payment_term_days': extracted_invoice.payment_term_days,
+                'vendor': extracted_invoice.vendor,
+                'billing_address': extracted_invoice.billing_address,
+                'payment_method': extracted_invoice.payment_method,
+                'processed_invoice_id': extracted_invoice.processed_invoice_id,
+                'line_items': list(extracted_invoice.line_items.order_by('id').values(
+                    'description', 'quantity', 'unit_price', 'total',
+                )),
+            })
+        return {'document_type': 'invoice', 'invoices': invoices}
+
+    def _extract_from_pdf(
+        self,
+        job: InvoiceExtractionJob,
+        render_options: Optional[RenderOptions] = None,
+        events: Optional[ExtractionEvents] = None,
+    ) -> Dict[str, Any]:
         """Extract data from PDF file."""
         file_path = job.uploaded_file.path
         
         try:
-            # Read the PDF file
-            with open(file_path, 'rb') as f:
-                file_bytes = f.read()
+            # Statements, remittances and the like are recognised by a cheap first
+            # stage and not sent to the full extraction (nor split into segments,
+            # since the invoice numbers they list would look like a bundle)
+            classification = None
+            if settings.LLM_CASCADE_ENABLED:
+                classification = self._classify_pdf(Path(file_path).read_bytes())
+                if not should_extract(classification, self._get_cascade_policy()):
+                    return self._skip_extraction(job, classification)
             
-            # Convert PDF to image for AI processing
-            image_base64 = self.get_image_from_pdf(file_bytes)
-            if not image_base64:
-                raise Exception("Failed to process PDF file - could not convert to image")
+            # Bundles of several invoices are split so that each invoice is extracted
+            # in its own, smaller request, concurrently with the others
+            extraction_start = time.time()
+            if settings.PDF_SEGMENTATION_ENABLED:
+                with open(file_path, 'rb') as f:
+                    file_bytes = f.read()
+                segments = segment_pdf(file_bytes, self._get_segmentation_policy())
+                if len(segments) > 1:
+                    result = self._extract_from_segments(job, split_pdf(file_bytes, segments), segments, render_options)
+                    return self._record_cascade(job, classification, time.time() - extraction_start, result)
+                del file_bytes
             
-            # Try to use available AI services
-            if hasattr(settings, 'ANTHROPIC_API_KEY') and settings.ANTHROPIC_API_KEY:
-                client = self.AnthropicClient()
-                result = client.extract_invoice_data(image_base64)
-                job.ai_service_used = 'anthropic'
-                if result:
-                    return result
-            
-            elif (hasattr(settings, 'AWS_DEFAULT_REGION') and settings.AWS_DEFAULT_REGION and 
-                  hasattr(settings, 'AWS_ACCESS_KEY_ID') and settings.AWS_ACCESS_KEY_ID):
-                client = self.BedrockClient()
-                result = client.extract_invoice_data(image_base64)
-                job.ai_service_used = 'bedrock'
-                if result:
-                    return result
-            
-            # If no AI services available, return an error
-            raise Exception("No AI extraction services configured. Please configure ANTHROPIC_API_KEY or AWS credentials.")
+            # Read the PDF file (not kept here, so it can be dropped once rendered)
+            result = self._extract_pdf_document(job, Path(file_path).read_bytes(), render_options, events)
+            return self._record_cascade(job, classification, time.time() - extraction_start, result)
             
         except Exception as e:
             job.ai_service_used = 'extraction_failed'
             raise Exception(f"PDF extraction failed: {str(e)}")
 
+    def _extract_pdf_document(
+        self,
+        job: InvoiceExtractionJob,
+        file_bytes: bytes,
+        render_options: Optional[RenderOptions] = None,
+        events: Optional[ExtractionEvents] = None,
+    ) -> Dict[str, Any]:
+        """Extract data from one PDF document: a whole upload or one invoice of a bundle."""
+        text_layer = None
+        if settings.PDF_TEXT_LAYER_ENABLED or settings.VENDOR_TEMPLATES_ENABLED:
+            text_layer = extract_text_layer(file_bytes, self._get_text_layer_policy())
+        
+        # Repeat suppliers with a learned layout are extracted locally, without the LLM
+        if text_layer is not None and settings.VENDOR_TEMPLATES_ENABLED:
+            result = self.template_service.extract(text_layer)
+            if result:
+                job.ai_service_used = 'vendor_template'
+                job.render_stats = {
+                    'input_mode': 'vendor_template',
+                    'pages': len(text_layer.pages),
+                    'vendor_template': result['vendor_template'],
+                }
+                return result
+        
+        # Born-digital PDFs with a trustworthy text layer are sent as text, which is
+        # far cheaper and faster than page images; anything else falls back to images
+        if text_layer is not None and settings.PDF_TEXT_LAYER_ENABLED:
+            result = self._extract_from_text_layer(job, file_bytes, text_layer, events)
+            if result:
+                self._learn_vendor_template(text_layer, result)
+                return result
+        
+        # Render pages into a spool so only one page image is in memory at a
+        # time, then drop the raw PDF before the (long) LLM call
+        render_stats = RenderStats()
+        page_spool = self.spool_image_from_pdf(
+            file_bytes,
+            workers=settings.PDF_RENDER_WORKERS,
+            options=render_options or self._get_render_options(),
+            stats=render_stats,
+            max_memory_bytes=settings.PDF_PAGE_SPOOL_MAX_MEMORY,
+            cache=self._get_page_cache(),
+        )
+        del file_bytes
+        job.render_stats = {**render_stats.as_dict(), 'input_mode': 'images'}
+        if not page_spool:
+            raise Exception("Failed to process PDF file - could not convert to image")
+        
+        # No table lines found on the rendered pages means they aren't known, not that there are none
+        selection = self._select_model(job, DocumentComplexity(page_count=render_stats.pages, table_lines=render_stats.table_lines or None))
+        windows = self._plan_windows(job, page_spool)
+        
+        # Use the fastest healthy AI service, failing over to the others. The spool
+        # is closed once no attempt reads it any more, which for a hedged attempt
+        # that lost is after the route returns
+        result = self._route(
+            job,
+            lambda client: self._extract_images(client, page_spool, windows, events, selection),
+            release=page_spool.close,
+        )
+        if result:
+            self._learn_vendor_template(text_layer, result)
+            return result
+        
+        # If no AI services available, return an error
+        raise Exception("No AI extraction services configured. Please configure ANTHROPIC_API_KEY or AWS credentials.")
+
+    def _available_clients(self) -> Dict[str, Any]:
+        """Client getters of the configured AI services, in preference order."""
+        clients = {}
+        if hasattr(settings, 'ANTHROPIC_API_KEY') and settings.ANTHROPIC_API_KEY:
+            clients['anthropic'] = self.get_anthropic_client
+        if (hasattr(settings, 'AWS_DEFAULT_REGION') and settings.AWS_DEFAULT_REGION and
+                hasattr(settings, 'AWS_ACCESS_KEY_ID') and settings.AWS_ACCESS_KEY_ID):
+            clients['bedrock'] = self.get_bedrock_client
+        return clients
+
+    def _route(self, job: InvoiceExtractionJob, extract, release=None) -> Optional[Dict[str, Any]]:
+        """
+        Run an extraction call on the fastest healthy AI service, failing over (or
+        hedging) to the others, and record which one answered on the job.
+        
+        Args:
+            job: The job to record the answering service on
+            extract: The extraction call, given a client
+            release: Frees the call's inputs once no attempt uses them
+        
+        Returns:
+            The extracted data, or None if no service is configured or none answered
+        """
+        clients = self._available_clients()
+        if not clients:
+            if release is not None:
+                release()
+            return None
+        routed = self.router.call(clients, extract, release)
+        job.ai_service_used = routed.provider
+        job.render_stats = {**job.render_stats, 'routing': routed.as_dict()}
+        return routed.result
+
+    def _get_selection_policy(self) -> SelectionPolicy:
+        """Build the model selection thresholds from settings."""
+        return SelectionPolicy(
+            simple_max_pages=settings.LLM_MODEL_SELECTION_SIMPLE_MAX_PAGES,
+            simple_max_chars_per_page=settings.LLM_MODEL_SELECTION_SIMPLE_MAX_CHARS_PER_PAGE,
+            simple_max_table_lines=settings.LLM_MODEL_SELECTION_SIMPLE_MAX_TABLE_LINES,
+        )
+
+    def _select_model(self, job: InvoiceExtractionJob, complexity: DocumentComplexity) -> Optional[ModelSelection]:
+        """
+        Choose the extraction's model tier and output budget from the document's
+        complexity, and record the decision on the job.
+        
+        Returns:
+            The selection, or None when model selection is off (the clients then
+            use their standard model and size the budget themselves)
+        """
+        if not settings.LLM_MODEL_SELECTION_ENABLED:
+            return None
+        selection = select_model(complexity, self._get_selection_policy(), get_output_policy())
+        job.model_selection = selection.as_dict()
+        logger.info(
+            f"Selected the {selection.tier} model tier with {selection.max_tokens} output tokens "
+            f"({', '.join(selection.exceeded) or 'simple document'})"
+        )
+        return selection
+
+    def _image_complexity(self, file_bytes: bytes) -> DocumentComplexity:
+        """The complexity of an uploaded image: a single page, and the table lines counted on it."""
+        image = bytes_to_cv2(file_bytes)
+        return DocumentComplexity(page_count=1, table_lines=(count_table_lines(image) or None) if image is not None else None)
+
+    def _get_cascade_policy(self) -> CascadePolicy:
+        """Build the classification cascade policy from settings."""
+        return CascadePolicy(
+            use_heuristic=settings.LLM_CASCADE_USE_HEURISTIC,
+            image_long_edge=settings.LLM_CASCADE_IMAGE_LONG_EDGE,
+            min_confidence=settings.LLM_CASCADE_MIN_CONFIDENCE,
+        )
+
+    def _classify_pdf(self, file_bytes: bytes) -> Optional[Dict[str, Any]]:
+        """Classify a PDF from its first page's text, or a low-resolution image of it when it has none."""
+        text = first_page_text(file_bytes)
+        if text is not None:
+            return self._classify_document(text, None)
+        policy = self._get_cascade_policy()
+        return self._classify_document(None, lambda: render_overview_image(
+            file_bytes, policy.image_long_edge,
+            encoding=self._get_render_options().encoding,
+            sandbox=self._get_sandbox_policy(),
+        ))
+
+    def _classify_document(self, text: Optional[str], render_image) -> Optional[Dict[str, Any]]:
+        """
+        First stage of the cascade: the document type, from the title in its first
+        page's text when it names a type that is extracted, or else from the small
+        classification model.
+        
+        Args:
+            text: The first page's text, if it has any
+            render_image: Renders the low-resolution first page image; only called
+                when there's no text to classify from
+        
+        Returns:
+            The document type, the confidence in it, which classifier decided
+            ('heuristic' or the AI service), and the stage's time, usage and cost;
+            None if no classifier could tell
+        """
+        policy = self._get_cascade_policy()
+        start_time = time.time()
+        document_type = classify_from_text(text) if policy.use_heuristic else None
+        # Only a title that sends the document on to extraction is trusted as is;
+        # one that would skip it is confirmed by the model
+        if document_type in EXTRACTABLE_TYPES:
+            classification = {'document_type': document_type, 'confidence': 1.0, 'source': 'heuristic'}
+        else:
+            clients = self._available_clients()
+            image = render_image() if text is None else None
+            if text is None and image is None:
+                return None
+            classification = None
+            # Classification calls are too short to feed the router's latency statistics
+            for provider in self.router.ranked(list(clients)):
+                result = clients[provider]().classify_document(image, text[:policy.max_text_chars] if text else None)
+                if result:
+                    classification = {**result, 'source': provider}
+                    break
+            if classification is None:
+                return None
+        classification['seconds'] = round(time.time() - start_time, 3)
+        classification['cost_usd'] = usage_cost(classification.get('usage'))
+        logger.info(
+            f"Classified as {classification['document_type']} ({classification['confidence']:.2f}) "
+            f"by {classification['source']} in {classification['seconds']}s"
+        )
+        return classification
+
+    def _skip_extraction(self, job: InvoiceExtractionJob, classification: Dict[str, Any]) -> Dict[str, Any]:
+        """The result of a document the first stage found has no invoices to extract."""
+        job.ai_service_used = classification['source']
+        job.render_stats = {
+            'input_mode': 'classified',
+            'cascade': {'classification': classification, 'extraction': None},
+        }
+        return {
+            'document_type': classification['document_type'],
+            'invoices': [],
+            'usage': classification.get('usage'),
+        }
+
+    def _record_cascade(
+        self,
+        job: InvoiceExtractionJob,
+        classification: Optional[Dict[str, Any]],
+        extraction_seconds: float,
+        result: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        """Record both cascade stages' time and cost on the job, and count the classification in the result's usage."""
+        if classification is None:
+            return result
+        job.render_stats = {
+            **job.render_stats,
+            'cascade': {
+                'classification': classification,
+                'extraction': {
+                    'seconds': round(extraction_seconds, 3),
+                    'cost_usd': usage_cost(result.get('usage')),
+                },
+            },
+        }
+        return {**result, 'usage': combine_usage([classification.get('usage'), result.get('usage')])}
+
+    def _get_window_policy(self) -> WindowPolicy:
+        """Build the per-request image limits from settings."""
+        return WindowPolicy(
+            max_images=settings.PDF_WINDOW_MAX_IMAGES,
+            max_bytes=settings.PDF_WINDOW_MAX_BYTES,
+            overlap_pages=settings.PDF_WINDOW_OVERLAP_PAGES,
+            max_workers=settings.PDF_WINDOW_WORKERS,
+        )
+
+    def _plan_windows(self, job: InvoiceExtractionJob, page_spool: PageSpool) -> Optional[List[Window]]:
+        """The overlapping windows to send a document's page images in, recorded on the job; None if one request holds them."""
+        layout = page_spool.layout()
+        policy = self._get_window_policy()
+        if not needs_windows(layout, policy):
+            return None
+        windows = plan_windows(layout, policy)
+        job.render_stats['windows'] = [
+            {'pages': [window.first_page, window.last_page], 'images': window.image_count}
+            for window in windows
+        ]
+        return windows
+
+    def _extract_images(
+        self,
+        client,
+        page_spool: PageSpool,
+        windows: Optional[List[Window]],
+        events: Optional[ExtractionEvents] = None,
+        selection: Optional[ModelSelection] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Send a document's page images to a client, in the planned windows if one request can't hold them.
+        
+        Windowed documents are not streamed: an invoice seen in two windows is
+        only known to be one once the windows are merged.
+        """
+        if windows is None:
+            return client.extract_invoice_data(page_spool, events=events, selection=selection)
+
+        # Windows are async requests on one event loop rather than a thread each
+        extract = partial(client.extract_invoice_data_async, selection=selection)
+        return run_sync(extract_in_windows_async(extract, page_spool, windows, self._get_window_policy()))
+
+    def _extract_from_segments(
+        self,
+        job: InvoiceExtractionJob,
+        segment_pdfs: List[bytes],
+        segments: List[Segment],
+        render_options: Optional[RenderOptions] = None,
+    ) -> Dict[str, Any]:
+        """Extract each invoice of a bundled PDF concurrently and merge the results into the job."""
+        def extract_segment(segment_pdf: bytes):
+            # Segments record their service and stats on a stand-in for the job,
+            # which is only updated once all of them are done
+            segment_job = SimpleNamespace(ai_service_used='', render_stats={}, model_selection={})
+            try:
+                return segment_job, self._extract_pdf_document(segment_job, segment_pdf, render_options)
+            finally:
+                # Each worker thread opens its own database connection
+                connection.close()
+        
+        with ThreadPoolExecutor(max_workers=settings.PDF_SEGMENT_WORKERS) as executor:
+            outcomes = list(executor.map(extract_segment, segment_pdfs))
+        
+        segment_stats = []
+        for segment, (segment_job, result) in zip(segments, outcomes):
+            segment_stats.append({
+                'page_range': [segment.start + 1, segment.end],
+                'boundary': segment.reason,
+                'invoice_number': segment.invoice_number,
+                'ai_service_used': segment_job.ai_service_used,
+                **segment_job.render_stats,
+                'llm_usage': result.get('usage'),
+            })
+        
+        services_used = sorted({segment_job.ai_service_used for segment_job, _ in outcomes})
+        job.ai_service_used = ','.join(services_used)[:50]
+        job.render_stats = {'input_mode': 'segmented', 'segments': segment_stats}
+        job.model_selection = {'segments': [segment_job.model_selection for segment_job, _ in outcomes]}
+        
+        # An invoice split across segments (a wrong boundary) comes back in parts;
+        # merge them by invoice number and amount as for windows
+        results = [result for _, result in outcomes]
+        merged = merge_window_results(results)
+        document_types = [result.get('document_type') for result in results]
+        merged['document_type'] = 'invoice' if 'invoice' in document_types else document_types[0]
+        return merged
+
+    def _learn_vendor_template(self, text_layer: Optional[TextLayer], extracted_data: Dict[str, Any]) -> None:
+        """Feed a successful LLM extraction of a born-digital PDF to its vendor's template."""
+        if text_layer is not None and settings.VENDOR_TEMPLATES_ENABLED:
+            self.template_service.observe(text_layer, extracted_data)
+
+    def _extract_from_text_layer(
+        self,
+        job: InvoiceExtractionJob,
+        file_bytes: bytes,
+        text_layer: TextLayer,
+        events: Optional[ExtractionEvents] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """Extract data from a PDF's text layer, optionally with a small image of its first page."""
+        policy = self._get_text_layer_policy()
+        images = []
+        if policy.include_overview_image:
+            overview = render_overview_image(
+                file_bytes, policy.overview_long_edge,
+                encoding=self._get_render_options().encoding,
+                sandbox=self._get_sandbox_policy(),
+            )
+            if overview is not None:
+                images.append(overview)
+
+        job.render_stats = {
+            'input_mode': 'text_layer',
+            'pages': len(text_layer.pages),
+            'text_chars': text_layer.char_count,
+            'images': len(images),
+        }
+
+        document_text = text_layer.render()
+        selection = self._select_model(job, text_complexity(len(text_layer.pages), text_layer.char_count, document_text))
+        return self._route(job, lambda client: client.extract_invoice_data(images, document_text=document_text, events=events, selection=selection))
+
     def _extract_from_csv(self, job: InvoiceExtractionJob) -> Dict[str, Any]:
         """Extract data from CSV file."""
         file_path = job.uploaded_file.path
@@ -437,7 +980,7 @@ class InvoiceExtractionService:
             job.ai_service_used = 'csv_parse_failed'
             raise Exception(f"CSV parsing failed: {str(e)}")
 
-    def _extract_from_image(self, job: InvoiceExtractionJob) -> Dict[str, Any]:
+    def _extract_from_image(self, job: InvoiceExtractionJob, events: Optional[ExtractionEvents] = None) -> Dict[str, Any]:
         """Extract data from image file."""
         file_path = job.uploaded_file.path
         
@@ -446,23 +989,23 @@ class InvoiceExtractionService:
             with open(file_path, 'rb') as f:
                 file_bytes = f.read()
             
-            image_base64 = base64.b64encode(file_bytes).decode('utf-8')
+            classification = None
+            if settings.LLM_CASCADE_ENABLED:
+                policy = self._get_cascade_policy()
+                classification = self._classify_document(None, lambda: shrink_image(file_bytes, policy.image_long_edge))
+                if not should_extract(classification, policy):
+                    return self._skip_extraction(job, classification)
             
-            # Try to use available AI services
-            if hasattr(settings, 'ANTHROPIC_API_KEY') and settings.ANTHROPIC_API_KEY:
-                client = self.AnthropicClient()
-                result = client.extract_invoice_data(image_base64)
-                job.ai_service_used = 'anthropic'
-                if result:
-                    return result
+            image_base64 = self._image_payload(file_bytes, job.file_type)
+            selection = None
+            if settings.LLM_MODEL_SELECTION_ENABLED:
+                selection = self._select_model(job, self._image_complexity(file_bytes))
             
-            elif (hasattr(settings, 'AWS_DEFAULT_REGION') and settings.AWS_DEFAULT_REGION and 
-                  hasattr(settings, 'AWS_ACCESS_KEY_ID') and settings.AWS_ACCESS_KEY_ID):
-                client = self.BedrockClient()
-                result = client.extract_invoice_data(image_base64)
-                job.ai_service_used = 'bedrock'
-                if result:
-                    return result
+            # Use the fastest healthy AI service, failing over to the others
+            extraction_start = time.time()
+            result = self._route(job, lambda client: client.extract_invoice_data(image_base64, events=events, selection=selection))
+            if result:
+                return self._record_cascade(job, classification, time.time() - extraction_start, result)
             
             # If no AI services available, return an error
             raise Exception("No AI extraction services configured. Please configure ANTHROPIC_API_KEY or AWS credentials.")
@@ -489,7 +1032,10 @@ class InvoiceExtractionService:
                 payment_term_days=invoice_data.get('payment_term_days'),
                 vendor=invoice_data.get('vendor'),
                 billing_address=invoice_data.get('billing_address'),
-                payment_method=invoice_data.get('payment_method')
+                payment_method=invoice_data.get('payment_method'),
+                # Set when the data is reused from a duplicate's already processed invoice
+                processed_to_invoice=bool(invoice_data.get('processed_invoice_id')),
+                processed_invoice_id=invoice_data.get('processed_invoice_id')
             )
             
             # Create line items separately
@@ -522,6 +1068,34 @@ class POMatchingService:
     
     def __init__(self):
         self._cached_po_numbers = None
+        self._prefetched: Dict[Tuple[str, int], Future] = {}
+        self._prefetch_executor: Optional[ThreadPoolExecutor] = None
+    
+    def prefetch_match(self, po_number: Any, match_threshold: int = 2) -> None:
+        """
+        Start looking up a PO number's match in the background, e.g. while the
+        model is still writing the rest of its invoice; matching picks it up.
+        """
+        key = (str(po_number or '').strip(), match_threshold)
+        if not key[0] or key in self._prefetched:
+            return
+        if self._prefetch_executor is None:
+            self._prefetch_executor = ThreadPoolExecutor(max_workers=settings.PO_PREFETCH_WORKERS)
+        self._prefetched[key] = self._prefetch_executor.submit(self._prefetch_in_thread, *key)
+    
+    def _prefetch_in_thread(self, po_number: str, match_threshold: int) -> Optional[Tuple[PurchaseOrder, str]]:
+        try:
+            return self._match_po_number(po_number, match_threshold)
+        finally:
+            # Each worker thread opens its own database connection
+            connection.close()
+    
+    def close(self) -> None:
+        """Wait for outstanding prefetches and drop their results."""
+        if self._prefetch_executor is not None:
+            self._prefetch_executor.shutdown(wait=True)
+            self._prefetch_executor = None
+        self._prefetched = {}
     
     def find_matching_pos(self, extracted_invoices: List[Dict[str, Any]], match_threshold: int = 2) -> List[Dict[str, Any]]:
         """
@@ -568,15 +1142,16 @@ class POMatchingService:
             'match_type': 'none'
         }
         
-        if not extracted_po_number or not self._cached_po_numbers:
+        if not extracted_po_number:
             return result
         
-        # Find best match using document matching service
-        match_result = find_best_match(extracted_po_number, self._cached_po_numbers, match_threshold)
+        # Use the lookup started while the invoice was being extracted, if any
+        prefetched = self._prefetched.pop((extracted_po_number, match_threshold), None)
+        match = prefetched.result() if prefetched is not None else self._match_po_number(extracted_po_number, match_threshold)
         
-        if match_result:
-            matched_po_number, match_type_result = match_result
-            matched_po = PurchaseOrder.objects.select_related('vendor', 'company').get(po_number=matched_po_number)
+        if match:
+            matched_po, match_type_result = match
+            matched_po_number = matched_po.po_number
             
             # Calculate confidence score
             match_confidence = calculate_match_confidence(
@@ -592,6 +1167,22 @@ class POMatchingService:
             })
         
         return result
+    
+    def _match_po_number(self, po_number: str, match_threshold: int) -> Optional[Tuple[PurchaseOrder, str]]:
+        """Find the PO best matching a PO number, with the match type ('exact' or fuzzy)."""
+        # Cache PO numbers for efficiency
+        po_numbers = self._cached_po_numbers
+        if po_numbers is None:
+            po_numbers = self._cached_po_numbers = list(PurchaseOrder.objects.values_list('po_number', flat=True))
+        if not po_numbers:
+            return None
+        
+        # Find best match using document matching service
+        match_result = find_best_match(po_number, po_numbers, match_threshold)
+        if not match_result:
+            return None
+        matched_po_number, match_type_result = match_result
+        return PurchaseOrder.objects.select_related('vendor', 'company').get(po_number=matched_po_number), match_type_result
 
 
 class DataComparisonService:
@@ -712,9 +1303,18 @@ class ExtractAndMatchOrchestrator:
         # Step 1: Create extraction job
         job = self._create_extraction_job(uploaded_file)
         
+        # PO lookups start as soon as the model has written each invoice's PO
+        # number, while it is still writing the line items
+        events = None
+        if settings.LLM_STREAMING_ENABLED:
+            events = ExtractionEvents(
+                on_field=lambda index, field, value: self._on_extracted_field(field, value, match_threshold),
+                fields=('po_number',),
+            )
+        
         try:
             # Step 2: Extract invoice data (this runs the full extraction pipeline)
-            extraction_result = self.extraction_service.extract_invoice_data(job)
+            extraction_result = self.extraction_service.extract_invoice_data(job, events=events)
             
             # The extraction service now saves to models and returns frontend format
             # We need to get the actual ExtractedInvoice model instances for matching
@@ -743,34 +1343,43 @@ class ExtractAndMatchOrchestrator:
             for result in matching_results:
                 extracted_invoice = result['extracted_invoice']
                 
-                # Create Invoice record
-                invoice = Invoice.objects.create(
-                    invoice_number=extracted_invoice.invoice_number,
-                    date=extracted_invoice.date,
-                    due_date=extracted_invoice.due_date,
-                    po_number=extracted_invoice.po_number,
-                    vendor=Vendor.objects.get_or_create(name=extracted_invoice.vendor)[0],
-                    company=Company.objects.first(),  # TODO: Determine company from context
-                    currency=extracted_invoice.currency_code,
-                    payment_terms=extracted_invoice.payment_term_days,
-                    billing_address=extracted_invoice.billing_address,
-                    total_due=extracted_invoice.amount
-                )
+                # Re-sent duplicates reuse the Invoice created for the original
+                invoice = None
+                if extracted_invoice.processed_invoice_id:
+                    invoice = Invoice.objects.filter(id=extracted_invoice.processed_invoice_id).first()
                 
-                # Create line items
-                for line_item in extracted_invoice.line_items.all():
-                    item = Item.objects.get_or_create(
-                        description=line_item.description,
-                        defaults={'item_code': f'AUTO-{line_item.id}'}
-                    )[0]
-                    
-                    InvoiceLineItem.objects.create(
-                        invoice=invoice,
-                        item=item,
-                        quantity=line_item.quantity,
-                        unit_price=line_item.unit_price,
-                        total=line_item.total
+                if invoice is None:
+                    # Create Invoice record
+                    invoice = Invoice.objects.create(
+                        invoice_number=extracted_invoice.invoice_number,
+                        date=extracted_invoice.date,
+                        due_date=extracted_invoice.due_date,
+                        po_number=extracted_invoice.po_number,
+                        vendor=Vendor.objects.get_or_create(name=extracted_invoice.vendor)[0],
+                        company=Company.objects.first(),  # TODO: Determine company from context
+                        currency=extracted_invoice.currency_code,
+                        payment_terms=extracted_invoice.payment_term_days,
+                        billing_address=extracted_invoice.billing_address,
+                        total_due=extracted_invoice.amount
                     )
+                    extracted_invoice.processed_to_invoice = True
+                    extracted_invoice.processed_invoice_id = invoice.id
+                    extracted_invoice.save(update_fields=['processed_to_invoice', 'processed_invoice_id'])
+                
+                    # Create line items
+                    for line_item in extracted_invoice.line_items.all():
+                        item = Item.objects.get_or_create(
+                            description=line_item.description,
+                            defaults={'item_code': f'AUTO-{line_item.id}'}
+                        )[0]
+                    
+                        InvoiceLineItem.objects.create(
+                            invoice=invoice,
+                            item=item,
+                            quantity=line_item.quantity,
+                            unit_price=line_item.unit_price,
+                            total=line_item.total
+                        )
                 
                 # Assign user based on rules
                 assigned_user, assignment_explanation = self.assignment_service.assign_invoice(invoice)
@@ -792,6 +1401,13 @@ class ExtractAndMatchOrchestrator:
             job.error_message = f'Workflow failed: {str(e)}'
             job.save()
             raise e
+        finally:
+            self.matching_service.close()
+    
+    def _on_extracted_field(self, field: str, value: Any, match_threshold: int) -> None:
+        """Act on an invoice field streamed from the model before the extraction finishes."""
+        if field == 'po_number' and value:
+            self.matching_service.prefetch_match(value, match_threshold)
     
     def _create_extraction_job(self, uploaded_file: UploadedFile) -> InvoiceExtractionJob:
         """Create a new extraction job from uploaded file."""
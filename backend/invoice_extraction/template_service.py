@@ -0,0 +1,180 @@
+"""
+Vendor Template Service
+
+This service learns per-vendor invoice layouts from LLM extractions of
+born-digital PDFs and uses them to extract later invoices from the same
+vendors locally, without an LLM call.
+
+Templates are stored in the database (VendorTemplate) and the active ones are
+cached in memory in each worker process, refreshed every
+VENDOR_TEMPLATE_CACHE_SECONDS or as soon as this process changes one.
+"""
+
+import logging
+import re
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from ai_engineering.text_layer import TextLayer
+from ai_engineering.vendor_templates import (
+    apply_template,
+    document_segments,
+    identity_texts,
+    learn_template,
+    observe_extraction,
+)
+
+from .models import VendorTemplate
+
+logger = logging.getLogger(__name__)
+
+# Templates whose identity is smaller than this are too generic to recognise a vendor by
+MIN_IDENTITY_TEXTS = 10
+
+_cache_lock = threading.Lock()
+_cache: Dict[str, Any] = {'loaded_at': 0.0, 'templates': {}, 'index': {}}
+
+
+def vendor_key(vendor_name: str) -> str:
+    """Normalize a vendor name so spelling variants of the same vendor share a template."""
+    return re.sub(r'[^a-z0-9]+', ' ', vendor_name.casefold()).strip()
+
+
+def invalidate_template_cache() -> None:
+    """Force the next lookup in this process to reload templates from the database."""
+    with _cache_lock:
+        _cache['loaded_at'] = 0.0
+
+
+class VendorTemplateService:
+    """Service for learning vendor templates and extracting invoices with them."""
+
+    def _active_templates(self) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, set]]:
+        """Return the cached active templates and an index from identity text to vendor keys."""
+        with _cache_lock:
+            if time.monotonic() - _cache['loaded_at'] > settings.VENDOR_TEMPLATE_CACHE_SECONDS:
+                templates = {}
+                index: Dict[str, set] = {}
+                for key, template in VendorTemplate.objects.filter(status='ACTIVE').values_list('vendor_key', 'template'):
+                    templates[key] = template
+                    for text in template.get('identity', []):
+                        index.setdefault(text, set()).add(key)
+                _cache.update(loaded_at=time.monotonic(), templates=templates, index=index)
+            return _cache['templates'], _cache['index']
+
+    def match_template(self, text_layer: TextLayer) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """
+        Find the active template whose vendor identity best matches a document.
+
+        Returns:
+            (vendor key, template) or None if no template matches closely enough
+        """
+        templates, index = self._active_templates()
+        if not templates:
+            return None
+
+        counts: Dict[str, int] = {}
+        for text in identity_texts(document_segments(text_layer)):
+            for key in index.get(text, ()):
+                counts[key] = counts.get(key, 0) + 1
+
+        best_key, best_score = None, 0.0
+        for key, count in counts.items():
+            score = count / len(templates[key]['identity'])
+            if score > best_score:
+                best_key, best_score = key, score
+
+        if best_key is None or best_score < settings.VENDOR_TEMPLATE_MIN_IDENTITY_SCORE:
+            return None
+        return best_key, templates[best_key]
+
+    def extract(self, text_layer: TextLayer) -> Optional[Dict[str, Any]]:
+        """
+        Extract a document with its vendor's template, if one matches and the result validates.
+
+        Returns:
+            Extraction result in the same shape as the LLM clients return, or None
+            when the document should go to the LLM
+        """
+        match = self.match_template(text_layer)
+        if match is None:
+            return None
+        key, template = match
+
+        try:
+            invoice, reason = apply_template(template, text_layer)
+        except Exception as e:
+            invoice, reason = None, f"template error: {str(e)}"
+        if invoice is None:
+            logger.info(f"Vendor template for '{key}' failed, falling back to LLM: {reason}")
+            VendorTemplate.objects.filter(vendor_key=key).update(
+                fallback_count=F('fallback_count') + 1,
+                last_fallback_reason=reason,
+            )
+            return None
+
+        VendorTemplate.objects.filter(vendor_key=key).update(hit_count=F('hit_count') + 1)
+        logger.info(f"Extracted invoice {invoice.get('number')} with the vendor template for '{key}'")
+        return {
+            'document_type': 'invoice',
+            'invoices': [invoice],
+            'vendor_template': key,
+        }
+
+    def observe(self, text_layer: TextLayer, extracted_data: Dict[str, Any]) -> None:
+        """
+        Learn from a successful LLM extraction of a born-digital PDF.
+
+        Only single-invoice documents with a vendor are used. Once the latest
+        VENDOR_TEMPLATE_MIN_SAMPLES observations agree on a layout the vendor's
+        template becomes active; if they stop agreeing (the vendor changed its
+        layout) it goes back to learning. Disabled templates keep collecting
+        observations but are never reactivated automatically.
+        """
+        invoices = extracted_data.get('invoices') or []
+        if extracted_data.get('document_type') != 'invoice' or len(invoices) != 1:
+            return
+        vendor_name = (invoices[0].get('vendor') or '').strip()
+        key = vendor_key(vendor_name)[:255]
+        if not key:
+            return
+
+        # Learning is best effort and must never fail the extraction it learns from
+        try:
+            self._record_observation(key, vendor_name, observe_extraction(text_layer, invoices[0]))
+        except Exception:
+            logger.exception(f"Failed to update the vendor template for '{key}'")
+            return
+
+        invalidate_template_cache()
+
+    def _record_observation(self, key: str, vendor_name: str, observation: Dict[str, Any]) -> None:
+        """Store an observation and relearn the vendor's template from the latest ones."""
+        min_samples = settings.VENDOR_TEMPLATE_MIN_SAMPLES
+
+        with transaction.atomic():
+            vendor_template, _ = VendorTemplate.objects.select_for_update().get_or_create(
+                vendor_key=key,
+                defaults={'vendor_name': vendor_name[:255]},
+            )
+            vendor_template.observations = (vendor_template.observations + [observation])[-min_samples:]
+            vendor_template.sample_count += 1
+
+            if len(vendor_template.observations) >= min_samples:
+                learned = learn_template(vendor_template.observations)
+                if learned and len(learned['identity']) >= MIN_IDENTITY_TEXTS:
+                    vendor_template.template = learned
+                    if vendor_template.status != 'DISABLED':
+                        if vendor_template.status != 'ACTIVE':
+                            logger.info(f"Vendor template for '{key}' learned from {min_samples} extractions")
+                        vendor_template.status = 'ACTIVE'
+                elif vendor_template.status == 'ACTIVE':
+                    logger.info(f"Vendor template for '{key}' no longer matches recent extractions; relearning")
+                    vendor_template.status = 'LEARNING'
+
+            vendor_template.save()
@@ -8,17 +8,46 @@ from typing import Optional, List, Dict, Any, Tuple
 from django.contrib.auth.models import User
 from .models import Invoice, AssignmentRule, AssignmentRuleUser
 from ai_engineering.anthropic_client import AnthropicClient
+from ai_engineering.client_registry import get_anthropic_client
+from ai_engineering.circuit_breaker import get_circuit_breaker
+from ai_engineering.prompt_cache import cached_text_block, usage_from_response
+from ai_engineering.rate_limit import get_rate_limiter, message_tokens
 import logging
 import json
 
 logger = logging.getLogger(__name__)
 
+ASSIGNMENT_INSTRUCTIONS = """You are an expert in invoice processing and workflow assignment. Your task is to analyze an invoice and determine which assignment rules should apply to it.
+
+For each rule, evaluate if it should apply to this invoice based on the natural language rule description and invoice characteristics.
+Consider factors like:
+- Invoice amount and currency
+- Vendor and company
+- Line item descriptions and categories
+- PO/GR presence
+- Payment terms
+- Department relevance
+
+Return a JSON array of rule IDs that should apply, ordered by confidence (highest first). Include a brief explanation for each match.
+Format:
+[
+  {
+    "rule_id": 123,
+    "confidence": 0.95,
+    "explanation": "Rule matches because..."
+  }
+]
+
+Only include rules where you are at least 70% confident they should apply."""
+
 
 class InvoiceAssignmentService:
     """Service for automatic invoice assignment based on rules."""
     
-    def __init__(self):
-        self.anthropic_client = AnthropicClient()
+    @property
+    def anthropic_client(self) -> AnthropicClient:
+        """The process-wide Anthropic client, built on first use."""
+        return get_anthropic_client()
     
     def assign_invoice(self, invoice: Invoice, force_reassign: bool = False) -> Tuple[Optional[User], Optional[Dict[str, Any]]]:
         """
@@ -121,42 +150,37 @@ class InvoiceAssignmentService:
             for rule in active_rules
         ]
         
-        # Create prompt for Claude
-        prompt = f"""You are an expert in invoice processing and workflow assignment. Your task is to analyze an invoice and determine which assignment rules should apply to it.
-
-Here is the invoice data:
+        # The instructions and rules are the same for every invoice until a rule
+        # changes, so they form the cached system prefix and the invoice comes last
+        system = [
+            {"type": "text", "text": ASSIGNMENT_INSTRUCTIONS},
+            cached_text_block(
+                f"Here are the available assignment rules:\n{json.dumps(rules_data, indent=2)}",
+                self.anthropic_client.prompt_caching,
+            ),
+        ]
+        prompt = f"""Here is the invoice data:
 {json.dumps(invoice_data, indent=2)}
 
-Here are the available assignment rules:
-{json.dumps(rules_data, indent=2)}
-
-For each rule, evaluate if it should apply to this invoice based on the natural language rule description and invoice characteristics.
-Consider factors like:
-- Invoice amount and currency
-- Vendor and company
-- Line item descriptions and categories
-- PO/GR presence
-- Payment terms
-- Department relevance
-
-Return a JSON array of rule IDs that should apply, ordered by confidence (highest first). Include a brief explanation for each match.
-Format:
-[
-  {{
-    "rule_id": 123,
-    "confidence": 0.95,
-    "explanation": "Rule matches because..."
-  }}
-]
-
-Only include rules where you are at least 70% confident they should apply."""
+Return the JSON array of matching rules for this invoice."""
 
         try:
-            # Get Claude's analysis
-            response = self.anthropic_client.client.messages.create(
+            # Get Claude's analysis, within the circuit breaker and rate limit shared with extraction
+            messages = [{"role": "user", "content": prompt}]
+            rate_limiter = get_rate_limiter()
+            reserved = message_tokens(messages, 1000, system=system)
+            response = get_circuit_breaker().call("anthropic", lambda: rate_limiter.call("anthropic", reserved, lambda: self.anthropic_client.client.messages.create(
                 model=self.anthropic_client.model,
                 max_tokens=1000,
-                messages=[{"role": "user", "content": prompt}]
+                system=system,
+                messages=messages
+            )))
+            usage = usage_from_response(response.usage)
+            rate_limiter.settle("anthropic", reserved, usage)
+            logger.info(
+                f"Rule matching for invoice {invoice.invoice_number} used {usage['input_tokens']} input, "
+                f"{usage['cache_read_input_tokens']} cache read, {usage['cache_creation_input_tokens']} cache write "
+                f"and {usage['output_tokens']} output tokens"
             )
             
             # Parse the response - extract the JSON array from the text content